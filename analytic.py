@@ -2,15 +2,22 @@
 # analytics.py
 from __future__ import annotations
 from dataclasses import dataclass
-from functools import lru_cache
-import json
 import numpy as np
 import pandas as pd
 import plotly.express as px
 from sqlalchemy import create_engine
 from sqlalchemy.engine import URL
 import os
+import sys
+import time
+import argparse
+import threading
+import weakref
+import pickle
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from dotenv import load_dotenv
+from snapshot import source_fingerprint, load_snapshot, save_snapshot
 
 '''提供 KPI、退貨原因佔比、熱點、四象限、Top5、時滯、金額統計'''
 
@@ -29,16 +36,154 @@ QUADRANT_ORDER = [
     "左下：低銷售×低退貨",
 ]
 
+# 維度欄位：每筆訂單明細都重複一次的字串 → 字典編碼（category）
+DIM_COLS = ["barcode", "productid", "product_name", "supplier",
+            "category1", "category2", "category3", "color", "size", "reason_cat"]
+TAG_SEP = "|"       # tags_l2 以標籤組合字串存成 category，例如 "尺寸不符|尺寸偏小"；沒有標籤 = ""
+# base 快照：目錄（設成空字串 = 不用快照）、來源表、build 邏輯版本（改 build_base 時遞增，舊快照自動失效）
+SNAPSHOT_DIR  = os.getenv("BASE_SNAPSHOT_DIR", os.path.join(".cache", "base_snapshot"))
+BASE_SOURCES  = ["product", "orders", "returns_clean", "return_tags", "reason_tag"]
+# 各表有索引的鍵：新資料 → MAX 變動（只讀索引端點，輪詢成本與資料量無關）
+BASE_MAX_COLS = {"product": "barcode", "orders": "orderdate", "returns_clean": "return_id",
+                 "return_tags": "return_id", "reason_tag": "tag_id"}
+BASE_BUILD_VERSION = "base-v1"
+
 # ===== 連線 & 載入 =====
 def get_engine(db: dict):
     url = URL.create("mysql+mysqlconnector", username=db["user"], password=db["password"],
                  host=db["host"], port=db["port"], database=db["database"], query={"charset":"utf8mb4"})
     return create_engine(url)
 
-@lru_cache(maxsize=1)
-def load_base_df(db_host, db_user, db_password, db_name, db_port=3306) -> pd.DataFrame:
-    """從 MySQL 撈三表，建立 base 明細。結果快取（同一參數重用）。"""
+def data_version(eng) -> str:
+    """來源資料版本：各表 data_version 版本號、MAX(鍵)、UPDATE_TIME 的指紋（只查統計與索引端點，不掃資料）"""
+    return source_fingerprint(eng, BASE_SOURCES, extra=BASE_BUILD_VERSION, max_cols=BASE_MAX_COLS)
+
+def load_base_df(db_host, db_user, db_password, db_name, db_port=3306, compact=True,
+                 snapshot=True) -> pd.DataFrame:
+    """
+    建立 base 明細（不快取；常駐程式請用 BaseCache）。compact=False 保留舊的寬表格式（對照記憶體用）。
+    snapshot=True：來源表指紋與本機快照相符就直接 mmap 載入；不符才從 MySQL 重建並寫回快照。
+    """
     eng = get_engine({"host":db_host,"user":db_user,"password":db_password,"database":db_name,"port":db_port})
+    return load_base(eng, compact=compact, snapshot=snapshot)
+
+def load_base(eng, version=None, compact=True, snapshot=True) -> pd.DataFrame:
+    use_snapshot = compact and snapshot and bool(SNAPSHOT_DIR)
+    if use_snapshot:
+        version = version or data_version(eng)
+        base = load_snapshot(SNAPSHOT_DIR, version)
+        if base is not None:
+            return base
+    base = build_base(*read_sources(eng), compact=compact)
+    if use_snapshot:
+        save_snapshot(base, SNAPSHOT_DIR, version)
+    return base
+
+class BaseCache:
+    """
+    常駐的 base 明細快取：
+      - get() 永遠回傳一份完整的 frame（第一次呼叫時同步載入）
+      - 背景 thread 每 poll_seconds 查一次 data_version()，變了才在背景重建
+      - 重建完成後一次換掉 (版本, frame, 載入時間)；進行中的查詢拿的是舊 frame，不會被擋住也不會看到半成品
+    """
+    def __init__(self, db: dict, poll_seconds: float = 60, compact: bool = True, snapshot: bool = True):
+        self.eng = get_engine(db)
+        self.poll_seconds = poll_seconds
+        self.compact, self.snapshot = compact, snapshot
+        self._current = None                 # (version, df, loaded_at)，整個 tuple 一次替換
+        self._build_lock = threading.Lock()  # 同時只有一個重建
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_error = None
+        self.last_poll = None
+
+    def _build(self, version):
+        df = load_base(self.eng, version, compact=self.compact, snapshot=self.snapshot)
+        filter_index(df)                     # 換上之前先建好篩選 / 趨勢 / 時滯草圖索引
+        trend_index(df)
+        lag_sketch_index(df)
+        self._current = (version, df, time.time())
+        return df
+
+    def get(self) -> pd.DataFrame:
+        cur = self._current
+        if cur is not None:
+            return cur[1]
+        with self._build_lock:
+            if self._current is None:
+                self._build(data_version(self.eng))
+        return self._current[1]
+
+    def current(self) -> tuple:
+        """(版本, frame, 載入時間 epoch)：同一次查詢內版本與資料一致"""
+        self.get()
+        return self._current
+
+    def refresh(self, wait: bool = False) -> bool:
+        """查版本；有變動就重建（wait=False 在背景 thread 做）。回傳是否觸發重建"""
+        version = data_version(self.eng)
+        self.last_poll = time.time()
+        cur = self._current
+        if cur is not None and cur[0] == version:
+            return False
+        if not self._build_lock.acquire(blocking=wait):
+            return False                     # 已在重建中
+        def work():
+            try:
+                t0 = time.perf_counter()
+                df = self._build(version)
+                self.last_error = None
+                print(f"[base] 版本 {version} 載入完成：{len(df):,} 列，{time.perf_counter() - t0:.1f}s")
+            except Exception as e:           # 重建失敗就繼續提供舊 frame
+                self.last_error = f"{type(e).__name__}: {e}"
+                print(f"[base] 重建失敗，沿用舊資料：{self.last_error}")
+            finally:
+                self._build_lock.release()
+        if wait:
+            work()
+        else:
+            threading.Thread(target=work, name="base-rebuild", daemon=True).start()
+        return True
+
+    def _loop(self):
+        while not self._stop.wait(self.poll_seconds):
+            try:
+                self.refresh()
+            except Exception as e:           # DB 暫時連不上：下一輪再試
+                self.last_error = f"{type(e).__name__}: {e}"
+
+    def start(self):
+        """啟動背景輪詢（poll_seconds <= 0 則不輪詢）"""
+        if self.poll_seconds > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="base-poll", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    @property
+    def version(self) -> str | None:
+        cur = self._current
+        return cur[0] if cur else None
+
+    @property
+    def age_seconds(self) -> float | None:
+        cur = self._current
+        return time.time() - cur[2] if cur else None
+
+    def info(self) -> dict:
+        cur = self._current
+        return {"version": cur[0] if cur else None,
+                "rows": len(cur[1]) if cur else 0,
+                "loaded_at": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(cur[2])) if cur else None,
+                "age_seconds": round(self.age_seconds, 1) if cur else None,
+                "building": self._build_lock.locked(),
+                "last_poll": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.last_poll)) if self.last_poll else None,
+                "last_error": self.last_error}
+
+def read_sources(eng):
+    """從 MySQL 撈 product / orders / returns_clean 與 L2 標籤代碼"""
     p = pd.read_sql("""
         SELECT barcode, productid, product_name, supplier, sellprice, category1, category2, category3,color,size
         FROM product
@@ -46,64 +191,493 @@ def load_base_df(db_host, db_user, db_password, db_name, db_port=3306) -> pd.Dat
     o = pd.read_sql("SELECT orderid, orderdate, barcode, sell_qty FROM orders", eng)
     r = pd.read_sql("""
         SELECT return_id, orderid, returndate, barcode, return_qty,
-               COALESCE(reason_category_l1,'其他') AS reason_cat, reason_tags
+               COALESCE(reason_category_l1,'其他') AS reason_cat
         FROM returns_clean
     """, eng)
+    # L2 標籤：return_tags 只存整數代碼，字典另外撈一次再對回名稱
+    links = pd.read_sql("SELECT return_id, tag_id FROM return_tags ORDER BY return_id, seq", eng)
+    names = pd.read_sql("SELECT tag_id, tag FROM reason_tag", eng).set_index("tag_id")["tag"]
 
+    return p, o, r, links, names
+
+def build_base(p, o, r, links, names, compact=True) -> pd.DataFrame:
+    """
+    product / orders / returns_clean / return_tags 合併成 base 明細。
+    compact=True：維度欄 category、數量 int32、單價與時滯 float32、年月用 period[M]、tags_l2 為標籤組合的 category；
+    金額欄（sales_amount / loss_amount）維持 float64，避免大量加總失真。
+    """
     o["orderdate"]   = pd.to_datetime(o["orderdate"], errors="coerce")
     r["returndate"]  = pd.to_datetime(r["returndate"], errors="coerce")
+    r["tags_l2"]     = tags_by_return(r["return_id"], links, names)
+    if compact:
+        # 合併前先在小表上編碼，合併後就不會出現整張寬表的 object 字串
+        for d in (p, r):
+            for c in d.columns.intersection(DIM_COLS).drop("barcode", errors="ignore"):
+                d[c] = d[c].astype("category")
+        o["sell_qty"] = o["sell_qty"].astype("int32")
+        p["sellprice"] = p["sellprice"].astype("float32")
 
     base = o.merge(r, on=["orderid","barcode"], how="left") \
             .merge(p, on="barcode", how="left")
     base["return_qty"]   = base["return_qty"].fillna(0)
-    base["sales_amount"] = base["sell_qty"] * base["sellprice"]
-    base["loss_amount"]  = base["return_qty"] * base["sellprice"]
-    base["order_ym"]     = base["orderdate"].dt.to_period("M").astype(str)
-    base["event_ym"]     = base["returndate"].dt.to_period("M").astype(str)
-    base["lag_days"]     = (base["returndate"] - base["orderdate"]).dt.days
-
-    def parse_tags(s):
-        if pd.isna(s): return []
-        try:
-            v = json.loads(s)
-            return v if isinstance(v, list) else []
-        except Exception:
-            return []
-    base["tags_l2"] = base["reason_tags"].apply(parse_tags)
+    base["tags_l2"]      = base["tags_l2"].fillna("")
+    if compact:
+        base["barcode"]    = base["barcode"].astype("category")
+        base["return_qty"] = base["return_qty"].astype("int32")
+        base["tags_l2"]    = base["tags_l2"].astype("category")
+    price = base["sellprice"].astype("float64")
+    base["sales_amount"] = base["sell_qty"] * price
+    base["loss_amount"]  = base["return_qty"] * price
+    if compact:
+        base["order_ym"] = base["orderdate"].dt.to_period("M")
+        base["event_ym"] = base["returndate"].dt.to_period("M")
+        base["lag_days"] = (base["returndate"] - base["orderdate"]).dt.days.astype("float32")
+    else:
+        base["order_ym"] = base["orderdate"].dt.to_period("M").astype(str)
+        base["event_ym"] = base["returndate"].dt.to_period("M").astype(str)
+        base["lag_days"] = (base["returndate"] - base["orderdate"]).dt.days
     return base
 
+def tags_by_return(return_ids: pd.Series, links: pd.DataFrame, names: pd.Series) -> pd.Series:
+    """return_tags (return_id, tag_id) 代碼 → 每筆退貨的標籤組合字串（以 TAG_SEP 串接，沒有標籤 → ""）"""
+    tags = links["tag_id"].map(names)
+    grouped = tags.groupby(links["return_id"].to_numpy(), sort=False).agg(TAG_SEP.join)
+    return return_ids.map(grouped).fillna("")
+
+def split_tags(v) -> list[str]:
+    """tags_l2 的值 → 標籤 list"""
+    return v.split(TAG_SEP) if isinstance(v, str) and v else []
+
+class TagMatrix:
+    """
+    L2 標籤的 multi-hot 矩陣（列 × 標籤），以兩個因子表示：
+      codes：每列的標籤組合代碼（tags_l2 的 category codes，-1 = 缺值）
+      combo：組合 × 標籤 的 0/1 矩陣（組合數通常只有數百）
+    列 × 標籤 = onehot(codes) @ combo，所以「每個標籤的加總」= combo.T @ bincount(codes, 權重)，
+    不用展開成一列一標籤。combo 只依類別值而定，同一資料版本的明細 / 篩選結果 / cube 共用同一份。
+    """
+    def __init__(self, combos: tuple):
+        self.combos = combos
+        self.tags = pd.Index(sorted({t for c in combos for t in split_tags(c)}), name="tags_l2")
+        pos = {t: i for i, t in enumerate(self.tags)}
+        self.combo = np.zeros((len(combos), len(self.tags)), dtype=np.float64)
+        for i, c in enumerate(combos):
+            for t in split_tags(c):
+                self.combo[i, pos[t]] = 1.0
+
+    @staticmethod
+    def codes(df: pd.DataFrame) -> tuple[np.ndarray, tuple]:
+        col = df["tags_l2"]
+        cat = col.array if isinstance(col.dtype, pd.CategoricalDtype) else pd.Categorical(col)
+        return np.asarray(cat.codes), tuple(cat.categories)
+
+    def sum_by_tag(self, codes: np.ndarray, values) -> pd.Series:
+        """各標籤的 values 加總（NaN 視為 0）"""
+        ok = codes >= 0
+        w = np.nan_to_num(np.asarray(values, dtype="float64")[ok])
+        per_combo = np.bincount(codes[ok], weights=w, minlength=len(self.combos))
+        return pd.Series(per_combo @ self.combo, index=self.tags)
+
+    def crosstab(self, codes: np.ndarray, dim: pd.Series, values) -> pd.DataFrame:
+        """dim（例如 category3 / barcode）× 標籤 的 values 加總；只計有標籤的列"""
+        has_tag = self.combo.any(axis=1)
+        ok = (codes >= 0) & dim.notna().to_numpy()
+        ok[ok] = has_tag[codes[ok]]
+        dim_codes, dim_vals = pd.factorize(dim[ok], sort=True)
+        keys = dim_codes.astype(np.int64) * len(self.combos) + codes[ok]
+        uniq, inv = np.unique(keys, return_inverse=True)
+        sums = np.bincount(inv, weights=np.nan_to_num(np.asarray(values, dtype="float64")[ok]))
+        out = np.zeros((len(dim_vals), len(self.tags)))
+        np.add.at(out, uniq // len(self.combos), sums[:, None] * self.combo[uniq % len(self.combos)])
+        return pd.DataFrame(out, index=pd.Index(dim_vals, name=dim.name), columns=self.tags)
+
+_TAG_MATRICES = OrderedDict()      # 組合 tuple → TagMatrix（保留最近幾個資料版本）
+_TAG_MATRICES_LOCK = threading.Lock()   # 面板在 PanelScheduler 的多個 thread 上同時呼叫
+
+def tag_matrix(df: pd.DataFrame) -> tuple[TagMatrix, np.ndarray]:
+    """(TagMatrix, 每列組合代碼)；組合矩陣依類別值快取"""
+    codes, combos = TagMatrix.codes(df)
+    with _TAG_MATRICES_LOCK:
+        tm = _TAG_MATRICES.get(combos)
+        if tm is None:
+            tm = _TAG_MATRICES[combos] = TagMatrix(combos)
+            while len(_TAG_MATRICES) > 4:
+                _TAG_MATRICES.popitem(last=False)
+        else:
+            _TAG_MATRICES.move_to_end(combos)
+    return tm, codes
+
+def memory_report(df: pd.DataFrame, baseline: pd.DataFrame | None = None) -> pd.DataFrame:
+    """
+    每欄記憶體（bytes，deep=True 含字串本體）。
+    給 baseline 時多一欄 baseline 的 bytes 與壓縮倍數，最後一列為合計。
+    """
+    def usage(d):
+        return d.memory_usage(index=False, deep=True)
+    rep = pd.DataFrame({"欄位": df.columns, "dtype": df.dtypes.astype(str).values,
+                        "bytes": usage(df).values})
+    if baseline is not None:
+        rep["baseline_bytes"] = usage(baseline).reindex(df.columns).values
+    rep = rep.sort_values("bytes", ascending=False, ignore_index=True)
+    total = {"欄位": "合計", "dtype": "", "bytes": rep["bytes"].sum()}
+    if baseline is not None:
+        total["baseline_bytes"] = rep["baseline_bytes"].sum()
+    rep = pd.concat([rep, pd.DataFrame([total])], ignore_index=True)
+    rep["佔比(%)"] = (rep["bytes"] / total["bytes"] * 100).round(2)
+    if baseline is not None:
+        rep["壓縮倍數"] = (rep["baseline_bytes"] / rep["bytes"].replace(0, np.nan)).round(2)
+    return rep
+
 # ===== 篩選參數 =====
-@dataclass
+@dataclass(frozen=True)
 class Filters:
-    productid: list[str] | None = None
-    category2: list[str] | None = None
-    category3: list[str] | None = None
-    reason_l1: list[str] | None = None
+    """
+    篩選條件（不可變、可 hash）：建立時即正規化
+      清單 → 去重排序後的 tuple（空清單視為 None），日期 → 'YYYY-MM-DD'（有時間才保留時分秒）
+    同樣的條件不論輸入順序或日期寫法，都得到相等的 Filters，可直接當快取鍵。
+    """
+    productid: tuple[str, ...] | None = None
+    category2: tuple[str, ...] | None = None
+    category3: tuple[str, ...] | None = None
+    reason_l1: tuple[str, ...] | None = None
     order_from: str | None = None   # 'YYYY-MM-DD'
     order_to:   str | None = None
     return_from: str | None = None
     return_to:   str | None = None
 
-def apply_filters(df: pd.DataFrame, f: Filters) -> pd.DataFrame:
-    d = df.copy()
-    if f.productid: d = d[d["productid"].isin(f.productid)]
-    if f.category2: d = d[d["category2"].isin(f.category2)]
-    if f.category3: d = d[d["category3"].isin(f.category3)]
-    if f.reason_l1: d = d[d["reason_cat"].isin(f.reason_l1)]
-    if f.order_from:  d = d[d["orderdate"]  >= pd.to_datetime(f.order_from)]
-    if f.order_to:    d = d[d["orderdate"]  <  pd.to_datetime(f.order_to)]
-    if f.return_from: d = d[(~d["returndate"].isna()) & (d["returndate"] >= pd.to_datetime(f.return_from))]
-    if f.return_to:   d = d[(~d["returndate"].isna()) & (d["returndate"] <  pd.to_datetime(f.return_to))]
-    return d
+    def __post_init__(self):
+        for name in ("productid", "category2", "category3", "reason_l1"):
+            v = getattr(self, name)
+            if isinstance(v, str):
+                v = [v]
+            object.__setattr__(self, name, tuple(sorted({str(x) for x in v})) if v else None)
+        for name in ("order_from", "order_to", "return_from", "return_to"):
+            v = getattr(self, name)
+            if v is None or (isinstance(v, str) and not v.strip()):
+                object.__setattr__(self, name, None)
+                continue
+            ts = pd.Timestamp(v)
+            object.__setattr__(self, name, ts.strftime("%Y-%m-%d") if ts == ts.normalize()
+                                           else ts.strftime("%Y-%m-%d %H:%M:%S"))
+
+# Filters 欄位 → base 欄位
+FILTER_DIMS  = {"productid": "productid", "category2": "category2",
+                "category3": "category3", "reason_l1": "reason_cat"}
+FILTER_DATES = {"order": "orderdate", "return": "returndate"}
+_NAT = np.iinfo(np.int64).min
+
+class FilterIndex:
+    """
+    base 明細的篩選索引（每個資料版本建一次）：
+      - 維度欄：依類別代碼排序的列號 + 每個代碼的起訖位置（倒排表）
+      - 日期欄：依日期排序的列號，區間條件用 searchsorted 切片（NaT 不在索引內）
+    select() 先取候選列最少的條件展開列號，其餘條件只在這些列上檢查；
+    成本跟結果大小成正比，不掃整張表也不複製 base。
+    """
+    def __init__(self, df: pd.DataFrame):
+        self.n = len(df)
+        itype = np.int32 if self.n < 2**31 else np.int64
+        self.dims = {}
+        for col in FILTER_DIMS.values():
+            c = df[col]
+            cat = c.array if isinstance(c.dtype, pd.CategoricalDtype) else pd.Categorical(c)
+            codes = np.asarray(cat.codes)
+            order = np.argsort(codes, kind="stable").astype(itype)
+            counts = np.bincount(codes[codes >= 0], minlength=len(cat.categories))
+            starts = np.concatenate([[0], np.cumsum(counts)]) + int((codes < 0).sum())   # -1（NaN）排在最前面
+            lookup = pd.Index(cat.categories)
+            self.dims[col] = (codes, order, starts, lookup)
+        self.dates = {}
+        for col in FILTER_DATES.values():
+            vals = df[col].to_numpy("datetime64[ns]").view("i8")
+            rows = np.flatnonzero(vals != _NAT)
+            rows = rows[np.argsort(vals[rows], kind="stable")].astype(itype)
+            self.dates[col] = (vals, rows, vals[rows])
+
+    def _codes(self, col, values):
+        lookup = self.dims[col][3]
+        pos = lookup.get_indexer(pd.Index(values).unique())
+        return pos[pos >= 0]
+
+    def select(self, f: Filters) -> np.ndarray | None:
+        """符合條件的列號（遞增）；沒有任何條件 → None（= 全部）"""
+        conds = []      # (候選列數, 展開列號的函式, 在給定列上檢查的函式)
+        for attr, col in FILTER_DIMS.items():
+            values = getattr(f, attr)
+            if not values:
+                continue
+            codes, order, starts, _ = self.dims[col]
+            want = self._codes(col, values)
+            size = int((starts[want + 1] - starts[want]).sum())
+            conds.append((size,
+                          lambda order=order, starts=starts, want=want:
+                              np.concatenate([order[starts[k]:starts[k + 1]] for k in want])
+                              if len(want) else np.empty(0, dtype=order.dtype),
+                          lambda rows, codes=codes, want=want: np.isin(codes[rows], want)))
+        for prefix, col in FILTER_DATES.items():
+            lo, hi = getattr(f, f"{prefix}_from"), getattr(f, f"{prefix}_to")
+            if not (lo or hi):
+                continue
+            vals, rows_sorted, sorted_vals = self.dates[col]
+            lo_v = pd.Timestamp(lo).value if lo else None
+            hi_v = pd.Timestamp(hi).value if hi else None
+            a = np.searchsorted(sorted_vals, lo_v, "left") if lo else 0
+            b = np.searchsorted(sorted_vals, hi_v, "left") if hi else len(sorted_vals)
+            b = max(a, b)
+            def check(rows, vals=vals, lo_v=lo_v, hi_v=hi_v):
+                v = vals[rows]
+                m = v != _NAT
+                if lo_v is not None: m &= v >= lo_v
+                if hi_v is not None: m &= v < hi_v
+                return m
+            conds.append((b - a, lambda rows_sorted=rows_sorted, a=a, b=b: rows_sorted[a:b], check))
+        if not conds:
+            return None
+        conds.sort(key=lambda c: c[0])
+        rows = np.sort(conds[0][1]())
+        for _, _, check in conds[1:]:
+            if not len(rows):
+                break
+            rows = rows[check(rows)]
+        return rows
+
+    def count(self, f: Filters) -> int:
+        """符合條件的列數（不取子集）"""
+        rows = self.select(f)
+        return self.n if rows is None else len(rows)
+
+_FRAME_INDEXES = {}    # (id(df), 類別) → (weakref(df), 索引)
+
+def _frame_index(df: pd.DataFrame, cls):
+    """取得（必要時建立）df 的 cls 索引；df 被回收時索引一起釋放"""
+    key = (id(df), cls.__name__)
+    hit = _FRAME_INDEXES.get(key)
+    if hit is not None and hit[0]() is df:
+        return hit[1]
+    idx = cls(df)
+    _FRAME_INDEXES[key] = (weakref.ref(df, lambda _: _FRAME_INDEXES.pop(key, None)), idx)
+    return idx
+
+def filter_index(df: pd.DataFrame) -> FilterIndex:
+    return _frame_index(df, FilterIndex)
+
+def apply_filters(df: pd.DataFrame, f: Filters, index: FilterIndex | None = None) -> pd.DataFrame:
+    """
+    依 Filters 取子集：透過 FilterIndex 算出列號再 take，只複製結果列。
+    沒有任何條件時直接回傳 df 本身（呼叫端不可原地修改）。
+    """
+    rows = (index or filter_index(df)).select(f)
+    return df if rows is None else df.take(rows)
+
+# ===== 面板結果快取 =====
+def _nbytes(obj) -> int:
+    """估算快取值大小：DataFrame 用 memory_usage，tuple 逐項加總，其餘用 pickle 長度"""
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(index=True, deep=True).sum())
+    if isinstance(obj, tuple):
+        return sum(_nbytes(x) for x in obj)
+    try:
+        return len(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return sys.getsizeof(obj)
+
+class PanelCache:
+    """
+    (資料版本, Filters, 面板) → 面板輸出 的 LRU，以估算位元組數為上限淘汰。
+    資料版本一變（BaseCache 換上新 frame）整個快取清空；hits / misses 見 info()。
+    快取值會被多個請求共用，呼叫端不可原地修改。
+    """
+    def __init__(self, max_bytes: int = 256 * 2**20):
+        self.max_bytes = max_bytes
+        self.version = None
+        self.lock = threading.Lock()
+        self._d = OrderedDict()          # key → (value, nbytes)
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def clear(self, version=None):
+        with self.lock:
+            self._d.clear()
+            self.bytes = 0
+            self.version = version
 
-# ===== 統計函式（每一個統計 = 一個純函式） =====
+    def get_or_compute(self, version, filters: Filters, panel, compute):
+        """命中直接回傳；否則呼叫 compute() 算出後放入（計算不持鎖，同鍵併發時可能重算一次）"""
+        key = (filters, panel)
+        with self.lock:
+            if version != self.version:
+                self._d.clear()
+                self.bytes = 0
+                self.version = version
+            hit = self._d.get(key)
+            if hit is not None:
+                self.hits += 1
+                self._d.move_to_end(key)
+                return hit[0]
+            self.misses += 1
+        value = compute()
+        size = _nbytes(value)
+        with self.lock:
+            if version != self.version or size > self.max_bytes:
+                return value                 # 算的期間資料已換版，或單一結果就超過上限：不放
+            old = self._d.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._d[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, n) = self._d.popitem(last=False)
+                self.bytes -= n
+                self.evictions += 1
+        return value
+
+    def info(self) -> dict:
+        looked = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / looked, 4) if looked else 0.0,
+                "evictions": self.evictions, "entries": len(self._d),
+                "bytes": self.bytes, "max_bytes": self.max_bytes, "version": self.version}
+
+class PanelScheduler:
+    """
+    面板並行排程：run({名稱: (fn, 依賴名稱 tuple)}) 把沒有依賴的面板先丟進 thread pool，
+    依賴的面板完成後才送出 fn(*依賴的結果)；回傳 (結果 dict, 各面板耗時秒數 dict)。
+    pandas / NumPy 的運算大多會釋放 GIL，各面板可以重疊執行；pool 在多個請求間共用，run() 可併發呼叫。
+    任一面板失敗：等已送出的面板結束後，把第一個例外原樣拋出（與逐一計算時相同）。
+    timeout（秒）：整批超過就取消還沒開始的面板並拋 TimeoutError（已在跑的 thread 無法中斷，跑完結果丟棄）。
+    """
+    def __init__(self, max_workers: int | None = None):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="panel")
+        self.lock = threading.Lock()
+        self.stats = {}                  # 名稱 → [次數, 總秒數, 最大秒數]
+        self.last = {}                   # 最近一次 run 的 {"wall": 秒, "panels": {名稱: 秒}}
+
+    @staticmethod
+    def _timed(fn, args):
+        t0 = time.perf_counter()
+        out = fn(*args)
+        return out, time.perf_counter() - t0
+
+    def run(self, tasks: dict, timeout: float | None = None) -> tuple[dict, dict]:
+        for name, (_, deps) in tasks.items():
+            missing = [d for d in deps if d not in tasks]
+            if missing:
+                raise KeyError(f"面板 {name} 依賴未定義的面板：{missing}")
+        t0 = time.perf_counter()
+        deadline = None if timeout is None else t0 + timeout
+        results, timings, running = {}, {}, {}
+        pending = dict(tasks)
+        error = None
+        while pending or running:
+            if error is None:
+                for name, (fn, deps) in list(pending.items()):
+                    if all(d in results for d in deps):
+                        running[self.pool.submit(self._timed, fn, [results[d] for d in deps])] = name
+                        del pending[name]
+            if not running:
+                if error is None and pending:
+                    raise ValueError(f"面板依賴有循環：{sorted(map(str, pending))}")
+                break
+            left = None if deadline is None else max(deadline - time.perf_counter(), 0)
+            done, _ = wait(running, timeout=left, return_when=FIRST_COMPLETED)
+            if not done:
+                for fut in running:
+                    fut.cancel()
+                names = sorted(map(str, list(running.values()) + list(pending)))
+                raise TimeoutError(f"面板超過 {timeout}s 未完成：{names}")
+            for fut in done:
+                name = running.pop(fut)
+                try:
+                    results[name], timings[name] = fut.result()
+                except Exception as e:
+                    error = error or e
+        if error is not None:
+            raise error
+        wall = time.perf_counter() - t0
+        with self.lock:
+            for name, sec in timings.items():
+                st = self.stats.setdefault(name, [0, 0.0, 0.0])
+                st[0] += 1
+                st[1] += sec
+                st[2] = max(st[2], sec)
+            self.last = {"wall": wall, "panels": timings}
+        return results, timings
+
+    def info(self) -> pd.DataFrame:
+        """各面板累計：次數、平均 / 最大耗時（秒），依平均耗時遞減"""
+        with self.lock:
+            rows = [(str(k), n, tot / n, mx) for k, (n, tot, mx) in self.stats.items()]
+        return (pd.DataFrame(rows, columns=["面板", "次數", "平均(秒)", "最大(秒)"])
+                .sort_values("平均(秒)", ascending=False, ignore_index=True).round(4))
+
+# ===== 彙總 cube：一次 groupby，只做加總的面板共用 =====
+# 鍵：商品 × 原因 × 訂單日 × 退貨日 × 是否有退貨。
+# 時滯與 L2 標籤不進 cube（會讓 cube 接近逐列）：時滯面板用 LagSketchIndex（答不了時用篩選後明細），
+# L2 標籤面板用 TagMatrix 直接吃篩選後明細的組合代碼，KPI 也用明細（只有加總與一個中位數）。
+CUBE_KEYS = ["barcode", "reason_cat", "orderdate", "returndate", "returned"]
+CUBE_SUMS = ["sell_qty", "return_qty", "sales_amount", "loss_amount"]
+# 商品屬性（由 barcode 決定），彙總後再對回
+PRODUCT_ATTRS = ["productid", "product_name", "supplier", "sellprice",
+                 "category1", "category2", "category3", "color", "size"]
+
+def build_cube(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    篩選後明細 → 彙總 cube（每次請求建一次）。
+    orderdate / returndate 截到「日」，rows = 該格的明細列數；
+    其餘欄名與明細相同，所以只做加總的統計函式（summary / top5 / L1 佔比 / 熱點 / 四象限 / 趨勢 / L1 損失）
+    可以直接吃 cube。需要 lag_days / tags_l2 的面板（kpi_cards、lag_stats、l2_stats、L2 損失、tag_heatmap）請傳明細。
+    """
+    keys = {"barcode": df["barcode"], "reason_cat": df["reason_cat"],
+            "orderdate": df["orderdate"].dt.floor("D"), "returndate": df["returndate"].dt.floor("D"),
+            "returned": df["return_qty"] > 0}
+    g = df[CUBE_SUMS].groupby(list(keys.values()), observed=True, dropna=False, sort=False)
+    cube = g.sum()
+    cube.insert(0, "rows", g.size().astype("int64"))
+    cube.index.names = CUBE_KEYS
+    cube = cube.reset_index()
+    cube["order_ym"] = cube["orderdate"].dt.to_period("M")
+    cube["event_ym"] = cube["returndate"].dt.to_period("M")
+    attrs = df.loc[~df["barcode"].duplicated(), ["barcode"] + PRODUCT_ATTRS]
+    return cube.merge(attrs, on="barcode", how="left")
+
+def _weights(df: pd.DataFrame):
+    """cube 的列數權重；明細則為 None（每列權重 1）"""
+    return df["rows"].to_numpy() if "rows" in df.columns else None
+
+def _pct_label(q: float) -> str:
+    return f"{q * 100:g}%"          # 與 describe() 的欄名一致：0.5 → "50%"、0.99 → "99%"
+
+def _weighted_describe(v: np.ndarray, w: np.ndarray, percentiles=(0.5,)) -> dict:
+    """加權（次數）版的 count / mean / 分位數 / std / min / max，與 Series.describe() 對齊（線性內插）"""
+    order = np.argsort(v, kind="stable")
+    v, w = v[order].astype("float64"), w[order]
+    cum = np.cumsum(w)
+    n = int(cum[-1])
+    def nth(k):                               # 展開後第 k 個值（0 起算）
+        return v[np.searchsorted(cum, k, side="right")]
+    def quantile(q):
+        h = (n - 1) * q
+        lo = int(np.floor(h))
+        return nth(lo) + (h - lo) * (nth(min(lo + 1, n - 1)) - nth(lo))
+    mean = float((v * w).sum() / n)
+    std = float(np.sqrt((w * (v - mean) ** 2).sum() / (n - 1))) if n > 1 else np.nan
+    out = {"count": float(n), "mean": mean, "std": std, "min": float(v[0]), "max": float(v[-1])}
+    out.update({_pct_label(q): float(quantile(q)) for q in percentiles})
+    return out
+
+# ===== 統計函式（每一個統計 = 一個純函式；明細或 build_cube 的結果都可以傳） =====
 def kpi_cards(df: pd.DataFrame) -> dict:
     """計算總銷售、退貨率、損失金額、退貨時滯"""
     sales_qty   = float(df["sell_qty"].sum())
     return_qty  = float(df["return_qty"].sum())
     return_rate = (return_qty / sales_qty * 100) if sales_qty else 0.0
     loss_amount = float(df["loss_amount"].sum())
-    median_lag  = float(df["lag_days"].median()) if df["lag_days"].notna().any() else 0.0
+    w = _weights(df)
+    if w is None:
+        median_lag = float(df["lag_days"].median()) if df["lag_days"].notna().any() else 0.0
+    else:
+        has = df["lag_days"].notna().to_numpy()
+        median_lag = _weighted_describe(df["lag_days"].to_numpy()[has], w[has])["50%"] if has.any() else 0.0
     return {"sales_qty": int(sales_qty), "return_qty": int(return_qty),
             "return_rate_pct": round(return_rate, 2),
             "loss_amount": round(loss_amount, 0),
@@ -113,26 +687,30 @@ def kpi_cards(df: pd.DataFrame) -> dict:
 def event_return_rate(df: pd.DataFrame, freq: str = "D"):
     """
     事件退貨率趨勢（依 returndate 聚合）
-    freq: "D"=日、"M"=月
+    freq: "D"=日、"W"=週（週一起算）、"M"=月
     退貨率 = 當期退貨件數 / 當期銷售件數 * 100
     注意：事件法的分母用同日(週/月)銷售，解讀是「該時段的退貨壓力」
     """
-    if freq not in {"D", "M"}:
-        raise ValueError("freq must be 'D'|'M'")
+    if freq not in TREND_LABELS:
+        raise ValueError("freq must be 'D'|'W'|'M'")
+    sales = df.groupby(trend_key(df["orderdate"], df["order_ym"], freq))["sell_qty"].sum()
+    rets  = df.groupby(trend_key(df["returndate"], df["event_ym"], freq))["return_qty"].sum()
+    return trend_figure(sales, rets, freq)
 
-    # 依粒度建立 period 欄
+def trend_key(dates: pd.Series, ym: pd.Series, freq: str) -> pd.Series:
+    """日期欄（與對應的年月欄）→ 趨勢的期別鍵；明細路徑與 partitions.event_return_rate 共用"""
     if freq == "D":
-        sale_idx  = df["orderdate"].dt.date
-        retur_idx = df["returndate"].dt.date
-        x_label   = "日期"
-    else:  # "M"
-        sale_idx  = df["orderdate"].dt.to_period("M").astype(str)
-        retur_idx = df["returndate"].dt.to_period("M").astype(str)
-        x_label   = "月份"
+        return dates.dt.date
+    if freq == "W":     # 週一為起始日
+        return dates.dt.to_period("W").dt.start_time.dt.date
+    return ym.astype(str)
 
-    sales = df.groupby(sale_idx)["sell_qty"].sum().rename("銷售件數")
-    rets  = df.groupby(retur_idx)["return_qty"].sum().rename("退貨件數")
+TREND_LABELS = {"D": "日期", "W": "週", "M": "月份"}
 
+def trend_figure(sales: pd.Series, rets: pd.Series, freq: str):
+    """(各期銷售件數, 各期退貨件數) → (趨勢表, 折線圖)；明細路徑與 TrendIndex 共用"""
+    x_label = TREND_LABELS[freq]
+    sales, rets = sales.rename("銷售件數"), rets.rename("退貨件數")
     trend = pd.concat([sales, rets], axis=1).fillna(0).reset_index()
     trend = trend.rename(columns={"index": x_label})
     trend["退貨率(%)"] = trend["退貨件數"] / trend["銷售件數"].replace(0, np.nan) * 100
@@ -148,11 +726,112 @@ def event_return_rate(df: pd.DataFrame, freq: str = "D"):
     return trend, fig
 
 
+class TrendIndex:
+    """
+    事件退貨率的日曆索引（每個資料版本建一次）：
+      鍵 = (category2, category3, reason_cat) 的實際組合；每個鍵一列、每天一欄，
+      存訂單日的 sell_qty / 列數、退貨日的 return_qty / 列數（int64 稠密陣列）。
+    查詢只看維度條件：選出符合的鍵 → 加總成一條日序列 → 前綴和 → 日 / 週 / 月直接相減，
+    成本 O(鍵數 × 天數)，與訂單量無關。
+    有商品或日期條件（會改變「哪些訂單列被計入」）時回傳 None，由呼叫端走明細路徑。
+    """
+    DIMS = {"category2": "category2", "category3": "category3", "reason_l1": "reason_cat"}
+
+    def __init__(self, df: pd.DataFrame):
+        dims = list(self.DIMS.values())
+        g = df.groupby(dims, observed=True, dropna=False, sort=False)
+        key = g.ngroup().to_numpy()
+        self.keys = df[dims].take(np.unique(key, return_index=True)[1]).reset_index(drop=True)
+        nk = len(self.keys)
+        od = df["orderdate"].to_numpy("datetime64[D]").view("i8")
+        rd = df["returndate"].to_numpy("datetime64[D]").view("i8")
+        nat = np.iinfo(np.int64).min
+        o_ok, r_ok = od != nat, rd != nat
+        both = np.concatenate([od[o_ok], rd[r_ok]])
+        self.day0 = int(both.min()) if len(both) else 0
+        self.ndays = int(both.max()) - self.day0 + 1 if len(both) else 0
+        def grid(mask, day, w=None):
+            flat = key[mask] * self.ndays + (day[mask] - self.day0)
+            out = np.bincount(flat, weights=None if w is None else w[mask], minlength=nk * self.ndays)
+            return out.reshape(nk, self.ndays).astype(np.int64)
+        sell = df["sell_qty"].to_numpy(dtype="float64")
+        ret = df["return_qty"].to_numpy(dtype="float64")
+        self.sell, self.sell_rows = grid(o_ok, od, sell), grid(o_ok, od)
+        self.ret, self.ret_rows = grid(r_ok, rd, ret), grid(r_ok, rd)
+        self.no_return_rows = np.bincount(key[~r_ok], minlength=nk)    # 月粒度的 "NaT" 列
+        self.no_order_rows = np.bincount(key[~o_ok], minlength=nk)
+
+    def select(self, f: Filters) -> np.ndarray | None:
+        """符合維度條件的鍵（bool）；有本索引無法回答的條件 → None"""
+        if f.productid or f.order_from or f.order_to or f.return_from or f.return_to:
+            return None
+        m = np.ones(len(self.keys), dtype=bool)
+        for attr, col in self.DIMS.items():
+            values = getattr(f, attr)
+            if values:
+                m &= self.keys[col].isin(values).to_numpy()
+        return m
+
+    def _buckets(self, freq: str):
+        """各期的 (起始日序號, 標籤)"""
+        days = np.arange(self.day0, self.day0 + self.ndays)
+        if freq == "D":
+            starts = np.arange(self.ndays)
+        elif freq == "W":
+            monday = days - (days + 3) % 7        # 1970-01-01 是週四
+            starts = np.flatnonzero(np.r_[True, monday[1:] != monday[:-1]])
+        else:
+            months = days.astype("datetime64[D]").astype("datetime64[M]")
+            starts = np.flatnonzero(np.r_[True, months[1:] != months[:-1]])
+        first = days[starts].astype("datetime64[D]")
+        if freq == "M":
+            labels = [str(d)[:7] for d in first.astype("datetime64[M]")]
+        elif freq == "W":
+            labels = [(pd.Timestamp(d) - pd.Timedelta(days=pd.Timestamp(d).weekday())).date() for d in first]
+        else:
+            labels = [pd.Timestamp(d).date() for d in first]
+        return starts, labels
+
+    def series(self, f: Filters, freq: str = "D"):
+        """(各期銷售件數, 各期退貨件數)；無法以索引回答 → None"""
+        m = self.select(f)
+        if m is None:
+            return None
+        sums = {}
+        for name, arr in (("sell", self.sell), ("sell_rows", self.sell_rows),
+                          ("ret", self.ret), ("ret_rows", self.ret_rows)):
+            daily = arr[m].sum(axis=0)
+            sums[name] = np.r_[0, np.cumsum(daily)]        # 前綴和
+        starts, labels = self._buckets(freq)
+        ends = np.r_[starts[1:], self.ndays]
+        def per_bucket(name):
+            return sums[name][ends] - sums[name][starts]
+        labels = pd.Index(labels, dtype=object)
+        s_rows, r_rows = per_bucket("sell_rows") > 0, per_bucket("ret_rows") > 0
+        sales = pd.Series(per_bucket("sell")[s_rows], index=labels[s_rows])
+        rets = pd.Series(per_bucket("ret")[r_rows], index=labels[r_rows])
+        if freq == "M":      # 與明細路徑一致：沒有日期的列歸在 "NaT"
+            if self.no_order_rows[m].sum():
+                sales = pd.concat([sales, pd.Series([0], index=["NaT"])]).sort_index()
+            if self.no_return_rows[m].sum():
+                rets = pd.concat([rets, pd.Series([0], index=["NaT"])]).sort_index()
+        return sales, rets
+
+    def event_return_rate(self, f: Filters, freq: str = "D"):
+        """同 event_return_rate(apply_filters(df, f), freq)；無法以索引回答 → None"""
+        if freq not in TREND_LABELS:
+            raise ValueError("freq must be 'D'|'W'|'M'")
+        s = self.series(f, freq)
+        return None if s is None else trend_figure(*s, freq)
+
+def trend_index(df: pd.DataFrame) -> TrendIndex:
+    return _frame_index(df, TrendIndex)
+
 def reason_l1_share(df: pd.DataFrame) -> tuple[pd.DataFrame, "plotly.graph_objs.Figure"]:
     """
         退貨原因（L1）佔比
     """
-    cat = df.groupby("reason_cat")["return_qty"].sum().sort_values(ascending=False).reset_index()
+    cat = df.groupby("reason_cat", observed=True)["return_qty"].sum().sort_values(ascending=False).reset_index()
     cat["佔比(%)"] = (cat["return_qty"] / cat["return_qty"].sum() * 100).round(2) if len(cat) else 0
     fig = px.bar(cat, x="reason_cat", y="佔比(%)", text="佔比(%)")
     fig.update_traces(texttemplate="%{text:.2f}%", textposition="outside", cliponaxis=False)
@@ -168,7 +847,7 @@ def reason_l1_share(df: pd.DataFrame) -> tuple[pd.DataFrame, "plotly.graph_objs.
 
 def heatmap(df: pd.DataFrame, level: str = "category3") -> tuple[pd.DataFrame, "plotly.graph_objs.Figure"]:
     '''熱點圖（類別 × 原因）'''
-    pt = df.pivot_table(index=level, columns="reason_cat", values="return_qty", aggfunc="sum", fill_value=0)
+    pt = df.pivot_table(index=level, columns="reason_cat", values="return_qty", aggfunc="sum", fill_value=0, observed=True)
     level_map = {
         "category1": "大類",
         "category2": "中類",
@@ -183,7 +862,7 @@ def heatmap(df: pd.DataFrame, level: str = "category3") -> tuple[pd.DataFrame, "
 
 def scatter_quadrant(df: pd.DataFrame) -> tuple[pd.DataFrame, "plotly.graph_objs.Figure", float, float]:
     '''銷售額 vs 退貨率 四象限圖'''
-    prod = (df.groupby(["barcode","product_name"]).agg(
+    prod = (df.groupby(["barcode","product_name"], observed=True).agg(
         sales_qty=("sell_qty","sum"),
         return_qty=("return_qty","sum"),
         sales_amount=("sales_amount","sum"),
@@ -208,6 +887,59 @@ def scatter_quadrant(df: pd.DataFrame) -> tuple[pd.DataFrame, "plotly.graph_objs
     return prod, fig, med_sales, med_rr
 
 
+# ===== 排名：多鍵排序取前 N =====
+def _sort_key(s: pd.Series, ascending: bool) -> tuple[np.ndarray, np.ndarray]:
+    """(值, 是否 NaN)：值越小越前面；NaN 一律排最後（同 sort_values 的 na_position="last"）"""
+    v = pd.to_numeric(s).to_numpy(dtype="float64", na_value=np.nan)
+    nan = np.isnan(v)
+    v = np.where(nan, np.inf, v if ascending else -v)
+    return v, nan
+
+def top_n_positions(df: pd.DataFrame, by: list[str], ascending: list[bool], n: int,
+                    group: pd.Series | None = None) -> np.ndarray:
+    """
+    依 by / ascending（多鍵、穩定排序、NaN 在後，與 sort_values 相同）取前 n 列的位置。
+    group 給定時為各組前 n（組依類別 / 值排序）。
+    不分組：先用 np.partition 以第一鍵篩出候選（含同值），只對候選做 lexsort；
+    分組：整體一次 lexsort（組代碼為最高優先鍵），再取每組前 n。
+    """
+    keys = [_sort_key(df[c], a) for c, a in zip(by, ascending)]
+    pos = np.arange(len(df))
+    if group is None and len(df) > 4 * n:
+        first = keys[0][0]
+        kth = np.partition(first, n - 1)[n - 1]
+        pos = np.flatnonzero(first <= kth)
+    lex = []
+    for v, nan in reversed(keys):            # lexsort：最後一個鍵優先
+        lex += [v[pos], nan[pos]]
+    if group is not None:
+        cat = group.array if isinstance(group.dtype, pd.CategoricalDtype) else pd.Categorical(group)
+        gcodes = np.asarray(cat.codes)[pos]
+        lex.append(gcodes)
+    order = pos[np.lexsort(lex)] if len(pos) else pos
+    if group is None:
+        return order[:n]
+    g = np.asarray(cat.codes)[order]
+    keep = g >= 0
+    order, g = order[keep], g[keep]
+    starts = np.r_[0, np.flatnonzero(np.diff(g)) + 1]
+    rank = np.arange(len(g)) - np.repeat(starts, np.diff(np.r_[starts, len(g)]))
+    return order[rank < n]
+
+# 四象限的排序規則（第一鍵, 第二鍵）
+QUADRANT_SORT = {
+    "右上：高銷售×高退貨": (["return_rate(%)", "sales_amount"], [False, False]),
+    "右下：高銷售×低退貨": (["sales_amount", "return_rate(%)"], [False, True]),
+    "左上：低銷售×高退貨": (["return_rate(%)", "sales_amount"], [False, False]),
+    "左下：低銷售×低退貨": (["sales_amount", "return_rate(%)"], [False, True]),
+}
+
+def quadrant_labels(prod_df: pd.DataFrame, med_sales: float, med_rr: float) -> np.ndarray:
+    """各商品所屬象限（NaN 退貨率視為低退貨）"""
+    hs = (prod_df["sales_amount"] >= med_sales).to_numpy()
+    hr = (prod_df["return_rate(%)"] >= med_rr).to_numpy()
+    return np.select([hs & hr, hs & ~hr, ~hs & hr], QUADRANT_ORDER[:3], default=QUADRANT_ORDER[3])
+
 def quadrant_matrix(prod_df: pd.DataFrame, med_sales: float, med_rr: float,
                     notes_map: dict | None = None) -> pd.DataFrame:
     """
@@ -216,31 +948,18 @@ def quadrant_matrix(prod_df: pd.DataFrame, med_sales: float, med_rr: float,
     """
     notes = notes_map or QUADRANT_NOTES
 
-    def quad(r):
-        hs, hr = r["sales_amount"] >= med_sales, r["return_rate(%)"] >= med_rr
-        if hs and hr:  return "右上：高銷售×高退貨"
-        if hs and not hr: return "右下：高銷售×低退貨"
-        if (not hs) and hr: return "左上：低銷售×高退貨"
-        return "左下：低銷售×低退貨"
-
-    df = prod_df.copy()
-    df["quadrant"] = df.apply(quad, axis=1)
-
-    def pick_top5(sub: pd.DataFrame, q: str):
-        if q == "右上：高銷售×高退貨":
-            sub = sub.sort_values(["return_rate(%)", "sales_amount"], ascending=[False, False])
-        elif q == "右下：高銷售×低退貨":
-            sub = sub.sort_values(["sales_amount", "return_rate(%)"], ascending=[False, True])
-        elif q == "左上：低銷售×高退貨":
-            sub = sub.sort_values(["return_rate(%)", "sales_amount"], ascending=[False, False])
-        else:
-            sub = sub.sort_values(["sales_amount", "return_rate(%)"], ascending=[False, True])
-        items = sub.head(5).apply(lambda r: f"{r['barcode']}｜{r['product_name']}", axis=1).tolist()
+    quadrant = quadrant_labels(prod_df, med_sales, med_rr)
+
+    def pick_top5(q: str):
+        sub = prod_df[quadrant == q]
+        by, asc = QUADRANT_SORT[q]
+        top = sub.take(top_n_positions(sub, by, asc, 5))
+        items = (top["barcode"].astype(str) + "｜" + top["product_name"].astype(str)).tolist()
         return items + [""] * (5 - len(items))
 
     rows = []
     for q in QUADRANT_ORDER:
-        t1, t2, t3, t4, t5 = pick_top5(df[df["quadrant"] == q], q)
+        t1, t2, t3, t4, t5 = pick_top5(q)
         rows.append({
             "四象限 Top5": q,
             "備註": notes.get(q, ""),
@@ -256,13 +975,13 @@ def top5_per_reason(df: pd.DataFrame, n: int = 5, denom: str = "total") -> pd.Da
     denom="reason": 分母=該商品在該原因所對應的列之 sell_qty（通常偏小，不建議）
     """
     # 1) 分母：商品總銷售（不看是否有退貨）
-    sales_all = (df.groupby(["barcode","product_name"])
+    sales_all = (df.groupby(["barcode","product_name"], observed=True)
                    .agg(sales_qty=("sell_qty","sum"))
                    .reset_index())
 
     # 2) 分子：按原因的退貨量（只取有退貨且有原因的列）
     ret_reason = (df[(df["return_qty"] > 0) & (df["reason_cat"].notna())]
-                    .groupby(["reason_cat","barcode","product_name"])
+                    .groupby(["reason_cat","barcode","product_name"], observed=True)
                     .agg(return_qty=("return_qty","sum"))
                     .reset_index())
 
@@ -271,7 +990,7 @@ def top5_per_reason(df: pd.DataFrame, n: int = 5, denom: str = "total") -> pd.Da
     # 可選：若你硬要用「只計入該原因列的銷售量」當分母
     if denom == "reason":
         sales_reason = (df[(df["return_qty"] > 0) & (df["reason_cat"].notna())]
-                          .groupby(["reason_cat","barcode","product_name"])
+                          .groupby(["reason_cat","barcode","product_name"], observed=True)
                           .agg(sales_qty_reason=("sell_qty","sum"))
                           .reset_index())
         out_base = out_base.merge(sales_reason, on=["reason_cat","barcode","product_name"], how="left")
@@ -283,66 +1002,211 @@ def top5_per_reason(df: pd.DataFrame, n: int = 5, denom: str = "total") -> pd.Da
     out_base["return_rate(%)"] = (out_base["return_qty"] /
                                   out_base["denom_sales"].replace(0, np.nan) * 100).round(2)
 
-    # 4) 各原因取 TopN
-    blocks = []
-    for rc, sub in out_base.groupby("reason_cat"):
-        s = (sub.sort_values(["return_rate(%)","return_qty","denom_sales"],
-                             ascending=[False, False, False])
-                .head(n)
+    # 4) 各原因取 TopN（依原因分組，退貨率 → 退貨件數 → 銷售件數 由大到小）
+    if out_base.empty:
+        return pd.DataFrame()
+    pos = top_n_positions(out_base, ["return_rate(%)","return_qty","denom_sales"], [False, False, False],
+                          n, group=out_base["reason_cat"])
+    return (out_base.take(pos)
                 .loc[:, ["reason_cat","barcode","product_name","denom_sales","return_qty","return_rate(%)"]]
                 .rename(columns={"reason_cat": "原因",
                                 "barcode": "商品條碼",
                                 "product_name": "商品名稱",
                                 "denom_sales": "銷售件數",
                                 "return_qty": "退貨件數",
-                                "return_rate(%)": "退貨率(%)"}))
-        blocks.append(s)
-    return pd.concat(blocks, ignore_index=True) if blocks else pd.DataFrame()
+                                "return_rate(%)": "退貨率(%)"})
+                .reset_index(drop=True))
+
+LAG_PERCENTILES = (0.5, 0.9, 0.99)
+LAG_COLS = {"count": "筆數", "mean": "平均(天)", "50%": "中位數(天)", "std": "標準差(天)",
+            "min": "最小(天)", "max": "最大(天)", "90%": "P90(天)", "99%": "P99(天)"}
 
 def lag_stats(df: pd.DataFrame) -> pd.DataFrame:
     """
-        退貨時滯統計（天）— 以原因(L1)分組，輸出中文欄位
-        欄位：原因、筆數、平均(天)、中位數(天)、標準差(天)、最小(天)、最大(天)
+        退貨時滯統計（天）— 以原因(L1)分組，輸出中文欄位（精確值，會排序所有時滯）
+        欄位：原因、筆數、平均(天)、中位數(天)、標準差(天)、最小(天)、最大(天)、P90(天)、P99(天)
+        LagSketchIndex.lag_stats() 以合併分位數草圖回答同一張表（近似分位數）
     """
-    g = df.dropna(subset=["lag_days"]).groupby("reason_cat")["lag_days"].describe()
-    ret = (g.loc[:, ["count","mean","50%","std","min","max"]]
+    d = df.dropna(subset=["lag_days"])
+    if _weights(d) is None:
+        g = d.groupby("reason_cat", observed=True)["lag_days"].describe(percentiles=list(LAG_PERCENTILES))
+    else:
+        g = pd.DataFrame({rc: _weighted_describe(sub["lag_days"].to_numpy(), sub["rows"].to_numpy(),
+                                                 LAG_PERCENTILES)
+                          for rc, sub in d.groupby("reason_cat", observed=True)}).T
+        if g.empty:
+            g = pd.DataFrame(columns=list(LAG_COLS), dtype="float64")
+    g.index.name = "reason_cat"          # 空結果時 describe() 不會保留分組欄名
+    return _lag_table(g)
+
+def _lag_table(g: pd.DataFrame) -> pd.DataFrame:
+    """index=reason_cat、欄位為 describe() 欄名的統計 → 中文輸出表"""
+    ret = (g.loc[:, list(LAG_COLS)].astype("float64")
          .reset_index()  # 先把 reason_cat 拉回欄位
-         .rename(columns={
-             "reason_cat": "原因",
-             "count": "筆數",
-             "mean": "平均(天)",
-             "50%": "中位數(天)",
-             "std": "標準差(天)",
-             "min": "最小(天)",
-             "max": "最大(天)"
-         })
-         .sort_values("中位數(天)"))
-    for col in ["平均(天)", "標準差(天)", "中位數(天)"]:
+         .rename(columns={"reason_cat": "原因", **LAG_COLS})
+         .sort_values("中位數(天)", kind="stable"))
+    for col in ["平均(天)", "標準差(天)", "中位數(天)", "P90(天)", "P99(天)"]:
         ret[col] = ret[col].round(2)
     return ret
 
+class LagSketchIndex:
+    """
+    退貨時滯的可合併分位數草圖（每個資料版本建一次）：
+      格 = (reason_cat, category2, category3, 退貨月份)；每格一條對數分桶計數（DDSketch 作法），
+      另存精確的筆數 / 總和 / 平方和 / 最小 / 最大，所以筆數、平均、標準差、最小、最大都是精確值。
+    查詢 = 選出符合條件的格 → 計數逐桶相加（合併）→ 依累積次數找分位數所在的桶。
+    只存實際用到的桶（np.unique 壓成連續的欄），0 與負時滯各自成桶，不會撐大矩陣。
+    誤差界：桶 k 涵蓋 (γ^(k-1), γ^k]，γ = (1+α)/(1-α)，桶的代表值 2γ^k/(γ+1) 與桶內任一值 x 相差 ≤ α·|x|
+      （α 預設 1%）。時滯是整數天，代表值先四捨五入回整數天：|x| ≤ 1/(2α)（α=1% 時 50 天）的端點即為精確值，
+      更大的時滯誤差 ≤ α·|x| + 0.5 天。分位數落在兩值之間時與精確版一樣對兩個端點線性內插。
+    有商品、訂單日期或非整月的退貨日期條件時回傳 None，由呼叫端走精確路徑。
+    """
+    DIMS = {"reason_l1": "reason_cat", "category2": "category2", "category3": "category3"}
+
+    def __init__(self, df: pd.DataFrame, alpha: float = 0.01):
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        d = df.loc[df["lag_days"].notna(), list(self.DIMS.values()) + ["returndate", "lag_days"]]
+        month = d["returndate"].to_numpy("datetime64[M]")
+        keys = [d[c] for c in self.DIMS.values()] + [pd.Series(month, index=d.index)]
+        cell = d.groupby(keys, observed=True, dropna=False, sort=False).ngroup().to_numpy()
+        first = np.unique(cell, return_index=True)[1]
+        self.cells = d[list(self.DIMS.values())].iloc[first].reset_index(drop=True)
+        self.cells["month"] = month[first]
+        v = d["lag_days"].to_numpy("float64")
+        nc = len(self.cells)
+        # 桶號（負值、0、正值各自一段）只保留實際出現的，欄 j 對應桶號 self.keys[j]（遞增 = 時滯遞增）
+        self.keys, col = np.unique(self._key(v), return_inverse=True)
+        nb = max(len(self.keys), 1)
+        counts = np.bincount(cell * nb + col, minlength=nc * nb)
+        self.counts = counts.reshape(nc, nb).astype(np.int32)
+        self.n = np.bincount(cell, minlength=nc)
+        self.sum = np.bincount(cell, weights=v, minlength=nc)
+        self.sumsq = np.bincount(cell, weights=v * v, minlength=nc)
+        self.min = np.full(nc, np.inf)
+        np.minimum.at(self.min, cell, v)
+        self.max = np.full(nc, -np.inf)
+        np.maximum.at(self.max, cell, v)
+
+    # 正值 x → ceil(log_γ x) + OFFSET；0 → 0；負值對稱放到負半軸（OFFSET 讓 0 < |x| < 1 也不會跨到另一側）
+    OFFSET = 1 << 20
+
+    def _key(self, v: np.ndarray) -> np.ndarray:
+        k = np.zeros(len(v), dtype=np.int64)
+        nz = v != 0
+        mag = np.ceil(np.log(np.abs(v[nz])) / np.log(self.gamma)).astype(np.int64) + self.OFFSET
+        k[nz] = np.sign(v[nz]).astype(np.int64) * mag
+        return k
+
+    def _value(self, k: np.ndarray) -> np.ndarray:
+        """桶號 → 代表值"""
+        mag = np.abs(k) - self.OFFSET
+        val = 2 * self.gamma ** mag.astype("float64") / (self.gamma + 1)
+        return np.where(k == 0, 0.0, np.sign(k) * val)
+
+    def select(self, f: Filters) -> np.ndarray | None:
+        """符合條件的格（bool）；有本索引無法回答的條件 → None"""
+        if f.productid or f.order_from or f.order_to:
+            return None
+        m = np.ones(len(self.cells), dtype=bool)
+        for attr, col in self.DIMS.items():
+            values = getattr(f, attr)
+            if values:
+                m &= self.cells[col].isin(values).to_numpy()
+        for bound, keep in ((f.return_from, np.greater_equal), (f.return_to, np.less)):
+            if bound:
+                ts = pd.Timestamp(bound)
+                if ts != ts.to_period("M").start_time:
+                    return None          # 非整月邊界：一格內只有部分列符合
+                m &= keep(self.cells["month"].to_numpy(), np.datetime64(ts, "M"))
+        return m
+
+    def describe(self, cells: np.ndarray, percentiles=LAG_PERCENTILES) -> dict:
+        """合併指定格的草圖 → describe() 格式（分位數為近似值，其餘精確）"""
+        n = int(self.n[cells].sum())
+        s, ss = self.sum[cells].sum(), self.sumsq[cells].sum()
+        mean = s / n
+        std = float(np.sqrt(max(ss - s * mean, 0.0) / (n - 1))) if n > 1 else np.nan
+        cum = np.cumsum(self.counts[cells].sum(axis=0, dtype=np.int64))
+        lo, hi = float(self.min[cells].min()), float(self.max[cells].max())
+        out = {"count": float(n), "mean": float(mean), "std": std, "min": lo, "max": hi}
+        def nth(k):                           # 第 k 小（0 起算）所在桶的代表值，四捨五入回整數天
+            b = int(np.searchsorted(cum, k, side="right"))
+            return float(np.clip(np.round(self._value(self.keys[b:b + 1])[0]), lo, hi))
+        for q in percentiles:                 # 與精確版相同的線性內插
+            h = (n - 1) * q
+            k = int(np.floor(h))
+            out[_pct_label(q)] = nth(k) + (h - k) * (nth(min(k + 1, n - 1)) - nth(k))
+        return out
+
+    def lag_stats(self, f: Filters) -> pd.DataFrame | None:
+        """同 lag_stats(apply_filters(df, f))，分位數為草圖近似；無法以索引回答 → None"""
+        m = self.select(f)
+        if m is None:
+            return None
+        rc = self.cells["reason_cat"]
+        present = set(rc[m].dropna())
+        order = rc.cat.categories if isinstance(rc.dtype, pd.CategoricalDtype) else sorted(present)
+        # 與精確版的 groupby 相同順序（類別順序），同中位數時排序結果一致
+        g = pd.DataFrame({r: self.describe(np.flatnonzero(m & (rc == r).to_numpy()))
+                          for r in order if r in present}).T
+        if g.empty:
+            g = pd.DataFrame(columns=list(LAG_COLS), dtype="float64")
+        g.index.name = "reason_cat"
+        return _lag_table(g)
+
+def lag_sketch_index(df: pd.DataFrame) -> LagSketchIndex:
+    return _frame_index(df, LagSketchIndex)
+
 def loss_by_reason(df: pd.DataFrame, level="l1") -> pd.DataFrame:
     '''退貨金額按原因分類彙總'''
     if level=="l1":
-        d = (df.groupby("reason_cat", as_index=False)["loss_amount"].sum() 
+        d = (df.groupby("reason_cat", as_index=False, observed=True)["loss_amount"].sum() 
         .sort_values("loss_amount", ascending=False)
         .rename(columns={"reason_cat": "原因分類", "loss_amount": "退貨金額"}))
         d["佔比(%)"] = (d["退貨金額"]/d["退貨金額"].sum()*100).round(2)
         return d
-    # L2：展開 tags
-    rows=[]
-    for _, r in df[["loss_amount","tags_l2"]].iterrows():
-        for t in (r["tags_l2"] or []):
-            rows.append((t, r["loss_amount"]))
-    l2 = pd.DataFrame(rows, columns=["退貨原因","退貨金額"])
-    if l2.empty:
+    # L2：multi-hot 標籤矩陣 × 金額
+    d = l2_stats(df)[["退貨原因","退貨金額"]].sort_values("退貨原因")
+    if d.empty:
         return pd.DataFrame(columns=["退貨原因","退貨金額","佔比(%)"])
+    d = d.sort_values("退貨金額", ascending=False)
+    d["佔比(%)"] = (d["退貨金額"] / max(d["退貨金額"].sum(), 1) * 100).round(2)
+    return d
 
-    d = (l2.groupby("退貨原因", as_index=False)["退貨金額"].sum()
-            .sort_values("退貨金額", ascending=False))
+def l2_stats(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    L2 標籤統計：退貨件數、退貨金額、佔比（以金額計；一筆多標籤時各標籤都計入）
+    欄位：退貨原因、退貨件數、退貨金額、佔比(%)
+    """
+    tm, codes = tag_matrix(df)
+    w = _weights(df)
+    n = tm.sum_by_tag(codes, w if w is not None else np.ones(len(df)))
+    d = pd.DataFrame({"退貨原因": tm.tags,
+                      "退貨件數": tm.sum_by_tag(codes, df["return_qty"]).to_numpy(),
+                      "退貨金額": tm.sum_by_tag(codes, df["loss_amount"]).to_numpy()})[n.to_numpy() > 0]
+    d = d.sort_values("退貨金額", ascending=False, ignore_index=True)
     d["佔比(%)"] = (d["退貨金額"] / max(d["退貨金額"].sum(), 1) * 100).round(2)
     return d
 
+def tag_heatmap(df: pd.DataFrame, level: str = "category3", value: str = "return_qty",
+                top: int | None = 30) -> tuple[pd.DataFrame, "plotly.graph_objs.Figure"]:
+    """
+    熱點圖（類別 / 商品 × L2 標籤）：level = category2 / category3 / barcode
+    top：只畫加總最大的前 N 個 level 值（barcode 很多時用）
+    """
+    tm, codes = tag_matrix(df)
+    pt = tm.crosstab(codes, df[level], df[value])
+    pt = pt.loc[:, pt.sum(axis=0) > 0]
+    if top and len(pt) > top:
+        pt = pt.loc[pt.sum(axis=1).nlargest(top).index]
+    level_name = {"category1": "大類", "category2": "中類", "category3": "小類", "barcode": "商品條碼"}.get(level, level)
+    value_name = {"return_qty": "退貨件數", "loss_amount": "退貨金額"}.get(value, value)
+    fig = px.imshow(pt, aspect="auto", color_continuous_scale="Oranges",
+                    title=f"{level_name} × L2 標籤 熱點（{value_name}）")
+    fig.update_layout(xaxis_title="L2 標籤", yaxis_title=level_name)
+    return pt, fig
+
 def summary_table(df: pd.DataFrame) -> pd.DataFrame:
     """
     商品退貨統計表
@@ -354,7 +1218,7 @@ def summary_table(df: pd.DataFrame) -> pd.DataFrame:
             "銷售數量","退貨數量","退貨金額","退貨率%"
         ])
 
-    d = (df.groupby(["barcode","productid","product_name","color","size"], as_index=False)
+    d = (df.groupby(["barcode","productid","product_name","color","size"], as_index=False, observed=True)
            .agg(銷售數量=("sell_qty","sum"),
                 退貨數量=("return_qty","sum"),
                 退貨金額=("loss_amount","sum")))
@@ -389,3 +1253,20 @@ def summary_table(df: pd.DataFrame) -> pd.DataFrame:
 
     return d[["barcode","商品編號","商品名稱","顏色","size",
               "銷售數量","退貨數量","退貨金額","退貨率%"]]
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="base 明細記憶體報告")
+    ap.add_argument("--compare", action="store_true", help="另載一份未壓縮的 base 對照")
+    args = ap.parse_args(argv)
+    db = (os.getenv("DB_HOST"), os.getenv("DB_USER"), os.getenv("DB_PASSWORD"), os.getenv("DB_NAME"),
+          int(os.getenv("DB_PORT", "3306")))
+    base = load_base_df(*db)
+    raw = load_base_df(*db, compact=False) if args.compare else None
+    rep = memory_report(base, raw)
+    with pd.option_context("display.width", 200, "display.max_rows", None):
+        print(f"base：{len(base):,} 列")
+        print(rep.to_string(index=False))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,13 +3,15 @@
 import gradio as gr
 import pandas as pd
 import numpy as np, json
-import os
+import os, time, threading
 from dotenv import load_dotenv
 from openai import AzureOpenAI
-from analytic import (load_base_df, Filters, apply_filters,
+from analytic import (BaseCache, PanelCache, PanelScheduler, Filters, apply_filters, build_cube,
                        kpi_cards,event_return_rate , reason_l1_share,
                        heatmap, scatter_quadrant, quadrant_matrix,
-                       top5_per_reason, lag_stats, loss_by_reason,summary_table)
+                       top5_per_reason, lag_stats, loss_by_reason,summary_table, tag_heatmap,
+                       filter_index, trend_index, lag_sketch_index)
+import partitions as P
 '''
     退貨分析儀表板、AI 建議
 '''
@@ -29,52 +31,198 @@ db = {
     "password": os.getenv("DB_PASSWORD"),
     "database": os.getenv("DB_NAME")
 }
-base = load_base_df(db["host"], db["user"], db["password"], db["database"], db["port"])
+# USE_PARTITIONS=1：整份 base 放不進記憶體時，改讀 partitions.py 建好的月分區（BASE_PARTITION_DIR），
+# 面板都由各分區的部分彙總合併後算；此時不建 BaseCache
+USE_PARTITIONS = os.getenv("USE_PARTITIONS", "0") not in ("", "0")
+if USE_PARTITIONS:
+    cache = None
+    _parts = {"ds": P.PartitionedBase()}
+    _parts_lock = threading.Lock()
+else:
+    # 背景每 BASE_POLL_SECONDS 秒檢查資料版本，有新訂單/退貨就在背景重建後換上
+    cache = BaseCache(db, poll_seconds=float(os.getenv("BASE_POLL_SECONDS", "60"))).start()
+    cache.get()         # 啟動時先載好；之後一律經 cache.current() 取當前版本，不留舊 frame 的參照
+# 面板結果快取：(資料版本, Filters, 面板) → 輸出；資料換版自動清空
+panels = PanelCache(max_bytes=int(os.getenv("PANEL_CACHE_MB", "256")) * 2**20)
+# 時滯統計：sketch = 合併分位數草圖（50 天內的分位數與精確值相同，更長的時滯誤差 ≤ 1% + 0.5 天）；
+#           exact = 逐列排序的精確值（比對用）
+LAG_MODE = os.getenv("LAG_MODE", "sketch")
+# 儀表板各面板以 thread pool 並行計算（各請求共用）
+scheduler = PanelScheduler(max_workers=int(os.getenv("PANEL_WORKERS", "8")))
+# 一次更新圖表的面板計算上限（秒）；0 = 不限
+PANEL_TIMEOUT = float(os.getenv("PANEL_TIMEOUT_SECONDS", "0")) or None
 
-# 給 UI 的選單值
-opts_productid = sorted(base["productid"].dropna().unique().tolist())
-opts_c2 = sorted(base["category2"].dropna().unique().tolist())
-opts_c3 = sorted(base["category3"].dropna().unique().tolist())
-opts_reason = sorted(base["reason_cat"].fillna("其他").unique().tolist())
+# 給 UI 的選單值：依資料版本重算（BaseCache 換版後新商品 / 類別才會出現在篩選選單）
+_opts = {"version": None, "opts": None}
+
+def current_parts():
+    """分區模式目前的 PartitionedBase；partitions.py build 換版後換上新的"""
+    with _parts_lock:
+        _parts["ds"] = _parts["ds"].refreshed()
+        return _parts["ds"]
+
+def filter_options():
+    """(商品編號, 中類, 小類, 退貨原因) 的選單值；同一資料版本只算一次"""
+    if USE_PARTITIONS:
+        ds = current_parts()
+        version = ds.version
+    else:
+        version, df, _ = cache.current()
+    if _opts["version"] != version:
+        if USE_PARTITIONS:      # 商品 / 類別 × 原因的部分彙總就有這些值，不必讀明細
+            aggs = ds.aggregate(Filters(), ["product", "category"])
+            prod, cats = aggs["product"], aggs["category"]
+        else:
+            prod = cats = df
+        _opts["opts"] = (sorted(prod["productid"].dropna().unique().tolist()),
+                         sorted(cats["category2"].dropna().unique().tolist()),
+                         sorted(cats["category3"].dropna().unique().tolist()),
+                         sorted(set(cats["reason_cat"].dropna().unique().tolist()) | {"其他"}))   # 沒退貨的列視為「其他」
+        _opts["version"] = version
+    return _opts["opts"]
+
+def refresh_options():
+    """頁面載入 / 每次更新圖表後，把選單換成目前資料版本的值（已選的值保留）"""
+    return tuple(gr.update(choices=o) for o in filter_options())
+
+opts_productid, opts_c2, opts_c3, opts_reason = filter_options()
+
+def panel_getter(f, ds=None):
+    """
+    回傳 panel(name, fn, fast=None, source="cube")：先查面板快取，沒命中才篩選 + 建 cube（同一請求只建一次）再算。
+    fast(base_df) 可直接由整份 base 的索引回答（回傳 None 表示答不了），就不必篩選 / 建 cube。
+    source="detail"：fn 吃篩選後明細（需要 lag_days / tags_l2 的面板，cube 裡沒有這兩欄）；
+    source=None：fn() 不吃資料（由其他面板的結果算）。
+    panel 可在多個 thread 同時呼叫：明細與 cube 以鎖保護，先到的建、其餘等它建好
+    ds（分區模式的 PartitionedBase）給定時沒有整份 base：面板一律 source=None，由 ds 的部分彙總算
+    """
+    if ds is not None:
+        version, base_df, loaded_at = ds.version, None, ds.loaded_at
+    else:
+        version, base_df, loaded_at = cache.current()
+    state = {}
+    lock = threading.RLock()
+    def rows():
+        with lock:
+            if "rows" not in state:
+                state["rows"] = apply_filters(base_df, f)
+        return state["rows"]
+    def cube():
+        with lock:
+            if "cube" not in state:
+                # 篩選後先彙總成 cube，只做加總的面板都從 cube 算（不再各自 groupby 明細）
+                state["cube"] = build_cube(rows())
+        return state["cube"]
+    def compute(fn, fast, source):
+        out = fast(base_df) if fast is not None else None
+        if out is not None:
+            return out
+        if source is None:
+            return fn()
+        return fn(rows() if source == "detail" else cube())
+    def panel(name, fn, fast=None, source="cube"):
+        return panels.get_or_compute(version, f, name, lambda: compute(fn, fast, source))
+    return panel, version, loaded_at
+
+def partition_tasks(f, freq, panel, ds):
+    """分區模式的面板（名稱同 dashboard_tasks）：都由 ds 的部分彙總算，同一篩選條件各分區只讀一次"""
+    def p(name, fn, *args, **kw):
+        return lambda: panel(name, lambda: fn(ds, f, *args, **kw), source=None)
+    return {
+        "kpi":      (p("kpi", P.kpi_cards), ()),
+        "summary":  (p("summary", P.summary_table), ()),
+        "trend":    (p(("trend", freq), P.event_return_rate, freq), ()),
+        "reason_l1": (p("reason_l1", P.reason_l1_share), ()),
+        "h2":       (p(("heatmap", "category2"), P.heatmap, "category2"), ()),
+        "h3":       (p(("heatmap", "category3"), P.heatmap, "category3"), ()),
+        "scatter":  (p("scatter", P.scatter_quadrant), ()),
+        "matrix":   (lambda sc: panel("matrix", lambda: quadrant_matrix(sc[0], sc[2], sc[3]), source=None),
+                     ("scatter",)),
+        "top5":     (p("top5", P.top5_per_reason, n=5), ()),
+        # 原因 × 時滯次數表算出的就是精確值
+        "lag":      (p(("lag", "exact"), P.lag_stats), ()),
+        "loss_l1":  (p(("loss", "l1"), P.loss_by_reason, "l1"), ()),
+        "loss_l2":  (p(("loss", "l2"), P.loss_by_reason, "l2"), ()),
+        "t2":       (p(("tag_heatmap", "category2"), P.tag_heatmap, level="category2"), ()),
+        "t3":       (p(("tag_heatmap", "category3"), P.tag_heatmap, level="category3"), ()),
+        "tb":       (p(("tag_heatmap", "barcode"), P.tag_heatmap, level="barcode", top=30), ()),
+    }
+
+def dashboard_tasks(f, freq, panel, ds=None):
+    """面板 → (計算函式, 依賴的面板)；彼此獨立的面板並行，matrix 等 scatter 算完才跑"""
+    if ds is not None:
+        return partition_tasks(f, freq, panel, ds)
+    return {
+        "kpi":      (lambda: panel("kpi", kpi_cards, source="detail"), ()),
+        "summary":  (lambda: panel("summary", summary_table), ()),
+        # 趨勢：只有維度條件時直接由日曆前綴和索引算，不必篩選明細
+        "trend":    (lambda: panel(("trend", freq), lambda d: event_return_rate(d, freq=freq),
+                                   fast=lambda b: trend_index(b).event_return_rate(f, freq)), ()),
+        # L1 佔比、熱點
+        "reason_l1": (lambda: panel("reason_l1", reason_l1_share), ()),
+        "h2":       (lambda: panel(("heatmap", "category2"), lambda d: heatmap(d, level="category2")), ()),
+        "h3":       (lambda: panel(("heatmap", "category3"), lambda d: heatmap(d, level="category3")), ()),
+        # 四象限 + 矩陣
+        "scatter":  (lambda: panel("scatter", scatter_quadrant), ()),
+        "matrix":   (lambda sc: panel("matrix", lambda: quadrant_matrix(sc[0], sc[2], sc[3]), source=None),
+                     ("scatter",)),
+        # 各原因 Top5
+        "top5":     (lambda: panel("top5", lambda d: top5_per_reason(d, n=5)), ()),
+        # 時滯與損失
+        "lag":      (lambda: panel(("lag", LAG_MODE), lag_stats, source="detail",
+                                   fast=(lambda b: lag_sketch_index(b).lag_stats(f)) if LAG_MODE == "sketch" else None), ()),
+        "loss_l1":  (lambda: panel(("loss", "l1"), lambda d: loss_by_reason(d, "l1")), ()),
+        "loss_l2":  (lambda: panel(("loss", "l2"), lambda d: loss_by_reason(d, "l2"), source="detail"), ()),
+        # L2 標籤熱點（類別 / 商品 × 標籤）：標籤矩陣直接吃明細的組合代碼
+        "t2":       (lambda: panel(("tag_heatmap", "category2"), lambda d: tag_heatmap(d, level="category2"),
+                                   source="detail"), ()),
+        "t3":       (lambda: panel(("tag_heatmap", "category3"), lambda d: tag_heatmap(d, level="category3"),
+                                   source="detail"), ()),
+        "tb":       (lambda: panel(("tag_heatmap", "barcode"), lambda d: tag_heatmap(d, level="barcode", top=30),
+                                   source="detail"), ()),
+    }
 
 def run_dashboard(productid, c2, c3, reason, order_from, order_to, return_from, return_to,granularity):
     f = Filters(productid=productid or None, category2=c2 or None, category3=c3 or None,
                 reason_l1=reason or None, order_from=order_from or None, order_to=order_to or None,
                 return_from=return_from or None, return_to=return_to or None)
-    df = apply_filters(base, f)
-    
+    ds = current_parts() if USE_PARTITIONS else None
+    panel, version, loaded_at = panel_getter(f, ds)
+    freq = {"日":"D", "週":"W", "月":"M"}.get(granularity, "D")
+
+    tasks = dashboard_tasks(f, freq, panel, ds)
+    t0 = time.perf_counter()
+    out, timings = scheduler.run(tasks, timeout=PANEL_TIMEOUT)
+    wall = time.perf_counter() - t0
+    slowest = max(timings, key=timings.get)
+
     # KPI
-    kpi = kpi_cards(df)
+    kpi = out["kpi"]
+    pc = panels.info()
     kpi_md = (f"**銷售件數**：{kpi['sales_qty']:,}｜"
               f"**退貨件數**：{kpi['return_qty']:,}｜"
               f"**退貨率**：{kpi['return_rate_pct']:.2f}%｜"
               f"**退貨金額**：{kpi['loss_amount']:,}｜"
-              f"**退貨時滯(中位)**：{kpi['median_lag_days']:.0f} 天")
-    # summary
-    summary_df = summary_table(df)
-    # 趨勢
-    freq_map = {"日":"D",  "月":"M"}
-    trend_df, trend_fig = event_return_rate(df, freq=freq_map.get(granularity, "D"))
-    # L1 佔比
-    cat_df, cat_fig = reason_l1_share(df)
-    # 熱點
-    h2_df, h2_fig = heatmap(df, level="category2")
-    h3_df, h3_fig = heatmap(df, level="category3")
-    # 四象限 + 矩陣
-    prod_df, sc_fig, med_sales, med_rr = scatter_quadrant(df)
-    
-    matrix_df = quadrant_matrix(prod_df, med_sales, med_rr)
-
-    # 各原因 Top5
-    top5_df = top5_per_reason(df, n=5)
-    # 時滯與損失
-    lag_df = lag_stats(df)
-    loss_l1_df = loss_by_reason(df, "l1")
-    loss_l2_df = loss_by_reason(df, "l2")
-
-    
+              f"**退貨時滯(中位)**：{kpi['median_lag_days']:.0f} 天\n\n"
+              f"資料版本 {version}（{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(loaded_at))} 載入，"
+              f"{time.time() - loaded_at:.0f} 秒前）｜面板快取命中率 {pc['hit_rate']:.0%}｜"
+              f"計算 {wall:.2f}s（最慢：{slowest} {timings[slowest]:.2f}s）")
+    summary_df = out["summary"]
+    trend_df, trend_fig = out["trend"]
+    cat_df, cat_fig = out["reason_l1"]
+    h2_df, h2_fig = out["h2"]
+    h3_df, h3_fig = out["h3"]
+    prod_df, sc_fig, med_sales, med_rr = out["scatter"]
+    matrix_df = out["matrix"]
+    top5_df = out["top5"]
+    lag_df = out["lag"]
+    loss_l1_df, loss_l2_df = out["loss_l1"], out["loss_l2"]
+    t2_df, t2_fig = out["t2"]
+    t3_df, t3_fig = out["t3"]
+    tb_df, tb_fig = out["tb"]
+
     return (kpi_md, summary_df, trend_fig, cat_fig, h2_fig, h3_fig, sc_fig,
-            matrix_df, top5_df, lag_df, loss_l1_df, loss_l2_df)
+            matrix_df, top5_df, lag_df, loss_l1_df, loss_l2_df, t2_fig, t3_fig, tb_fig)
 
 
 # === AI 分析函式 ===
@@ -82,18 +230,25 @@ def run_ai_reco(productid, c2, c3, reason, order_from, order_to, return_from, re
     f = Filters(productid=productid or None, category2=c2 or None, category3=c3 or None,
                 reason_l1=reason or None, order_from=order_from or None, order_to=order_to or None,
                 return_from=return_from or None, return_to=return_to or None)
-    df = apply_filters(base, f)
+    ds = current_parts() if USE_PARTITIONS else None
+    panel, _, _ = panel_getter(f, ds)
 
-    if df.empty:
+    # 筆數直接由篩選索引算（不取子集、不建 cube）；分區模式由部分彙總的列數權重加總
+    if ds is not None:
+        n = panel("rows", lambda: P.row_count(ds, f), source=None)
+    else:
+        n = panel("rows", None, fast=lambda b: filter_index(b).count(f))
+    if n == 0:
         return "⚠️ 沒有符合條件的資料，無法生成建議。", pd.DataFrame()
 
-    # 簡單整理上下文
-    kpi = kpi_cards(df)
+    # 簡單整理上下文（與儀表板共用面板與面板快取）
+    tasks = dashboard_tasks(f, "D", panel, ds)
+    kpi = tasks["kpi"][0]()
     lag = kpi["median_lag_days"]
-    reason_df, _ = reason_l1_share(df)
+    reason_df, _ = tasks["reason_l1"][0]()
     top_reason = reason_df.iloc[0]["reason_cat"] if not reason_df.empty else "其他"
     top_reason_pct = reason_df.iloc[0]["佔比(%)"] if not reason_df.empty else 0
-    prod_df, _, _, _ = scatter_quadrant(df)
+    prod_df, _, _, _ = tasks["scatter"][0]()
     worst_item = ""
     if not prod_df.empty:
         worst = prod_df.sort_values("return_rate(%)", ascending=False).iloc[0]
@@ -136,7 +291,7 @@ with gr.Blocks(title="退貨分析儀表板") as demo:
         order_to    = gr.Textbox(label="訂單訖日 YYYY-MM-DD", placeholder="2025-09-01")
         return_from = gr.Textbox(label="退貨起日 YYYY-MM-DD", placeholder="2025-01-01")
         return_to   = gr.Textbox(label="退貨訖日 YYYY-MM-DD", placeholder="2025-09-01")
-        granularity = gr.Radio(choices=["日","月"], value="日", label="粒度（事件日期）")  # ← 這行很關鍵
+        granularity = gr.Radio(choices=["日","週","月"], value="日", label="粒度（事件日期）")  # ← 這行很關鍵
     btn = gr.Button("更新圖表", variant="primary")
 
     gr.Markdown("**商品退貨摘要**")
@@ -161,12 +316,18 @@ with gr.Blocks(title="退貨分析儀表板") as demo:
         loss_l1   = gr.Dataframe(interactive=False, wrap=False, label="退貨金額 vs 退貨原因（L1）")
         loss_l2   = gr.Dataframe(interactive=False, wrap=False, label="退貨金額 vs 退貨原因（L2 細標籤）")
 
+    gr.Markdown("**L2 細標籤熱點**")
+    with gr.Row():
+        t2_fig = gr.Plot()
+        t3_fig = gr.Plot()
+    tb_fig = gr.Plot()
+
     btn.click(
         fn=run_dashboard,
         inputs=[productid,c2,c3,reason,order_from,order_to,return_from,return_to,granularity],
         outputs=[kpi_md, summary_tbl, trend_fig, cat_fig, h2_fig, h3_fig, sc_fig,
-                matrix_df, top5_df, lag_df, loss_l1, loss_l2]
-    )
+                matrix_df, top5_df, lag_df, loss_l1, loss_l2, t2_fig, t3_fig, tb_fig]
+    ).then(fn=refresh_options, outputs=[productid, c2, c3, reason])
     gr.Markdown("---") 
     with gr.Row():
         goal_msg = gr.Textbox(
@@ -182,6 +343,8 @@ with gr.Blocks(title="退貨分析儀表板") as demo:
         inputs=[productid, c2, c3, reason, order_from, order_to, return_from, return_to, goal_msg],
         outputs=[ai_summary]
     )
+    # 每次開頁面都用目前資料版本的選單值（不必重啟服務）
+    demo.load(fn=refresh_options, outputs=[productid, c2, c3, reason])
 
 
 
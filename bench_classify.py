@@ -0,0 +1,55 @@
+import os, re, time, random, argparse
+from return_reason_cata import RULES, SYNONYMS, classify_many, clear_classify_cache, shutdown_pool
+
+'''
+    classify_many 多 process 擴展性測試
+    以 RULES 的關鍵字 + 同義詞 + 雜訊字組出合成退貨原因，比較不同 worker 數的耗時與加速比
+Usage:
+  python bench_classify.py [--rows 2000000] [--unique 0.3] [--workers 1 2 4 8 16 32]
+'''
+
+FILLER = ["，", "實穿", "收到後", "感覺", "有點", "明顯", "客人反映", "略", "整體", "不太", "。"]
+
+def make_corpus(rows, unique_ratio, seed=42):
+    """rows 筆原因，約 unique_ratio 比例為相異字串（其餘從已產生的字串重抽，模擬罐頭句）"""
+    rnd = random.Random(seed)
+    words = sorted({w for r in RULES for w in re.findall(r"[一-鿿]{2,}", r["pattern"])} | set(SYNONYMS))
+    n_uniq = max(1, int(rows * unique_ratio))
+    uniq = []
+    for i in range(n_uniq):
+        parts = [rnd.choice(words) if rnd.random() < 0.5 else rnd.choice(FILLER)
+                 for _ in range(rnd.randint(2, 8))]
+        uniq.append("".join(parts) + f"#{i}")
+    return [uniq[i] if i < n_uniq else rnd.choice(uniq) for i in range(rows)]
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="classify_many 多 process 加速比")
+    ap.add_argument("--rows", type=int, default=2_000_000)
+    ap.add_argument("--unique", type=float, default=0.3, help="相異字串比例")
+    ap.add_argument("--workers", type=int, nargs="+",
+                    default=sorted({1, 2, 4, 8, 16, 32, os.cpu_count() or 1}))
+    args = ap.parse_args(argv)
+
+    t0 = time.perf_counter()
+    corpus = make_corpus(args.rows, args.unique)
+    print(f"[bench] corpus rows={len(corpus):,} unique≈{args.unique:.0%} "
+          f"({time.perf_counter() - t0:.1f}s), cpu={os.cpu_count()}")
+    print(f"{'workers':>7} {'秒':>8} {'rows/s':>12} {'加速比':>7} {'效率':>6}")
+
+    base, ref = None, None
+    for w in args.workers:
+        clear_classify_cache()
+        if w > 1:
+            classify_many(corpus[:w * 1000], use_cache=False, workers=w)   # 先把 pool 叫起來，不算在內
+        t0 = time.perf_counter()
+        out = classify_many(corpus, use_cache=False, workers=w)
+        sec = time.perf_counter() - t0
+        if ref is None:
+            ref, base = out, sec
+        elif out != ref:
+            raise AssertionError(f"workers={w} 的結果與單 process 不一致")
+        print(f"{w:>7} {sec:>8.2f} {len(corpus) / sec:>12,.0f} {base / sec:>7.2f} {base / sec / w:>6.0%}")
+        shutdown_pool()
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,24 @@
 import pandas as pd
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.engine import URL
-import json, os
+import os, time, hashlib, argparse
 from dotenv import load_dotenv
-from return_reason_cata import classify_reason
+from return_reason_cata import RULES, classify_many, classify_cache_info, rules_fingerprint
+from schema import (TABLES, create_tables, ensure_columns, ensure_indexes, drop_obsolete_columns,
+                    bump_data_version, log_change, log_change_days)
 
 '''
     此程式會讀取 returns 表 → 套用原因分類 → 產生 returns_clean 表
+    串流管線（記憶體只跟 chunk 大小有關）：
+      read（依 return_id 分頁：WHERE return_id > 上一頁最後一筆 LIMIT chunksize）→ classify（classify_many 整批）→ serialize（同結果只轉一次代碼）
+      → write（executemany 多列 INSERT 到暫存表）→ 全部完成後 RENAME 換表
+    L2 標籤存成 return_tags(return_id, tag_id)（reason_tag 字典）；
+    命中明細加 --with-matches 才寫 return_matches（以 rule_id 參照 reason_rule）。
+    增量（預設）：每列記錄規則集指紋 rule_fp，只重分類「新的 / 內容變了 / 指紋過期」的 return_id 並 upsert；
+    過期比例超過 FULL_REBUILD_RATIO（例如剛改過 RULES）時自動改走整表重建。
+    --workers N：分類階段改用 N 個 process（大量回填 / 規則改版後整表重分類時用）。
+Usage:
+  python clear.py [--chunksize 50000] [--full] [--workers N] [--with-matches]
 '''
 # 載入環境變數
 load_dotenv()
@@ -18,32 +30,291 @@ DB_CONFIG = {
     "database": os.getenv("DB_NAME"),
 }
 
-# 建立 SQLAlchemy 連線
-url = URL.create(
-    "mysql+mysqlconnector",
-    username=DB_CONFIG["user"],
-    password=DB_CONFIG["password"],
-    host=DB_CONFIG["host"],
-    port=DB_CONFIG["port"],
-    database=DB_CONFIG["database"],
-    query={"charset":"utf8mb4"}
-)
-engine = create_engine(url)
-
-# 讀取 returns
-df = pd.read_sql("SELECT return_id, orderid, returndate, barcode, return_qty, reason FROM returns", engine)
-
-# 套用分類
-df["reason_category_l1"] = ""
-df["reason_tags"] = ""
-df["match_terms"] = ""
-
-for i, row in df.iterrows():
-    primary, tags_l2, matches = classify_reason(row["reason"])
-    df.at[i, "reason_category_l1"] = primary
-    df.at[i, "reason_tags"] = json.dumps(tags_l2, ensure_ascii=False)
-    df.at[i, "match_terms"] = json.dumps(matches, ensure_ascii=False)
-
-# 寫回新表
-df.to_sql("returns_clean", engine, if_exists="replace", index=False)
-print("✅ returns_clean 已更新：含 reason_category_l1 / reason_tags / match_terms")
+SRC_COLS = ["return_id", "orderid", "returndate", "barcode", "return_qty", "reason"]
+OUT_COLS = [c for c, _ in TABLES["returns_clean"]]
+TARGET   = "returns_clean"
+LINKS    = ["return_tags", "return_matches"]     # 依 return_id 掛在 returns_clean 下的明細表
+STAGING  = "_new"                                # 暫存表後綴
+FULL_REBUILD_RATIO = 0.5
+# 儲存格式版本：併入 rule_fp，格式改版後舊列會被視為過期而自動重建
+STORAGE_VERSION = "tags-v2"
+
+# 依主鍵分頁讀取（keyset）：mysql+mysqlconnector 不支援 server-side cursor，
+# read_sql(chunksize=...) 仍會先把整個結果集抓進 client，所以每頁各自查詢
+SELECT_ALL = f"SELECT {', '.join(SRC_COLS)} FROM returns WHERE return_id > :last ORDER BY return_id LIMIT :n"
+# 方言差異：NULL-safe 不等（SQLite 替身用於測試）
+NULLSAFE_NE = {
+    "mysql":  "NOT ({a} <=> {b})",
+    "sqlite": "{a} IS NOT {b}",
+}
+
+def stale_where(dialect="mysql"):
+    """需要（重新）分類的列：returns_clean 沒有、來源內容變了、或規則指紋不同"""
+    ne = NULLSAFE_NE[dialect]
+    return f"""
+    FROM returns r LEFT JOIN returns_clean c ON c.return_id = r.return_id
+    WHERE (c.return_id IS NULL OR {ne.format(a="c.rule_fp", b=":fp")} OR {ne.format(a="c.reason", b="r.reason")}
+       OR c.return_qty <> r.return_qty OR c.returndate <> r.returndate
+       OR c.orderid <> r.orderid OR c.barcode <> r.barcode)
+"""
+
+def select_stale(dialect="mysql"):
+    return (f"SELECT {', '.join('r.' + c for c in SRC_COLS)} {stale_where(dialect)}"
+            " AND r.return_id > :last ORDER BY r.return_id LIMIT :n")
+
+def get_engine():
+    # 建立 SQLAlchemy 連線
+    url = URL.create(
+        "mysql+mysqlconnector",
+        username=DB_CONFIG["user"],
+        password=DB_CONFIG["password"],
+        host=DB_CONFIG["host"],
+        port=DB_CONFIG["port"],
+        database=DB_CONFIG["database"],
+        query={"charset":"utf8mb4"}
+    )
+    return create_engine(url)
+
+def clean_fingerprint():
+    """returns_clean.rule_fp：規則集指紋 + 儲存格式版本"""
+    return hashlib.sha1(f"{rules_fingerprint()}:{STORAGE_VERSION}".encode()).hexdigest()[:16]
+
+def rule_key(rule):
+    return hashlib.sha1(f"{rule['category']}|{rule['tag']}|{rule['pattern']}".encode("utf-8")).hexdigest()[:16]
+
+def sync_dictionaries(cur, rules=RULES):
+    """
+    把 RULES 的標籤與規則寫進 reason_tag / reason_rule（已存在就略過，id 不變）。
+    回傳 ({tag: tag_id}, {(tag, pattern): rule_id})
+    """
+    cur.executemany("INSERT IGNORE INTO reason_tag (tag, category) VALUES (%s,%s)",
+                    list({r["tag"]: (r["tag"], r["category"]) for r in rules}.values()))
+    cur.executemany("INSERT IGNORE INTO reason_rule (rule_key, category, tag, pattern) VALUES (%s,%s,%s,%s)",
+                    [(rule_key(r), r["category"], r["tag"], r["pattern"]) for r in rules])
+    cur.execute("SELECT tag, tag_id FROM reason_tag")
+    tag_ids = dict(cur.fetchall())
+    cur.execute("SELECT rule_key, rule_id FROM reason_rule")
+    by_key = dict(cur.fetchall())
+    rule_ids = {(r["tag"], r["pattern"]): by_key[rule_key(r)] for r in rules}
+    return tag_ids, rule_ids
+
+def serialize_results(results, tag_ids, rule_ids):
+    """
+    classify_many 結果 → (L1, tag_id lists, 命中 (rule_id, start, end, text) lists)；
+    相同結果物件只轉一次代碼。
+    """
+    memo = {}
+    l1, tags, terms = [], [], []
+    for r in results:
+        s = memo.get(id(r))
+        if s is None:
+            primary, tags_l2, matches = r
+            s = memo[id(r)] = (primary,
+                               [tag_ids[t] for t in tags_l2],
+                               [(rule_ids[(m["tag"], m["pattern"])], m["start"], m["end"], m["text"][:512])
+                                for m in matches])
+        l1.append(s[0]); tags.append(s[1]); terms.append(s[2])
+    return l1, tags, terms
+
+def link_rows(ids, tags, terms, with_matches=False):
+    """展開成 return_tags / return_matches 的列"""
+    tag_rows = [(rid, tid, seq) for rid, tl in zip(ids, tags) for seq, tid in enumerate(tl)]
+    match_rows = ([(rid, rule_id, st, en, txt) for rid, ml in zip(ids, terms) for rule_id, st, en, txt in ml]
+                  if with_matches else [])
+    return tag_rows, match_rows
+
+def to_db_rows(df, cols):
+    """DataFrame → list[tuple]，轉成 mysql.connector 認得的 Python 型別（datetime → 字串、NaN → None）"""
+    out = []
+    for c in cols:
+        s = df[c]
+        if pd.api.types.is_datetime64_any_dtype(s):
+            s = s.dt.strftime("%Y-%m-%d %H:%M:%S")
+        s = s.astype(object)
+        out.append(s.where(s.notna(), None).tolist())
+    return list(zip(*out))
+
+def insert_sql(table, cols=OUT_COLS, upsert=False):
+    sql = f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({','.join(['%s'] * len(cols))})"
+    if upsert:
+        sql += " ON DUPLICATE KEY UPDATE " + ", ".join(f"{c}=VALUES({c})" for c in cols if c != "return_id")
+    return sql
+
+def count_stale(conn, fp):
+    """(需重分類筆數, returns 總筆數)"""
+    stale = conn.execute(text("SELECT COUNT(*) " + stale_where(conn.dialect.name)), {"fp": fp}).scalar()
+    total = conn.execute(text("SELECT COUNT(*) FROM returns")).scalar()
+    return int(stale), int(total)
+
+# 變更紀錄（schema.log_change_days）：受影響的訂單日。
+# 一頁重分類的列取「舊值與新值」兩邊對到的訂單（orderid / barcode 可能被更正）；刪除同步取孤兒列對到的訂單
+PAGE_DAYS = """
+    SELECT DISTINCT DATE(o.orderdate) AS d FROM orders o
+    JOIN (SELECT orderid, barcode FROM returns_clean WHERE return_id IN ({ids})
+          UNION SELECT orderid, barcode FROM returns WHERE return_id IN ({ids})) x
+      ON o.orderid = x.orderid AND o.barcode = x.barcode"""
+ORPHAN_DAYS = """
+    SELECT DISTINCT DATE(o.orderdate) AS d FROM returns_clean c
+    JOIN orders o ON o.orderid = c.orderid AND o.barcode = c.barcode
+    WHERE NOT EXISTS (SELECT 1 FROM returns r WHERE r.return_id = c.return_id)"""
+
+def log_page_days(cur, ids, tables):
+    for part in (ids[i:i + 1000] for i in range(0, len(ids), 1000)):
+        marks = ",".join(["%s"] * len(part))
+        log_change_days(cur, tables, PAGE_DAYS.format(ids=marks), part + part)
+
+def purge_deleted(cur):
+    """returns 已刪除的列，returns_clean 與明細表也刪掉"""
+    n = 0
+    for t in [TARGET] + LINKS:
+        cur.execute(f"""DELETE FROM {t}
+                        WHERE NOT EXISTS (SELECT 1 FROM returns r WHERE r.return_id = {t}.return_id)""")
+        n += cur.rowcount if t == TARGET else 0
+    return n
+
+def delete_links(cur, ids, tables=LINKS):
+    """增量 upsert 前先清掉這批 return_id 的舊明細"""
+    for part in (ids[i:i + 1000] for i in range(0, len(ids), 1000)):
+        for t in tables:
+            cur.execute(f"DELETE FROM {t} WHERE return_id IN ({','.join(['%s'] * len(part))})", part)
+
+def prepare_staging(cur):
+    """暫存表用 CREATE TABLE LIKE 複製正式表（含索引），寫完再換名"""
+    for t in [TARGET] + LINKS:
+        cur.execute(f"DROP TABLE IF EXISTS {t}{STAGING}")
+        cur.execute(f"CREATE TABLE {t}{STAGING} LIKE {t}")
+
+def swap_staging(cur):
+    """多表 RENAME 是原子操作：讀取端只會看到整組舊表或整組新表"""
+    tables = [TARGET] + LINKS
+    for t in tables:
+        cur.execute(f"DROP TABLE IF EXISTS {t}_old")
+    cur.execute("RENAME TABLE " + ", ".join(f"{t} TO {t}_old, {t}{STAGING} TO {t}" for t in tables))
+    for t in tables:
+        cur.execute(f"DROP TABLE {t}_old")
+
+def read_pages(engine, query, params, chunksize):
+    """依 return_id 分頁產出 DataFrame；每頁一次獨立查詢，client 端最多只持有一頁"""
+    last = 0
+    while True:
+        with engine.connect() as conn:
+            df = pd.read_sql(text(query), conn, params={**params, "last": last, "n": chunksize})
+        if df.empty:
+            return
+        yield df
+        if len(df) < chunksize:
+            return
+        last = int(df["return_id"].iloc[-1])
+
+def run(engine, chunksize=50_000, full=False, workers=None, with_matches=False):
+    """
+    回傳 (模式, 筆數, 各階段秒數)。
+    full=False 時先算過期比例：少量 → 增量 upsert；大量（或 returns_clean 是空的）→ 整表重建。
+    """
+    timing = {"read": 0.0, "classify": 0.0, "serialize": 0.0, "write": 0.0}
+    fp = clean_fingerprint()
+    raw = engine.raw_connection()           # 寫入用的 DBAPI 連線（mysql.connector）
+    n = 0
+    try:
+        cur = raw.cursor()
+        tables = [TARGET, "reason_tag", "reason_rule"] + LINKS
+        create_tables(cur, tables)
+        create_tables(cur, ["data_version", "data_change"])   # 變更紀錄在寫入交易中途寫，表要先建好
+        ensure_columns(cur, tables)          # 舊表補 rule_fp 欄
+        drop_obsolete_columns(cur)           # 舊版的 reason_tags / match_terms JSON 欄
+        ensure_indexes(cur, tables)
+        tag_ids, rule_ids = sync_dictionaries(cur)
+        raw.commit()
+        if not full:
+            with engine.connect() as conn:
+                stale, total = count_stale(conn, fp)
+            print(f"[clear] rule_fp={fp} 需重分類 {stale:,} / {total:,}")
+            full = total > 0 and stale > total * FULL_REBUILD_RATIO
+        suffix = STAGING if full else ""
+        deleted = 0
+        if full:
+            prepare_staging(cur)
+            sql, query = insert_sql(TARGET + suffix), SELECT_ALL
+        else:
+            log_change_days(cur, [TARGET] + LINKS, ORPHAN_DAYS)
+            deleted = purge_deleted(cur)
+            raw.commit()
+            if deleted:
+                print(f"[clear] 移除已刪除的退貨 {deleted:,} 筆")
+            sql, query = insert_sql(TARGET, upsert=True), select_stale(engine.dialect.name)
+        tags_sql = insert_sql("return_tags" + suffix, [c for c, _ in TABLES["return_tags"]])
+        match_sql = insert_sql("return_matches" + suffix, [c for c, _ in TABLES["return_matches"]])
+        chunks = read_pages(engine, query, {"fp": fp}, chunksize)
+        while True:
+            t0 = time.perf_counter()
+            df = next(chunks, None)
+            timing["read"] += time.perf_counter() - t0
+            if df is None:
+                break
+
+            t0 = time.perf_counter()
+            results = classify_many(df["reason"].tolist(), workers=workers)
+            timing["classify"] += time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            df["reason_category_l1"], tags, terms = serialize_results(results, tag_ids, rule_ids)
+            df["rule_fp"] = fp
+            rows = to_db_rows(df, OUT_COLS)
+            ids = df["return_id"].astype(object).tolist()
+            tag_rows, match_rows = link_rows(ids, tags, terms, with_matches)
+            timing["serialize"] += time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            if not full:
+                log_page_days(cur, ids, [TARGET] + LINKS)
+                delete_links(cur, ids)
+            cur.executemany(sql, rows)     # mysql.connector 會合併成多列 INSERT
+            if tag_rows:
+                cur.executemany(tags_sql, tag_rows)
+            if match_rows:
+                cur.executemany(match_sql, match_rows)
+            raw.commit()
+            timing["write"] += time.perf_counter() - t0
+            n += len(df)
+            print(f"[clear] {n:>10,} rows", flush=True)
+
+        if full:
+            t0 = time.perf_counter()
+            swap_staging(cur)
+            raw.commit()
+            timing["write"] += time.perf_counter() - t0
+        # 重分類是原地更新（筆數、最大 return_id 不變）：遞增版本號讓下游快照 / 常駐快取重建；
+        # 整表重建記成整張表變更，增量的受影響訂單日已逐頁記下。什麼都沒變就不遞增
+        if full:
+            log_change(cur, [TARGET] + LINKS)
+        if full or n or deleted:
+            bump_data_version(cur, tables)
+            raw.commit()
+        cur.close()
+    finally:
+        raw.close()
+    return ("full" if full else "incremental"), n, timing
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="returns → 原因分類 → returns_clean")
+    ap.add_argument("--chunksize", type=int, default=50_000, help="每批讀取 / 寫入筆數")
+    ap.add_argument("--full", action="store_true", help="不看指紋，整表重新分類")
+    ap.add_argument("--workers", type=int, default=1, help="分類用的 process 數（1=單 process）")
+    ap.add_argument("--with-matches", action="store_true", help="一併寫入命中明細 return_matches")
+    args = ap.parse_args(argv)
+
+    t0 = time.perf_counter()
+    mode, n, timing = run(get_engine(), chunksize=args.chunksize, full=args.full,
+                          workers=args.workers, with_matches=args.with_matches)
+    total = time.perf_counter() - t0
+    print(f"[clear] mode={mode}, classified rows={n:,}")
+    for stage, sec in timing.items():
+        print(f"[time] {stage:<9} {sec:8.2f}s")
+    print(f"[time] {'total':<9} {total:8.2f}s ({n / max(total, 1e-9):,.0f} rows/s)")
+    info = classify_cache_info()
+    print(f"[cache] 分類 {info['classified']:,} / {info['rows']:,} 筆，命中率 {info['hit_rate']:.1%}")
+    print("✅ returns_clean 已更新：含 reason_category_l1，L2 標籤見 return_tags"
+          + ("，命中明細見 return_matches" if args.with_matches else ""))
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,32 @@
-import sys, os, csv, time
+import sys, os, csv, time, argparse, threading
+from datetime import timedelta
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
 import mysql.connector as mc
 from dotenv import load_dotenv
+from schema import NATURAL_KEYS, create_tables, ensure_indexes, bump_data_version, log_change
 
 """
-One-time CSV importer for MySQL using executemany (no LOCAL INFILE, no pandas).
+One-time CSV importer for MySQL using executemany (no LOCAL INFILE; pandas only parses integer columns).
 - Reads DB creds from .env
 - Import order: product -> orders -> returns
+- Streams CSV batches straight into executemany, commits every N batches
+  and records a checkpoint (table, byte offset, rows done) so a re-run resumes.
+- --workers N: orders / returns are split into N byte ranges and loaded over
+  N connections in parallel (product is always loaded first, single stream).
+- Each batch is parsed column-wise and validated (types, required fields,
+  barcode / (orderid, barcode) references) before it reaches MySQL;
+  rejected rows go to a reject file with a reason.
+- --incremental: only rows newer than the stored watermarks (MAX(orderdate),
+  MAX(returndate)) and new/changed products are sent, as upserts on the
+  natural keys (schema.NATURAL_KEYS), so re-running the same drop is idempotent.
+  An order line whose orderdate was corrected replaces the old row (the unique
+  key of a partitioned orders table includes orderdate).
 Usage:
-  python load_once.py
+  python load_once.py /path/to/folder [--batch-size 1000] [--commit-every 50] [--fresh] [--workers N]
+                      [--reject-file rejects.csv] [--incremental [--lookback-days D]]
   # folder must contain product.csv, orders.csv, returns.csv
 """
 
@@ -37,6 +56,33 @@ INT_COLS = {
     "orders":  ["sell_qty"],
     "returns": ["return_qty"],
 }
+# 不可為空的欄位（其餘空字串照舊寫入；INT 欄空值 → NULL）
+REQUIRED_COLS = {
+    "product": ["barcode"],
+    "orders":  ["orderid","orderdate","barcode","sell_qty"],
+    "returns": ["orderid","returndate","barcode","return_qty"],
+}
+# 事件日期欄（增量模式的高水位）
+DATE_COLS = {"orders": "orderdate", "returns": "returndate"}
+LOAD_ORDER = ["product","orders","returns"]
+# 可平行切段的表（product 是 FK 維度表，永遠先單線載完）
+PARALLEL_TABLES = {"orders", "returns"}
+# 增量 upsert 前先刪掉「同一明細、不同訂單日」的舊列：分區表的唯一鍵含 orderdate，
+# 訂單日被更正時 upsert 對不到舊列，會多插一列
+MOVED_SQL = {"orders": "DELETE FROM orders WHERE orderid=%s AND barcode=%s AND orderdate<>%s"}
+
+# checkpoint 表：與資料在同一個 transaction 更新，commit 成功才算前進
+CKPT_TABLE = "load_checkpoint"
+CKPT_DDL = f"""
+CREATE TABLE IF NOT EXISTS {CKPT_TABLE} (
+    tbl         VARCHAR(64)  NOT NULL PRIMARY KEY,
+    src         VARCHAR(255) NOT NULL,
+    byte_offset BIGINT       NOT NULL DEFAULT 0,
+    rows_done   BIGINT       NOT NULL DEFAULT 0,
+    done        TINYINT      NOT NULL DEFAULT 0,
+    updated_at  TIMESTAMP    NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+)
+"""
 
 
 def chunked(iterable, n=1000):
@@ -49,68 +95,533 @@ def chunked(iterable, n=1000):
     if buf:
         yield buf
 
+def parse_block(table, idx, width, rows, validator=None):
+    """
+    一批原始 CSV 列 → 欄式解析與驗證。
+    idx: COLS[table] 在 header 中的位置（None = header 沒有這欄）；width: header 欄數。
+    回傳 (records, rejects)；records 為 COLS 順序的 tuple，rejects 為 [(原始列, 原因)]。
+    """
+    cols = COLS[table]
+    int_cols = set(INT_COLS.get(table, []))
+    required = set(REQUIRED_COLS.get(table, []))
+    rejects = [(r, f"欄位數不符({len(r)}≠{width})") for r in rows if len(r) != width]
+    if rejects:
+        rows = [r for r in rows if len(r) == width]
+    n = len(rows)
+    if n == 0:
+        return [], rejects
+
+    raw = list(zip(*rows))
+    reason = np.full(n, None, dtype=object)
+    def flag(mask, msg):
+        hit = mask & (reason == None)  # noqa: E711  只保留第一個原因
+        reason[hit] = msg
+
+    data = {}
+    for c, i in zip(cols, idx):
+        col = np.array(raw[i] if i is not None else [""] * n, dtype=str)
+        s = np.char.strip(col)
+        empty = np.char.str_len(s) == 0
+        if c in required:
+            flag(empty, f"缺少 {c}")
+        if c in int_cols:
+            v = parse_ints(s, empty)
+            flag(~empty & (v == None), f"{c} 非整數")  # noqa: E711
+            data[c] = v
+        else:
+            data[c] = col
+
+    if validator is not None:
+        validator.check_refs(table, data, flag)
+
+    good = reason == None  # noqa: E711
+    if not good.all():
+        bad = np.flatnonzero(~good)
+        rejects += [(rows[k], reason[k]) for k in bad]
+    cols_out = [data[c][good].tolist() for c in cols]
+    return list(zip(*cols_out)), rejects
+
+def parse_ints(s, empty):
+    """
+    整數欄：與原本的 int(v) 接受同樣的寫法（正負號、前後空白、全形數字、1_000），
+    另外接受小數部分為 0 的數值（"2.0"）。空字串與無法轉成整數的值 → None。
+    """
+    num = pd.to_numeric(pd.Series(s, dtype=object), errors="coerce").to_numpy(dtype="float64")
+    ok = np.isfinite(num) & (num == np.round(num)) & (np.abs(num) < 2**53)
+    v = np.full(len(s), None, dtype=object)
+    v[ok] = num[ok].astype(np.int64).tolist()
+    for k in np.flatnonzero(~ok & ~empty):     # pandas 不認得的寫法（全形數字、底線）逐格交給 int()
+        try:
+            v[k] = int(s[k])
+        except ValueError:
+            pass
+    return v
+
+def order_key(orderid, barcode):
+    """(orderid, barcode) 的 hash key；字串比 tuple 省記憶體"""
+    return np.char.add(np.char.add(orderid, "\x1f"), barcode)
+
+class Validator:
+    """
+    匯入前的參照檢查：product barcode 集合、(orderid, barcode) → sell_qty。
+    資料在載入過程中邊載邊學；表若是續傳 / 略過（沒有完整經手），改從 DB 補齊。
+    取代原本 main() 結尾對 returns × orders 的全表 LEFT JOIN 檢查。
+    同一次匯入裡重複出現的訂單明細 (orderid, barcode) 拒絕（returns 無從分辨要對哪一列）；
+    DB 裡已有的明細不算重複，增量模式照常 upsert。
+    """
+    def __init__(self, reject_path, lookup=None):
+        self.reject_path = reject_path
+        self.lookup = lookup          # (conn, cur)：增量模式下缺的訂單回 DB 以自然鍵查
+        self.barcodes = set()
+        self.order_qty = {}
+        self.seen_orders = set()      # 本次匯入已經手的 (orderid, barcode)
+        self.partial = set()          # 本次沒有從頭完整載入的表
+        self.stats = Counter()        # (table, reason) → 筆數
+        self._lock = threading.Lock()
+
+    def check_refs(self, table, data, flag):
+        if table == "orders":
+            known = self.barcodes
+            flag(~np.fromiter((b in known for b in data["barcode"]), bool, len(data["barcode"])),
+                 "barcode 不存在於 product")
+            keys = order_key(data["orderid"], data["barcode"])
+            with self._lock:
+                seen = self.seen_orders
+                dup = np.zeros(len(keys), dtype=bool)
+                for i, k in enumerate(keys.tolist()):
+                    dup[i] = k in seen
+                    seen.add(k)
+            flag(dup, "訂單明細重複(orderid, barcode)")
+        elif table == "returns":
+            keys = order_key(data["orderid"], data["barcode"])
+            if self.lookup is not None:
+                self.fetch_orders(keys)
+            get = self.order_qty.get
+            sold = np.array([get(k, -1) for k in keys], dtype=np.int64)
+            flag(sold < 0, "找不到對應訂單(orderid, barcode)")
+            qty = np.array([q if q is not None else 0 for q in data["return_qty"]], dtype=np.int64)
+            flag(qty > sold, "退貨量大於銷售量")
+
+    def learn(self, table, records):
+        """
+        把已通過驗證的列加入參照集合（平行 worker 共用，需上鎖）。
+        orders 以 (orderid, barcode) 為自然鍵、upsert 覆寫，
+        所以同一鍵以最後一筆的 sell_qty 為準（直接指定，不累加；增量重放的列也不會重複計入）
+        """
+        if table == "product":
+            with self._lock:
+                self.barcodes.update(r[0] for r in records)
+        elif table == "orders":
+            if not records:
+                return
+            oid, _, bc, qty = zip(*records)
+            keys = order_key(np.array(oid, dtype=str), np.array(bc, dtype=str)).tolist()
+            with self._lock:
+                d = self.order_qty
+                for k, q in zip(keys, qty):
+                    d[k] = q or 0
+
+    def fetch_orders(self, keys):
+        """參照集合裡沒有的 (orderid, barcode)，用 orderid IN (...) 走唯一鍵補查"""
+        with self._lock:
+            missing = {k for k in keys.tolist() if k not in self.order_qty}
+            if not missing:
+                return
+            oids = sorted({k.split("\x1f", 1)[0] for k in missing})
+            _, cur = self.lookup
+            for part in chunked(oids, n=500):
+                cur.execute(f"SELECT orderid, barcode, sell_qty FROM orders "
+                            f"WHERE orderid IN ({','.join(['%s'] * len(part))})", part)
+                for o, b, q in cur.fetchall():
+                    k = f"{o}\x1f{b}"
+                    if k in missing:
+                        self.order_qty[k] = int(q or 0)
+
+    def prime(self, cur, table):
+        """表沒在本次完整經手時，從 DB 重建參照集合"""
+        if table == "product":
+            cur.execute("SELECT barcode FROM product")
+            self.barcodes = {r[0] for r in cur.fetchall()}
+        elif table == "orders":
+            cur.execute("SELECT orderid, barcode, sell_qty FROM orders")     # (orderid, barcode) 唯一
+            self.order_qty = {f"{o}\x1f{b}": int(q or 0) for o, b, q in cur.fetchall()}
+
+    def reject(self, table, rejects):
+        if not rejects:
+            return
+        with self._lock:
+            new = not os.path.exists(self.reject_path)
+            with open(self.reject_path, "a", encoding="utf-8-sig", newline="") as f:
+                w = csv.writer(f)
+                if new:
+                    w.writerow(["table", "reason", "row"])
+                for row, why in rejects:
+                    w.writerow([table, why, *row])
+                    self.stats[(table, why)] += 1
+
+class CsvStream:
+    """
+    逐行讀取 CSV（binary 模式），同時記錄已消耗的 byte offset。
+    offset 指向「最後一筆已產出資料列」的結尾，可直接存成 checkpoint，下次 seek 回來續讀。
+    end 不為 None 時只讀到該 byte 位置（需落在行首，見 split_ranges）。
+    """
+    def __init__(self, path, table, offset=0, end=None):
+        self.path = path
+        self.table = table
+        self.start = offset
+        self.offset = offset
+        self.end = end
+
+    def _lines(self, f):
+        for line in iter(f.readline, b""):
+            if self.end is not None and self.offset >= self.end:
+                return
+            self.offset += len(line)
+            yield line.decode("utf-8-sig")
+
+    def read_header(self):
+        """讀 header，設定 self.idx（COLS 在檔案中的欄位位置）與 self.width"""
+        with open(self.path, "rb") as f:
+            header_line = f.readline()
+        header = next(csv.reader([header_line.decode("utf-8-sig")]), [])
+        pos = {c.strip(): i for i, c in enumerate(header)}
+        self.idx = [pos.get(c) for c in COLS[self.table]]
+        self.width = len(header)
+        return header_line
+
+    def __iter__(self):
+        """產出原始列（list[str]），型別轉換與驗證交給 parse_block 整批處理"""
+        header_line = self.read_header()
+        with open(self.path, "rb") as f:
+            # 從頭讀時跳過 header；續傳時直接 seek 到 checkpoint
+            self.offset = max(self.start, len(header_line))
+            f.seek(self.offset)
+            for row in csv.reader(self._lines(f)):
+                if not row:
+                    continue
+                yield row
+
+def split_ranges(path, n):
+    """
+    把資料區（header 之後）切成 n 段 [start, end)，每個切點往後對齊到下一個換行。
+    假設一筆資料不跨行（本專案 CSV 皆為單行記錄）。
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        head = len(f.readline())
+        cuts = [head]
+        for k in range(1, n):
+            pos = head + (size - head) * k // n
+            if pos <= cuts[-1]:
+                continue
+            f.seek(pos - 1)
+            f.readline()   # 跳到下一行開頭（pos-1 剛好是換行時不會多跳一行）
+            pos = f.tell()
+            if cuts[-1] < pos < size:
+                cuts.append(pos)
+    cuts.append(size)
+    return list(zip(cuts[:-1], cuts[1:]))
+
 def iter_rows(path, table):
-    """逐行讀取 CSV，並轉換為 tuple"""
-    with open(path, "r", encoding="utf-8-sig", newline="") as f:
-        reader = csv.DictReader(f)
-        cols = COLS[table]
-        int_cols = set(INT_COLS.get(table, []))
-        for row in reader:
-            rec = []
-            for c in cols:
-                v = row.get(c, "")
-                if c in int_cols:
-                    try:
-                        v = int(v) if str(v).strip() != "" else None
-                    except:
-                        v = None
-                rec.append(v)
-            yield tuple(rec)
-
-def insert_table(cur, table, rows):
+    """逐行讀取 CSV，並轉換為 tuple（格式不合的列略過）"""
+    stream = CsvStream(path, table)
+    for batch in chunked(stream, n=1000):
+        records, _ = parse_block(table, stream.idx, stream.width, batch)
+        yield from records
+
+def insert_sql(table, upsert=False):
     cols = COLS[table]
     placeholders = ",".join(["%s"] * len(cols))
     sql = f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({placeholders})"
+    if upsert:
+        upd = [c for c in cols if c not in NATURAL_KEYS[table]]
+        sql += " ON DUPLICATE KEY UPDATE " + ", ".join(f"{c}=VALUES({c})" for c in upd)
+    return sql
+
+def insert_table(cur, table, rows, batch_size=1000):
+    sql = insert_sql(table)
     total = 0
     t0 = time.time()
-    for batch in chunked(rows, n=1000):
+    for batch in chunked(rows, n=batch_size):
         cur.executemany(sql, batch)
         total += len(batch)
     return total, time.time() - t0
 
-def main():
-    if len(sys.argv) < 2:
-        print("用法: python load_once.py /path/to/folder")
-        sys.exit(2)
-    base = os.path.abspath(sys.argv[1])
-    for t, fn in FILES.items():
-        if not os.path.exists(os.path.join(base, fn)):
-            raise FileNotFoundError(f"缺少 {t} 檔案：{os.path.join(base, fn)}")
+# ===== checkpoint =====
+def source_tag(path):
+    """以檔名 + 檔案大小辨識同一份 CSV；換檔就不沿用舊 checkpoint"""
+    return f"{os.path.basename(path)}:{os.path.getsize(path)}"
+
+def read_checkpoint(cur, table):
+    cur.execute(f"SELECT src, byte_offset, rows_done, done FROM {CKPT_TABLE} WHERE tbl=%s", (table,))
+    return cur.fetchone()
 
+def save_checkpoint(cur, table, src, offset, rows_done, done=0):
+    cur.execute(f"""
+        INSERT INTO {CKPT_TABLE} (tbl, src, byte_offset, rows_done, done) VALUES (%s,%s,%s,%s,%s)
+        ON DUPLICATE KEY UPDATE src=VALUES(src), byte_offset=VALUES(byte_offset),
+                                rows_done=VALUES(rows_done), done=VALUES(done)
+    """, (table, src, offset, rows_done, done))
+
+def stream_table(conn, cur, table, path, batch_size=1000, commit_every=50,
+                 key=None, start=0, end=None, validator=None, delta=None):
+    """
+    串流匯入單表：CSV → chunked → executemany，每 commit_every 批 commit 一次。
+    checkpoint 與資料同 transaction 寫入，中斷後重跑會從上次 commit 的位置續傳。
+    key/start/end：平行模式下每個 worker 只負責一段 byte 範圍，用自己的 checkpoint key。
+    validator：每批先欄式驗證，拒絕列寫入 reject 檔，通過的列才 executemany。
+    delta：增量模式的列篩選（見 delta_filter），有值時改用 upsert。
+    回傳 (本次匯入筆數, 累計筆數, 秒數)；已完成的表回傳 None。
+    """
+    key = key or table
+    src = source_tag(path) if end is None else f"{source_tag(path)}@{start}-{end}"
+    offset, rows_done = start, 0
+    ck = read_checkpoint(cur, key)
+    if ck and ck[0] == src:
+        if validator is not None:
+            validator.partial.add(table)
+        if ck[3]:
+            return None
+        offset, rows_done = int(ck[1]), int(ck[2])
+    elif ck:
+        print(f"[load] {key}: 來源檔已變更（{ck[0]} → {src}），checkpoint 重設")
+
+    sql = insert_sql(table, upsert=delta is not None)
+    stream = CsvStream(path, table, offset=offset, end=end)
+    n, pending = 0, 0
+    t0 = time.time()
+    for batch in chunked(stream, n=batch_size):
+        batch, rejects = parse_block(table, stream.idx, stream.width, batch, validator)
+        if validator is not None:
+            validator.reject(table, rejects)
+            validator.learn(table, batch)
+        if delta is not None:
+            batch = delta(batch)
+            if batch and table in MOVED_SQL:
+                pos = [COLS[table].index(c) for c in ("orderid", "barcode", DATE_COLS[table])]
+                cur.executemany(MOVED_SQL[table], [tuple(r[i] for i in pos) for r in batch])
+                if cur.rowcount > 0:         # 被刪掉的舊列在哪個訂單日不知道：記成整張表變更
+                    log_change(cur, [table])
+        if batch:
+            cur.executemany(sql, batch)
+        n += len(batch)
+        pending += 1
+        if pending >= commit_every:
+            save_checkpoint(cur, key, src, stream.offset, rows_done + n)
+            conn.commit()
+            pending = 0
+    save_checkpoint(cur, key, src, stream.offset, rows_done + n, done=1)
+    conn.commit()
+    return n, rows_done + n, time.time() - t0
+
+# ===== 平行載入 =====
+def open_conn():
+    """每個 worker 各自一條連線（mysql.connector 連線不可跨執行緒共用）"""
     conn = mc.connect(**DB_CONFIG, autocommit=False)
     cur  = conn.cursor()
     cur.execute("SET NAMES utf8mb4")
     cur.execute("SET SESSION sql_mode = 'STRICT_ALL_TABLES'")
     cur.execute("SET time_zone = '+00:00'")
+    return conn, cur
+
+def check_ckpt_mode(cur, table, keys):
+    """避免用不同 --workers 續傳同一張表（切段不同會重複匯入）"""
+    cur.execute(f"SELECT tbl FROM {CKPT_TABLE} WHERE (tbl=%s OR tbl LIKE %s) AND done=0",
+                (table, f"{table}#%"))
+    stale = {r[0] for r in cur.fetchall()} - set(keys)
+    if stale:
+        raise RuntimeError(f"{table} 有未完成的 checkpoint {sorted(stale)}，"
+                           f"請用相同的 --workers 續傳，或加 --fresh 重來")
+
+def _load_range(table, path, key, start, end, batch_size, commit_every, validator, delta):
+    conn, cur = open_conn()
     try:
-        # Import order: product -> orders -> returns
-        for table in ["product","orders","returns"]:
+        res = stream_table(conn, cur, table, path, batch_size=batch_size, commit_every=commit_every,
+                           key=key, start=start, end=end, validator=validator, delta=delta)
+        return key, res
+    finally:
+        cur.close()
+        conn.close()
+
+def parallel_table(cur, table, path, workers, batch_size=1000, commit_every=50,
+                   validator=None, delta=None):
+    """
+    把單表切成 workers 段，各段一條連線平行 executemany。
+    回傳 [(key, res)]，res 同 stream_table。
+    """
+    ranges = split_ranges(path, workers)
+    keys = [f"{table}#{k}/{len(ranges)}" for k in range(len(ranges))]
+    check_ckpt_mode(cur, table, keys)
+    with ThreadPoolExecutor(max_workers=len(ranges)) as ex:
+        futs = [ex.submit(_load_range, table, path, key, s, e, batch_size, commit_every, validator, delta)
+                for key, (s, e) in zip(keys, ranges)]
+        return [fu.result() for fu in futs]
+
+# ===== 增量匯入 =====
+WM_TABLE = "load_watermark"
+WM_DDL = f"""
+CREATE TABLE IF NOT EXISTS {WM_TABLE} (
+    tbl        VARCHAR(32) NOT NULL PRIMARY KEY,
+    hwm        DATETIME    NULL,
+    n_keys     BIGINT      NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP   NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+)
+"""
+
+def read_watermarks(cur):
+    """目前 DB 的高水位：MAX(orderdate) / MAX(returndate) 與 product barcode 數"""
+    wm = {}
+    for table, col in DATE_COLS.items():
+        cur.execute(f"SELECT MAX({col}), COUNT(*) FROM {table}")
+        wm[table] = cur.fetchone()
+    cur.execute("SELECT NULL, COUNT(*) FROM product")
+    wm["product"] = cur.fetchone()
+    return wm
+
+def save_watermarks(cur, wm):
+    for table, (hwm, n) in wm.items():
+        cur.execute(f"""
+            INSERT INTO {WM_TABLE} (tbl, hwm, n_keys) VALUES (%s,%s,%s)
+            ON DUPLICATE KEY UPDATE hwm=VALUES(hwm), n_keys=VALUES(n_keys)
+        """, (table, hwm, n))
+
+def delta_filter(cur, table, wm, lookback_days=0):
+    """
+    回傳增量模式的列篩選函式：
+    - product：只留新 barcode 或內容有變的列（和 DB 現值比對）
+    - orders / returns：只留事件日期 >= 高水位 - lookback 的列
+      （日期先解析成 datetime 再比，'2025/1/5' 這類未補零的寫法也正確；同秒的列靠 upsert 保持冪等。
+        解析不了的日期不在這裡丟掉，照常送出，由 MySQL 決定收不收）
+    """
+    cols = COLS[table]
+    if table == "product":
+        cur.execute(f"SELECT {', '.join(cols)} FROM product")
+        current = {r[0]: tuple(r) for r in cur.fetchall()}
+        return lambda rows: [r for r in rows if current.get(r[0]) != r]
+    cutoff = delta_cutoff(wm, table, lookback_days)
+    if cutoff is None:
+        return lambda rows: rows
+    j = cols.index(DATE_COLS[table])
+    def keep(rows):
+        if not rows:
+            return rows
+        when = pd.to_datetime(pd.Series([r[j] for r in rows], dtype=object), errors="coerce", format="mixed")
+        old = (when < cutoff).to_numpy()
+        return [r for r, o in zip(rows, old) if not o]
+    return keep
+
+def delta_cutoff(wm, table, lookback_days=0):
+    """增量模式 orders / returns 的日期下限（高水位 - lookback）；還沒有高水位 → None"""
+    hwm = wm[table][0]
+    return None if hwm is None else pd.Timestamp(hwm) - timedelta(days=lookback_days)
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="CSV → MySQL 匯入（product → orders → returns）")
+    ap.add_argument("folder", help="含 product.csv / orders.csv / returns.csv 的資料夾")
+    ap.add_argument("--batch-size", type=int, default=1000, help="每次 executemany 的筆數")
+    ap.add_argument("--commit-every", type=int, default=50, help="每幾批 commit 並寫一次 checkpoint")
+    ap.add_argument("--fresh", action="store_true", help="忽略既有 checkpoint，從頭匯入")
+    ap.add_argument("--workers", type=int, default=1, help="orders/returns 平行連線數（1=單線）")
+    ap.add_argument("--reject-file", default=None, help="驗證失敗列輸出檔（預設 <folder>/rejects.csv）")
+    ap.add_argument("--incremental", action="store_true", help="只匯入高水位之後的新資料（upsert）")
+    ap.add_argument("--lookback-days", type=int, default=0, help="增量模式往回重掃的天數（補遲到/更正的資料）")
+    return ap.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    base = os.path.abspath(args.folder)
+    for t, fn in FILES.items():
+        if not os.path.exists(os.path.join(base, fn)):
+            raise FileNotFoundError(f"缺少 {t} 檔案：{os.path.join(base, fn)}")
+
+    reject_path = os.path.abspath(args.reject_file or os.path.join(base, "rejects.csv"))
+    validator = Validator(reject_path)
+
+    conn, cur = open_conn()
+    create_tables(cur, LOAD_ORDER)   # 表結構與索引見 schema.py
+    create_tables(cur, ["data_version", "data_change"])   # 變更紀錄在寫入交易中途寫，表要先建好
+    cur.execute(CKPT_DDL)
+    wm = None
+    if args.incremental:
+        cur.execute(WM_DDL)
+        for idx in ensure_indexes(cur, LOAD_ORDER, only_unique=True):
+            print(f"[inc] 建立唯一鍵 {idx}")
+        wm = read_watermarks(cur)
+        for t, (hwm, n) in wm.items():
+            print(f"[inc] {t:<7} watermark={hwm} rows={n}")
+        # DB 已有歷史資料：product 從 DB 補參照，orders 改用逐批自然鍵查詢（不做全表掃描）
+        validator.partial.update(LOAD_ORDER)
+        validator.lookup = open_conn()
+    if args.fresh:
+        cur.execute(f"DELETE FROM {CKPT_TABLE}")
+        conn.commit()
+        if os.path.exists(reject_path):
+            os.remove(reject_path)
+    touched = {}                     # 表 → "rows"（本次有寫入）/ "skipped"（checkpoint 顯示先前已寫完）
+    try:
+        # Import order: product -> orders -> returns（平行模式下每張表全部 worker 結束才換下一張）
+        for table in LOAD_ORDER:
             path = os.path.join(base, FILES[table])
-            rows = list(iter_rows(path, table))
-            print(f"[load] {table:<7} rows={len(rows)} ...", end="", flush=True)
-            n, sec = insert_table(cur, table, rows)
+            # 上游表沒有在本次完整載入 → 參照集合從 DB 補（增量模式的 orders 改逐批查，不整表讀）
+            parent = {"orders": "product", "returns": "orders"}.get(table)
+            if parent in validator.partial and not (parent == "orders" and validator.lookup):
+                validator.prime(cur, parent)
+            delta = delta_filter(cur, table, wm, args.lookback_days) if wm else None
+            if args.workers > 1 and table in PARALLEL_TABLES:
+                t0 = time.time()
+                results = parallel_table(cur, table, path, args.workers, batch_size=args.batch_size,
+                                         commit_every=args.commit_every, validator=validator, delta=delta)
+                total = 0
+                for key, res in results:
+                    if res is None:
+                        print(f"[load] {key:<12} skip: checkpoint 顯示已完成")
+                        continue
+                    n, _, sec = res
+                    total += n
+                    print(f"[load] {key:<12} inserted={n}, {sec:.2f}s, {n / max(sec, 1e-9):,.0f} rows/s")
+                sec = time.time() - t0
+                if any(res is None for _, res in results):
+                    touched[table] = "skipped"
+                elif total:
+                    touched[table] = "rows"
+                print(f"[load] {table:<7} done: inserted={total}, {sec:.2f}s, {total / max(sec, 1e-9):,.0f} rows/s")
+                continue
+            print(f"[load] {table:<7} ...", end="", flush=True)
+            res = stream_table(conn, cur, table, path, batch_size=args.batch_size,
+                               commit_every=args.commit_every, validator=validator, delta=delta)
+            if res is None:
+                touched[table] = "skipped"
+                print(" skip: checkpoint 顯示已完成")
+                continue
+            n, total, sec = res
+            if n:
+                touched[table] = "rows"
+            print(f" done: inserted={n} (total={total}), {sec:.2f}s")
+
+        # 驗證在匯入前就做完（取代 returns × orders 的全表 LEFT JOIN），這裡只印摘要
+        bad = sum(validator.stats.values())
+        print(f"[check] rejected rows={bad}" + (f" → {reject_path}" if bad else " (全部通過)"))
+        for (table, why), cnt in sorted(validator.stats.items()):
+            print(f"[check]   {table:<7} {why}: {cnt}")
+
+        # 原地 upsert（例如 product 改價）不會改變筆數或最大鍵：遞增版本號讓下游快照 / 常駐快取重建；
+        # 一併記下影響的訂單日：增量匯入的 orders 只動到 cutoff 之後，其餘（product、全量匯入、
+        # 先前中斷的那次寫入）記成整張表
+        for table, how in touched.items():
+            cutoff = delta_cutoff(wm, table, args.lookback_days) if wm and how == "rows" and table == "orders" else None
+            log_change(cur, [table], cutoff.date() if cutoff is not None else None)
+        bump_data_version(cur, list(touched))
+        conn.commit()
+
+        if wm is not None:
+            wm = read_watermarks(cur)
+            save_watermarks(cur, wm)
             conn.commit()
-            print(f" done: inserted={n}, {sec:.2f}s")
-
-        # quick sanity check
-        cur.execute("""
-        SELECT COUNT(*) FROM returns r
-        LEFT JOIN orders o USING(orderid, barcode)
-        WHERE o.orderid IS NULL OR r.return_qty > o.sell_qty
-        """)
-        bad = cur.fetchone()[0]
-        print(f"[check] returns join & qty ok? bad_rows={bad} (應為 0)")
+            print("[inc] new watermark: " + ", ".join(f"{t}={h or n}" for t, (h, n) in wm.items()))
     finally:
+        if validator.lookup is not None:
+            validator.lookup[1].close()
+            validator.lookup[0].close()
         cur.close()
         conn.close()
 
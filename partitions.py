@@ -0,0 +1,392 @@
+import os, sys, json, time, shutil, argparse, threading
+from collections import OrderedDict
+import pandas as pd
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import URL
+from dotenv import load_dotenv
+import analytic as A
+from snapshot import save_snapshot, load_snapshot
+
+'''
+    base 明細的月分區版本（out-of-core）：資料量大到整份 base 放不進記憶體時使用。
+      建置：product / reason_tag 小表讀一次；orders 依 orderdate 一個月一個月讀（MySQL 端 orders 有月分區時只掃該分區），
+            只撈該月訂單對得到的 returns_clean / return_tags，用 analytic.build_base 合併後
+            寫成一個分區目錄（snapshot.py 的欄式 .npy 格式）。任何時刻只有一個月的明細在記憶體裡。
+      查詢：依 Filters 的訂單日期（與各分區退貨日期的上下界）挑出要讀的分區，
+            每個分區 mmap 載入 → apply_filters → 壓成面板層級的部分彙總（PARTIALS：原因 × 時滯次數表、
+            每日銷售 / 每日退貨、類別 × 原因、標籤組合、商品、原因 × 商品、商品 × 標籤組合），
+            各分區的部分彙總 groupby 加總合併。
+            合併後的大小只跟維度（天數、時滯值、類別、商品數、標籤組合）有關，不隨明細列數成長，
+            再交給 analytic.py 的面板函式（做法同 rollup.py：欄名與明細相同，rows = 列數權重）。
+            儀表板的面板都有對應的部分彙總；要逐列明細的用途（例如匯出）才用 map_reduce + concat_frames。
+      儀表板：app.py 設 USE_PARTITIONS=1 時改讀這裡的分區（不載整份 base），manifest 換版自動換上。
+    目錄結構：ROOT/manifest.json（目前版本與分區清單）、ROOT/<版本>/<YYYY-MM | none>/
+    來源資料版本（analytic.data_version）變了才整批重建到新的版本目錄，完成後才換 manifest，
+    重建期間讀取端仍看舊版本。
+Usage:
+  python partitions.py build [--force] [--sqlite PATH]
+  python partitions.py info
+  python partitions.py summary [--order-from 2024-01-01] [--order-to 2025-01-01] [--category2 ...] [--reason ...]
+'''
+load_dotenv()
+DB_CONFIG = {
+    "host": os.getenv("DB_HOST"),
+    "port": int(os.getenv("DB_PORT", "3306")),
+    "user": os.getenv("DB_USER"),
+    "password": os.getenv("DB_PASSWORD"),
+    "database": os.getenv("DB_NAME"),
+}
+
+PART_DIR = os.getenv("BASE_PARTITION_DIR", os.path.join(".cache", "base_parts"))
+MANIFEST = "manifest.json"
+NO_DATE = "none"        # orderdate 為 NULL 的訂單
+
+def get_engine():
+    url = URL.create(
+        "mysql+mysqlconnector",
+        username=DB_CONFIG["user"],
+        password=DB_CONFIG["password"],
+        host=DB_CONFIG["host"],
+        port=DB_CONFIG["port"],
+        database=DB_CONFIG["database"],
+        query={"charset": "utf8mb4"}
+    )
+    return create_engine(url)
+
+def sqlite_engine(path=":memory:"):
+    """本機 / 測試用的 SQLite 替身（需有 product、orders、returns_clean、return_tags、reason_tag 表）"""
+    return create_engine(f"sqlite:///{path}")
+
+# ===== 建置 =====
+def order_months(eng) -> list[str]:
+    """orders 涵蓋的月份（'YYYY-MM'，由最早到最晚連續列出）；有 NULL 訂單日時最後加上 NO_DATE"""
+    with eng.connect() as conn:
+        lo, hi, nulls = conn.execute(text(
+            "SELECT MIN(orderdate), MAX(orderdate), SUM(CASE WHEN orderdate IS NULL THEN 1 ELSE 0 END) FROM orders"
+        )).one()
+    months = []
+    if lo is not None:
+        months = [str(p) for p in pd.period_range(pd.Timestamp(lo).to_period("M"),
+                                                  pd.Timestamp(hi).to_period("M"), freq="M")]
+    return months + ([NO_DATE] if nulls else [])
+
+def month_bounds(ym: str) -> dict:
+    p = pd.Period(ym, freq="M")
+    return {"a": p.start_time.strftime("%Y-%m-%d"), "b": (p + 1).start_time.strftime("%Y-%m-%d")}
+
+def read_month(eng, ym: str):
+    """單月的 (orders, returns_clean, return_tags)；退貨以 (orderid, barcode) 對到該月訂單才撈"""
+    if ym == NO_DATE:
+        cond, params = "orderdate IS NULL", {}
+    else:
+        cond, params = "orderdate >= :a AND orderdate < :b", month_bounds(ym)
+    in_month = f"(r.orderid, r.barcode) IN (SELECT orderid, barcode FROM orders WHERE {cond})"
+    with eng.connect() as conn:
+        o = pd.read_sql(text(f"SELECT orderid, orderdate, barcode, sell_qty FROM orders WHERE {cond}"),
+                        conn, params=params)
+        r = pd.read_sql(text(f"""
+            SELECT r.return_id, r.orderid, r.returndate, r.barcode, r.return_qty,
+                   COALESCE(r.reason_category_l1,'其他') AS reason_cat
+            FROM returns_clean r WHERE {in_month}"""), conn, params=params)
+        links = pd.read_sql(text(f"""
+            SELECT t.return_id, t.tag_id FROM return_tags t
+            WHERE t.return_id IN (SELECT r.return_id FROM returns_clean r WHERE {in_month})
+            ORDER BY t.return_id, t.seq"""), conn, params=params)
+    return o, r, links
+
+def _date_range(s: pd.Series) -> list:
+    s = s.dropna()
+    return [str(s.min()), str(s.max())] if len(s) else [None, None]
+
+def read_manifest(root: str = PART_DIR) -> dict | None:
+    try:
+        with open(os.path.join(root, MANIFEST), encoding="utf-8") as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+def build_partitions(eng, root: str = PART_DIR, version: str | None = None, force: bool = False) -> dict:
+    """
+    逐月建置分區並回傳 manifest；版本與現有 manifest 相同（且未 force）就不動。
+    version 預設為 analytic.data_version(eng)（MySQL）；SQLite 測試時請自行給。
+    """
+    version = version or A.data_version(eng)
+    old = read_manifest(root)
+    if old is not None and old["version"] == version and not force:
+        return old
+    t0 = time.perf_counter()
+    with eng.connect() as conn:
+        p = pd.read_sql(text("""
+            SELECT barcode, productid, product_name, supplier, sellprice, category1, category2, category3,color,size
+            FROM product"""), conn)
+        names = pd.read_sql(text("SELECT tag_id, tag FROM reason_tag"), conn).set_index("tag_id")["tag"]
+    vdir = os.path.join(root, version)
+    shutil.rmtree(vdir, ignore_errors=True)
+    os.makedirs(vdir)
+    parts = []
+    for ym in order_months(eng):
+        o, r, links = read_month(eng, ym)
+        if o.empty:
+            continue
+        df = A.build_base(p.copy(), o, r, links, names)
+        save_snapshot(df, os.path.join(vdir, ym), version)
+        parts.append({"month": ym, "rows": len(df),
+                      "orderdate": _date_range(df["orderdate"]), "returndate": _date_range(df["returndate"])})
+        del o, r, links, df
+    manifest = {"version": version, "dir": version, "partitions": parts,
+                "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "seconds": round(time.perf_counter() - t0, 1)}
+    tmp = os.path.join(root, f"{MANIFEST}.tmp{os.getpid()}")
+    with open(tmp, "w", encoding="utf-8") as fh:
+        json.dump(manifest, fh, ensure_ascii=False)
+    os.replace(tmp, os.path.join(root, MANIFEST))
+    for name in os.listdir(root):       # 舊版本目錄：已 mmap 的檔案在 Linux 上仍可讀到 process 結束
+        path = os.path.join(root, name)
+        if name != version and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+    return manifest
+
+# ===== 查詢 =====
+def concat_frames(frames: list[pd.DataFrame]) -> pd.DataFrame:
+    """接起各分區的結果；category 欄先換成各分區類別值的聯集（排序），避免 concat 後退化成 object"""
+    frames = [d for d in frames if len(d)] or frames[:1]
+    if not frames:
+        return pd.DataFrame()
+    if len(frames) == 1:
+        return frames[0].reset_index(drop=True)
+    frames = [d.copy() for d in frames]
+    for col in frames[0].columns:
+        if isinstance(frames[0][col].dtype, pd.CategoricalDtype):
+            cats = sorted(set().union(*(d[col].cat.categories for d in frames)))
+            for d in frames:
+                d[col] = d[col].cat.set_categories(cats)
+    return pd.concat(frames, ignore_index=True)
+
+# 面板層級的部分彙總：名稱 → (分組鍵, 加總欄)；另加 rows = 明細列數。
+# 鍵都是有限維度（日期截到日），所以結果大小與明細列數無關，可以跨分區相加。
+PARTIALS = {
+    "lag":      (["reason_cat", "lag_days"], ["sell_qty", "return_qty", "loss_amount"]),
+    "sales":    (["orderdate"], ["sell_qty"]),
+    "returns":  (["returndate"], ["return_qty"]),
+    "category": (["category1", "category2", "category3", "reason_cat"], ["return_qty"]),
+    "tags":     (["tags_l2"], ["return_qty", "loss_amount"]),
+    # 商品屬性由 barcode 決定，放進鍵只是為了帶到結果裡（不增加格數）
+    "product":  (["barcode", "productid", "product_name", "color", "size"],
+                 ["sell_qty", "return_qty", "sales_amount", "loss_amount"]),
+    # top5_per_reason：分子只算有退貨的列、denom="reason" 的分母也是，所以多分一個 returned 鍵
+    "product_reason": (["reason_cat", "barcode", "product_name", "returned"], ["sell_qty", "return_qty"]),
+    "product_tags":   (["barcode", "category2", "category3", "tags_l2"], ["return_qty", "loss_amount"]),
+}
+DAY_KEYS = ("orderdate", "returndate")
+
+def _key(df: pd.DataFrame, k: str) -> pd.Series:
+    if k in DAY_KEYS:
+        return df[k].dt.floor("D")
+    if k == "returned":              # 同 build_cube 的 returned 鍵
+        return (df["return_qty"] > 0).rename(k)
+    return df[k]
+
+def partial(df: pd.DataFrame, name: str) -> pd.DataFrame:
+    """篩選後的分區明細 → 部分彙總（欄名與明細相同，rows 當權重）"""
+    keys, sums = PARTIALS[name]
+    by = [_key(df, k) for k in keys]
+    g = df[sums].groupby(by, observed=True, dropna=False, sort=False)
+    out = g.sum()
+    out.insert(0, "rows", g.size().astype("int64"))
+    out.index.names = keys
+    return out.reset_index()
+
+def merge_partials(frames: list[pd.DataFrame], name: str) -> pd.DataFrame:
+    """各分區的同名部分彙總 → 依鍵加總（鍵在不同分區可能重複，例如同一時滯、同一退貨日）"""
+    keys, _ = PARTIALS[name]
+    d = concat_frames(frames)
+    if d.empty:
+        return d
+    return d.groupby(keys, observed=True, dropna=False, sort=False).sum().reset_index()
+
+AGG_CACHE = 8           # PartitionedBase 保留最近幾組篩選條件的合併部分彙總
+
+class PartitionedBase:
+    """
+    月分區 base 的讀取端：partitions(f) 依日期條件剪枝，map_reduce(f, fn, reduce) 逐分區計算後合併，
+    aggregate(f, names) = 各分區的 PARTIALS 部分彙總加總合併（= partial(apply_filters(整份 base, f))）。
+    物件綁定建立當下的 manifest；refreshed() 在 manifest 換版後回傳新版本的物件。
+    """
+    def __init__(self, root: str = PART_DIR):
+        self.root = root
+        self.manifest = read_manifest(root)
+        if self.manifest is None:
+            raise FileNotFoundError(f"找不到分區 manifest：{os.path.join(root, MANIFEST)}（請先 python partitions.py build）")
+        self.loaded_at = time.time()
+        self.lock = threading.Lock()
+        self._aggs = OrderedDict()       # Filters → {名稱: 合併後的部分彙總}
+
+    def refreshed(self) -> "PartitionedBase":
+        """manifest 換版了就回傳新版本的 PartitionedBase（進行中的查詢繼續用舊物件），否則回傳自己"""
+        m = read_manifest(self.root)
+        if m is None or m["version"] == self.version:
+            return self
+        return PartitionedBase(self.root)
+
+    @property
+    def version(self) -> str:
+        return self.manifest["version"]
+
+    def partitions(self, f: A.Filters) -> list[dict]:
+        """日期條件可能命中的分區（訂單日看月份，退貨日看分區內退貨日的上下界）"""
+        out = []
+        for part in self.manifest["partitions"]:
+            ym = part["month"]
+            if ym == NO_DATE:
+                if f.order_from or f.order_to:
+                    continue
+            else:
+                b = month_bounds(ym)
+                if f.order_from and b["b"] <= f.order_from[:10]:
+                    continue
+                if f.order_to and b["a"] >= f.order_to:
+                    continue
+            lo, hi = part["returndate"]
+            if f.return_from or f.return_to:
+                if lo is None:
+                    continue                 # 分區內沒有退貨：退貨日條件一定不成立
+                if f.return_from and pd.Timestamp(hi) < pd.Timestamp(f.return_from):
+                    continue
+                if f.return_to and pd.Timestamp(lo) >= pd.Timestamp(f.return_to):
+                    continue
+            out.append(part)
+        return out
+
+    def load(self, part: dict) -> pd.DataFrame:
+        df = load_snapshot(os.path.join(self.root, self.manifest["dir"], part["month"]), self.version)
+        if df is None:
+            raise FileNotFoundError(f"分區 {part['month']} 遺失或版本不符，請重新 build")
+        return df
+
+    def map_reduce(self, f: A.Filters, fn, reduce=concat_frames):
+        """每個命中的分區：載入 → 篩選 → fn；結果 list 交給 reduce 合併。一次只持有一個分區的明細"""
+        results = []
+        for part in self.partitions(f):
+            df = self.load(part)
+            sub = df if f == A.Filters() else A.apply_filters(df, f)
+            results.append(fn(sub))
+            del df, sub
+        if not results and self.manifest["partitions"]:   # 全部剪掉：回傳同欄位的空結果
+            results.append(fn(self.load(self.manifest["partitions"][0]).iloc[:0]))
+        return reduce(results)
+
+    def aggregate(self, f: A.Filters, names=tuple(PARTIALS)) -> dict[str, pd.DataFrame]:
+        """
+        {名稱: 合併後的部分彙總}。某組篩選條件第一次查時每個分區只讀一次、一次算完全部 PARTIALS，
+        結果保留 AGG_CACHE 組，同一請求的各面板共用（回傳值不可原地修改）。
+        儀表板的面板在多個 thread 上同時要：持鎖計算，先到的算、其餘等它算好再直接取。
+        """
+        with self.lock:
+            aggs = self._aggs.get(f)
+            if aggs is None:
+                aggs = self._aggs[f] = self.map_reduce(
+                    f, lambda d: {n: partial(d, n) for n in PARTIALS},
+                    lambda results: {n: merge_partials([r[n] for r in results], n) for n in PARTIALS})
+                while len(self._aggs) > AGG_CACHE:
+                    self._aggs.popitem(last=False)
+            else:
+                self._aggs.move_to_end(f)
+        return {n: aggs[n] for n in names}
+
+    def info(self) -> dict:
+        parts = self.manifest["partitions"]
+        return {"version": self.version, "partitions": len(parts),
+                "rows": sum(p["rows"] for p in parts),
+                "months": [parts[0]["month"], parts[-1]["month"]] if parts else None,
+                "created_at": self.manifest.get("created_at"), "build_seconds": self.manifest.get("seconds")}
+
+# ===== 面板（參數與回傳同 analytic.py / rollup.py 的同名函式） =====
+def kpi_cards(ds: PartitionedBase, f: A.Filters) -> dict:
+    return A.kpi_cards(ds.aggregate(f, ["lag"])["lag"])
+
+def lag_stats(ds: PartitionedBase, f: A.Filters) -> pd.DataFrame:
+    """原因 × 時滯的次數表就是精確的時滯分布（時滯為整數天），結果與明細版相同"""
+    return A.lag_stats(ds.aggregate(f, ["lag"])["lag"])
+
+def event_return_rate(ds: PartitionedBase, f: A.Filters, freq: str = "D"):
+    """銷售依訂單日、退貨依退貨日，兩份每日彙總各自換成期別後加總"""
+    if freq not in A.TREND_LABELS:
+        raise ValueError("freq must be 'D'|'W'|'M'")
+    parts = ds.aggregate(f, ["sales", "returns"])
+    def by_period(d, col, value):
+        dates = pd.to_datetime(d[col])
+        return d.groupby(A.trend_key(dates, dates.dt.to_period("M"), freq))[value].sum()
+    return A.trend_figure(by_period(parts["sales"], "orderdate", "sell_qty"),
+                          by_period(parts["returns"], "returndate", "return_qty"), freq)
+
+def reason_l1_share(ds: PartitionedBase, f: A.Filters):
+    return A.reason_l1_share(ds.aggregate(f, ["lag"])["lag"])
+
+def heatmap(ds: PartitionedBase, f: A.Filters, level: str = "category3"):
+    if level not in ("category1", "category2", "category3"):
+        raise ValueError("level must be category1|category2|category3")
+    return A.heatmap(ds.aggregate(f, ["category"])["category"], level)
+
+def loss_by_reason(ds: PartitionedBase, f: A.Filters, level="l1") -> pd.DataFrame:
+    name = "lag" if level == "l1" else "tags"
+    return A.loss_by_reason(ds.aggregate(f, [name])[name], level)
+
+def summary_table(ds: PartitionedBase, f: A.Filters) -> pd.DataFrame:
+    return A.summary_table(ds.aggregate(f, ["product"])["product"])
+
+def scatter_quadrant(ds: PartitionedBase, f: A.Filters):
+    """結果的 (商品表, 圖, 銷售額中位數, 退貨率中位數) 直接交給 analytic.quadrant_matrix"""
+    return A.scatter_quadrant(ds.aggregate(f, ["product"])["product"])
+
+def top5_per_reason(ds: PartitionedBase, f: A.Filters, n: int = 5, denom: str = "total") -> pd.DataFrame:
+    return A.top5_per_reason(ds.aggregate(f, ["product_reason"])["product_reason"], n, denom)
+
+def tag_heatmap(ds: PartitionedBase, f: A.Filters, level: str = "category3", value: str = "return_qty",
+                top: int | None = 30):
+    if level not in ("category2", "category3", "barcode"):
+        raise ValueError("level must be category2|category3|barcode")
+    return A.tag_heatmap(ds.aggregate(f, ["product_tags"])["product_tags"], level, value, top)
+
+def row_count(ds: PartitionedBase, f: A.Filters) -> int:
+    """符合條件的明細列數"""
+    return int(ds.aggregate(f, ["lag"])["lag"]["rows"].sum())
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="base 明細月分區（out-of-core）")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    b = sub.add_parser("build", help="逐月建置分區")
+    b.add_argument("--force", action="store_true", help="版本沒變也重建")
+    b.add_argument("--sqlite", help="改用 SQLite 檔（本機測試；版本改用時間戳）")
+    sub.add_parser("info", help="顯示目前分區")
+    s = sub.add_parser("summary", help="依篩選條件跑 KPI 與時滯統計")
+    for name in ("order-from", "order-to", "return-from", "return-to"):
+        s.add_argument(f"--{name}")
+    for name in ("productid", "category2", "category3", "reason"):
+        s.add_argument(f"--{name}", nargs="*")
+    args = ap.parse_args(argv)
+
+    if args.cmd == "build":
+        eng = sqlite_engine(args.sqlite) if args.sqlite else get_engine()
+        version = f"sqlite-{int(os.path.getmtime(args.sqlite))}" if args.sqlite else None
+        m = build_partitions(eng, version=version, force=args.force)
+        print(f"[partitions] 版本 {m['version']}：{len(m['partitions'])} 個分區，"
+              f"{sum(p['rows'] for p in m['partitions']):,} 列，{m.get('seconds')}s")
+        return 0
+    ds = PartitionedBase()
+    if args.cmd == "info":
+        print(json.dumps(ds.info(), ensure_ascii=False, indent=2))
+        return 0
+    f = A.Filters(productid=args.productid, category2=args.category2, category3=args.category3,
+                  reason_l1=args.reason, order_from=args.order_from, order_to=args.order_to,
+                  return_from=args.return_from, return_to=args.return_to)
+    t0 = time.perf_counter()
+    lag = ds.aggregate(f, ["lag"])["lag"]
+    print(f"分區 {len(ds.partitions(f))}/{len(ds.manifest['partitions'])}，原因 × 時滯 {len(lag):,} 格，"
+          f"{time.perf_counter() - t0:.1f}s")
+    print(A.kpi_cards(lag))
+    with pd.option_context("display.width", 200):
+        print(A.lag_stats(lag).to_string(index=False))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
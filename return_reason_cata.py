@@ -1,11 +1,34 @@
 import re
 import json
+import hashlib
+import sys
+import csv
+import math
+import time
+import random
+import atexit
+import argparse
+import threading
+import multiprocessing as mp
 import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+try:
+    from re import _parser as sre_parse, _constants as sre_c   # Python 3.11+
+except ImportError:                                             # pragma: no cover
+    import sre_parse, sre_constants as sre_c
 
 '''
     1.同義詞映射
     2.L2 細分類規則
     3.分類優先順序
+    4.規則引擎：import 時編譯一次（同義詞 regex、關鍵字 trie 預篩、預編譯 pattern）
+    5.classify_many：批次去重 + 跨呼叫 LRU 快取（規則變動自動失效）
+    6.classify_many(workers=N)：大量回填時分片給多個 process，各自編譯一次規則
+    7.規則剖析 / lint：每條規則的耗時與命中、對抗長輸入的成長曲線、新規則的時間預算檢查
+Usage:
+  python return_reason_cata.py profile data/returns.csv [--column reason]
+  python return_reason_cata.py lint [--budget-ms 20] [--length 1000]
 '''
 # 正規化：全半形、去雜訊、同義詞映射
 SYNONYMS = {
@@ -15,11 +38,7 @@ SYNONYMS = {
     "降價": "促銷", "打折": "促銷", "折扣": "促銷",
 }
 def normalize(text: str) -> str:
-    if not isinstance(text, str): return ""
-    t = unicodedata.normalize("NFKC", text).lower()
-    t = re.sub(r"\s+", "", t)
-    for k,v in SYNONYMS.items(): t = t.replace(k, v)
-    return t
+    return _engine().normalize(text)
 
 # L2 細分類規則
 # L2 規則：每條規則 = 一個「更細的標籤」
@@ -83,41 +102,528 @@ RULES = [
 
 PRIORITY = ["瑕疵因素","物流/包裝","尺寸/版型","材質/舒適度","顏色因素","設計/期待落差","活動因素","個人因素"]
 
+# ===== 規則引擎 =====
+def rules_fingerprint(rules=None, synonyms=None, priority=None) -> str:
+    """規則集指紋：RULES / SYNONYMS / PRIORITY 任一變動，指紋就不同"""
+    payload = json.dumps([RULES if rules is None else rules,
+                          SYNONYMS if synonyms is None else synonyms,
+                          PRIORITY if priority is None else priority],
+                         ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+
+def _literal_anchors(items):
+    """
+    由 sre 解析樹推出「必要字面字串」集合：任何一次匹配一定包含其中之一。
+    串接 → 取任一必要元素（挑最長、最少的那組）；分支 → 各分支聯集；推不出來回傳 None。
+    """
+    cands, run = [], []
+    def flush():
+        if run:
+            cands.append({"".join(run)})
+            run.clear()
+    for op, av in items:
+        if op is sre_c.LITERAL:
+            run.append(chr(av))
+            continue
+        flush()
+        sub = None
+        if op is sre_c.SUBPATTERN:
+            sub = _literal_anchors(av[-1])
+        elif op is sre_c.BRANCH:
+            parts = [_literal_anchors(b) for b in av[1]]
+            sub = set().union(*parts) if parts and all(parts) else None
+        elif op is sre_c.IN:
+            if all(o is sre_c.LITERAL for o, _ in av):
+                sub = {chr(v) for _, v in av}
+        elif op in (sre_c.MAX_REPEAT, sre_c.MIN_REPEAT) and av[0] >= 1:
+            sub = _literal_anchors(av[2])
+        if sub:
+            cands.append(sub)
+    flush()
+    if not cands:
+        return None
+    return max(cands, key=lambda c: (min(map(len, c)), -len(c)))
+
+def rule_anchors(pattern: str):
+    """單一 pattern 的預篩關鍵字；含 flag 或無法推導時回傳 None（永遠要跑）"""
+    try:
+        tree = sre_parse.parse(pattern)
+    except re.error:
+        return None
+    if tree.state.flags & (re.IGNORECASE | re.VERBOSE):
+        return None
+    anchors = _literal_anchors(list(tree))
+    return anchors if anchors and all(anchors) else None
+
+class RuleEngine:
+    """
+    classify_reason 的編譯版：輸出與逐條 re.finditer 完全相同。
+    - 同義詞：先用一條 regex 判斷有沒有同義詞，有才依 SYNONYMS 順序逐一 replace（保留原本的串接語意）
+    - 預篩：各規則的必要關鍵字建成 trie，一次掃描找出「可能命中」的規則，只跑這些
+    - pattern 預先 compile
+    """
+    def __init__(self, rules, synonyms, priority):
+        self.rules = [dict(r) for r in rules]
+        self.synonyms = list(synonyms.items())
+        self.priority = list(priority)
+        self.fingerprint = rules_fingerprint(rules, synonyms, priority)
+        self.categories = set(r["category"] for r in self.rules)
+        self.compiled = [re.compile(r["pattern"]) for r in self.rules]
+        self._ws = re.compile(r"\s+")
+        keys = sorted((k for k, _ in self.synonyms), key=len, reverse=True)
+        self._syn = re.compile("|".join(map(re.escape, keys))) if keys else None
+
+        self.always = []             # 推不出關鍵字的規則：每次都跑
+        self.trie = {}
+        for i, r in enumerate(self.rules):
+            anchors = rule_anchors(r["pattern"])
+            if anchors is None:
+                self.always.append(i)
+                continue
+            for a in anchors:
+                node = self.trie
+                for ch in a:
+                    node = node.setdefault(ch, {})
+                node.setdefault(None, set()).add(i)
+
+    def normalize(self, text: str) -> str:
+        if not isinstance(text, str): return ""
+        t = unicodedata.normalize("NFKC", text).lower()
+        t = self._ws.sub("", t)
+        if self._syn is not None and self._syn.search(t):
+            for k, v in self.synonyms:
+                if k in t: t = t.replace(k, v)
+        return t
+
+    def candidates(self, t: str):
+        """trie 掃描：回傳關鍵字有出現的規則 index（依 RULES 順序）"""
+        hit = set(self.always)
+        trie = self.trie
+        for i in range(len(t)):
+            node = trie
+            for ch in t[i:]:
+                node = node.get(ch)
+                if node is None:
+                    break
+                rs = node.get(None)
+                if rs:
+                    hit |= rs
+        return sorted(hit)
+
+    def classify_normalized(self, t: str):
+        cat_scores = {c:0 for c in self.categories}
+        tags_l2 = []               # 更細標籤
+        matches = []               # 關鍵字命中詳情
+
+        for i in self.candidates(t):
+            rule = self.rules[i]
+            for m in self.compiled[i].finditer(t):
+                cat_scores[rule["category"]] += 1
+                tags_l2.append(rule["tag"])
+                matches.append({
+                    "category": rule["category"],
+                    "tag": rule["tag"],
+                    "pattern": rule["pattern"],
+                    "text": m.group(0),
+                    "start": m.start(),
+                    "end": m.end()
+                })
+
+        # 去重並保序
+        tags_l2 = list(dict.fromkeys(tags_l2))
+
+        # 主分類：最高分；若並列，用 PRIORITY
+        if any(cat_scores.values()):
+            max_s = max(cat_scores.values())
+            tied = [c for c,s in cat_scores.items() if s==max_s and s>0]
+            primary = sorted(tied, key=lambda c: self.priority.index(c))[0]
+        else:
+            primary = "其他"
+
+        return primary, tags_l2, matches
+
+    def classify(self, text: str):
+        return self.classify_normalized(self.normalize(text))
+
+_ENGINE = None
+def compile_rules():
+    """依目前的 RULES / SYNONYMS / PRIORITY 重建引擎（改規則後呼叫）"""
+    global _ENGINE
+    _ENGINE = RuleEngine(RULES, SYNONYMS, PRIORITY)
+    return _ENGINE
+
+def _engine(check=False):
+    """check=True 時比對指紋，規則被改過就重建（成本是一次 json.dumps，批次呼叫才做）"""
+    if _ENGINE is None or (check and _ENGINE.fingerprint != rules_fingerprint()):
+        return compile_rules()
+    return _ENGINE
+
 # 分類優先順序
 def classify_reason(text: str):
-    t = normalize(text)
-    cat_scores = {c:0 for c in set(r["category"] for r in RULES)}
-    tags_l2 = []               # 更細標籤
-    matches = []               # 關鍵字命中詳情
-
-    for rule in RULES:
-        for m in re.finditer(rule["pattern"], t):
-            cat_scores[rule["category"]] += 1
-            tags_l2.append(rule["tag"])
-            matches.append({
-                "category": rule["category"],
-                "tag": rule["tag"],
-                "pattern": rule["pattern"],
-                "text": m.group(0),
-                "start": m.start(),
-                "end": m.end()
-            })
-
-    # 去重並保序
-    def dedupe(seq): 
-        seen=set(); out=[]
-        for x in seq:
-            if x not in seen:
-                seen.add(x); out.append(x)
-        return out
-    tags_l2 = dedupe(tags_l2)
-
-    # 主分類：最高分；若並列，用 PRIORITY
-    if any(cat_scores.values()):
-        max_s = max(cat_scores.values())
-        tied = [c for c,s in cat_scores.items() if s==max_s and s>0]
-        primary = sorted(tied, key=lambda c: PRIORITY.index(c))[0]
+    # 單筆呼叫不檢查指紋（太貴）；執行期改了 RULES 請呼叫 compile_rules()，classify_many 會自動偵測
+    return _engine().classify(text)
+
+# ===== 批次分類 + LRU =====
+class ReasonCache:
+    """正規化後字串 → 分類結果 的 LRU；綁定規則指紋，指紋不同即整批失效"""
+    def __init__(self, maxsize=100_000):
+        self.maxsize = maxsize
+        self.fingerprint = None
+        self.lock = threading.Lock()
+        self._d = OrderedDict()
+        self.hits = self.misses = self.rows = 0
+
+    def clear(self, fingerprint=None):
+        self._d.clear()
+        self.fingerprint = fingerprint
+        self.hits = self.misses = self.rows = 0
+
+    def get(self, key):
+        r = self._d.get(key)
+        if r is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._d.move_to_end(key)
+        return r
+
+    def put(self, key, value):
+        self._d[key] = value
+        if len(self._d) > self.maxsize:
+            self._d.popitem(last=False)
+
+    def info(self) -> dict:
+        looked = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hits / looked, 4) if looked else 0.0,
+                "rows": self.rows, "classified": self.misses,
+                "size": len(self._d), "maxsize": self.maxsize,
+                "fingerprint": self.fingerprint}
+
+_CACHE = ReasonCache()
+
+def classify_many(texts, use_cache=True, workers=None):
+    """
+    批次分類：先正規化，同一個正規化字串只分類一次，再依輸入順序展開。
+    跨呼叫保留 LRU 快取；RULES / SYNONYMS / PRIORITY 變動時自動清空。
+    workers > 1：正規化與查快取在本 process，未命中的字串分片給 process pool 分類，輸出順序不變。
+    回傳 list[(primary, tags_l2, matches)]；相同原因共用同一個結果物件，請勿原地修改。
+    """
+    eng = _engine(check=True)
+    if workers and workers > 1:
+        try:
+            return _classify_parallel(texts, eng, workers, use_cache)
+        except TypeError:            # 有不可 hash 的輸入，退回單 process
+            pass
+    with _CACHE.lock:
+        if _CACHE.fingerprint != eng.fingerprint:
+            _CACHE.clear(eng.fingerprint)
+        norm_of, keys = {}, []
+        for x in texts:
+            try:
+                k = norm_of[x]
+            except KeyError:
+                k = norm_of[x] = eng.normalize(x)
+            except TypeError:        # 不可 hash 的輸入
+                k = eng.normalize(x)
+            keys.append(k)
+        _CACHE.rows += len(keys)
+
+        results = {}
+        for k in dict.fromkeys(keys):
+            r = _CACHE.get(k) if use_cache else None
+            if r is None:
+                r = eng.classify_normalized(k)
+                if use_cache:
+                    _CACHE.put(k, r)
+            results[k] = r
+        return [results[k] for k in keys]
+
+def classify_cache_info() -> dict:
+    """快取命中統計：hit_rate = 命中 / 查詢（以去重後字串計）；classified / rows = 實際分類比例"""
+    with _CACHE.lock:
+        return _CACHE.info()
+
+def clear_classify_cache():
+    with _CACHE.lock:
+        _CACHE.clear()
+
+# ===== 多 process 分類 =====
+_W_ENGINE = None     # worker 內的引擎（initializer 建一次）
+_POOL = None         # (workers, fingerprint, executor)；跨呼叫重用，規則變了就重開
+
+def _init_worker(rules, synonyms, priority):
+    global _W_ENGINE
+    _W_ENGINE = RuleEngine(rules, synonyms, priority)
+
+def _classify_shard(keys):
+    """worker：分類一個分片（已正規化、已去重、快取沒命中的字串）"""
+    eng = _W_ENGINE
+    return [eng.classify_normalized(k) for k in keys]
+
+def _get_pool(workers, eng):
+    global _POOL
+    if _POOL is not None and _POOL[:2] == (workers, eng.fingerprint):
+        return _POOL[2]
+    shutdown_pool()
+    ex = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(eng.rules, dict(eng.synonyms), eng.priority))
+    _POOL = (workers, eng.fingerprint, ex)
+    return ex
+
+def shutdown_pool():
+    global _POOL
+    if _POOL is not None:
+        _POOL[2].shutdown()
+        _POOL = None
+
+atexit.register(shutdown_pool)
+
+def _classify_parallel(texts, eng, workers, use_cache):
+    """
+    正規化在主 process 做（與單 process 路徑同一把快取鍵），先查快取，
+    只把沒命中的字串分片給 worker；結果寫回快取。
+    """
+    key_of = {x: eng.normalize(x) for x in dict.fromkeys(texts)}
+    results = {}
+    with _CACHE.lock:
+        if _CACHE.fingerprint != eng.fingerprint:
+            _CACHE.clear(eng.fingerprint)
+        _CACHE.rows += len(texts)
+        for k in dict.fromkeys(key_of.values()):
+            results[k] = _CACHE.get(k) if use_cache else None
+    todo = [k for k, r in results.items() if r is None]
+    # 每個 worker 約 4 片，負載較平均；太小的分片不划算（少量未命中就在本 process 分類）
+    size = max(1000, -(-len(todo) // (workers * 4)))
+    shards = [todo[i:i + size] for i in range(0, len(todo), size)]
+    if len(shards) <= 1:
+        done = [eng.classify_normalized(k) for k in todo]
+    else:
+        done = [r for part in _get_pool(workers, eng).map(_classify_shard, shards) for r in part]
+    results.update(zip(todo, done))
+    if use_cache and todo:
+        with _CACHE.lock:
+            if _CACHE.fingerprint == eng.fingerprint:
+                for k, r in zip(todo, done):
+                    _CACHE.put(k, r)
+    return [results[key_of[x]] for x in texts]
+
+# ===== 規則剖析 / 回溯防護 =====
+LINT_LENGTH = 1000        # 對抗輸入長度（模擬客服工具貼進來的長文）
+LINT_BUDGET_MS = 20.0     # 單條規則在 LINT_LENGTH 對抗輸入上的時間上限
+SUPERLINEAR = 1.5         # 成長指數（log 時間 / log 長度）超過此值視為超線性
+LEN_BUCKETS = (32, 128, 512)
+
+def _pattern_chars(items, out):
+    """收集 pattern 中出現的所有字面字元（組對抗輸入用）"""
+    for op, av in items:
+        if op is sre_c.LITERAL:
+            out.add(chr(av))
+        elif op is sre_c.SUBPATTERN:
+            _pattern_chars(av[-1], out)
+        elif op is sre_c.BRANCH:
+            for b in av[1]: _pattern_chars(b, out)
+        elif op is sre_c.IN:
+            out.update(chr(v) for o, v in av if o is sre_c.LITERAL)
+        elif op in (sre_c.MAX_REPEAT, sre_c.MIN_REPEAT):
+            _pattern_chars(av[2], out)
+    return out
+
+def adversarial_inputs(pattern: str, length: int = LINT_LENGTH, seed: int = 0) -> dict:
+    """
+    針對單一 pattern 的最壞情況輸入（長度 length）：
+    - repeat：關鍵字重複（(X).*(Y) 型在沒有 Y 時每個 X 都會掃到結尾 → O(n²)）
+    - anchor+noise：一個關鍵字後面接 pattern 內的字元亂序（誘發部分匹配與回溯）
+    - noise：只有 pattern 內的字元
+    """
+    rnd = random.Random(seed)
+    anchors = sorted(rule_anchors(pattern) or [], key=len) or ["a"]
+    chars = sorted(_pattern_chars(list(sre_parse.parse(pattern)), set())) or ["a"]
+    noise = "".join(rnd.choice(chars) for _ in range(length))
+    out = {}
+    for a in anchors[:3]:
+        out[f"repeat:{a}"] = (a * (length // len(a) + 1))[:length]
+    out["anchor+noise"] = (anchors[0] + noise)[:length]
+    out["noise"] = noise
+    return out
+
+def _time_finditer(rx, s, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in rx.finditer(s):
+            pass
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+def growth_curve(pattern: str, length: int = LINT_LENGTH, budget_ms: float = LINT_BUDGET_MS):
+    """
+    對抗輸入長度由 16 倍增到 length，回傳 (最差輸入名, [(長度, 毫秒)], 成長指數)。
+    某一點超過預算 10 倍就停止加長（指數型回溯再加長會卡死）。
+    """
+    rx = re.compile(pattern)
+    worst = (None, [(0, 0.0)], 0.0)
+    for name, s in adversarial_inputs(pattern, length).items():
+        pts, n = [], 16
+        while True:
+            n = min(n, length)
+            ms = _time_finditer(rx, s[:n]) * 1000
+            pts.append((n, ms))
+            if n >= length or ms > budget_ms * 10:
+                break
+            n *= 2
+        if pts[-1][1] > worst[1][-1][1]:
+            worst = (name, pts, 0.0)
+    name, pts, _ = worst
+    # 成長指數：取最後兩個量得到時間的點（太短的時間是雜訊）
+    sig = [(n, ms) for n, ms in pts if ms > 0.02]
+    exp = 0.0
+    if len(sig) >= 2:
+        (n1, t1), (n2, t2) = sig[-2], sig[-1]
+        exp = math.log(t2 / t1) / math.log(n2 / n1) if n2 > n1 and t1 > 0 else 0.0
+    return name, pts, round(exp, 2)
+
+def _growth_child(pattern, length, budget_ms, q):
+    try:
+        q.put(("ok", growth_curve(pattern, length, budget_ms)))
+    except Exception as e:                 # pattern 編譯失敗等
+        q.put(("error", repr(e)))
+
+def growth_isolated(pattern, length=LINT_LENGTH, budget_ms=LINT_BUDGET_MS, timeout=None):
+    """
+    在子 process 跑 growth_curve，逾時就砍掉（re 無法中斷，災難性回溯只能這樣防）。
+    回傳 ("ok", 結果) / ("timeout", None) / ("error", 訊息)
+    """
+    timeout = timeout or max(5.0, budget_ms * 100 / 1000)
+    ctx = mp.get_context()
+    q = ctx.Queue()
+    p = ctx.Process(target=_growth_child, args=(pattern, length, budget_ms, q), daemon=True)
+    p.start()
+    p.join(timeout)
+    if p.is_alive():
+        p.terminate(); p.join()
+        return "timeout", None
+    return q.get() if not q.empty() else ("error", f"exit code {p.exitcode}")
+
+def profile_rules(texts, engine=None):
+    """
+    以實際語料跑一遍引擎（含 trie 預篩），統計每條規則：
+    呼叫次數、命中數、總耗時、最差一次的耗時與輸入長度、各長度區間平均耗時。
+    """
+    eng = engine or _engine(check=True)
+    stats = [{"i": i, "category": r["category"], "tag": r["tag"], "calls": 0, "hits": 0,
+              "total_ms": 0.0, "worst_us": 0.0, "worst_len": 0,
+              "by_len": {b: [0, 0.0] for b in LEN_BUCKETS + (None,)}}
+             for i, r in enumerate(eng.rules)]
+    clock = time.perf_counter_ns
+    for x in texts:
+        t = eng.normalize(x)
+        bucket = next((b for b in LEN_BUCKETS if len(t) < b), None)
+        for i in eng.candidates(t):
+            t0 = clock()
+            hits = sum(1 for _ in eng.compiled[i].finditer(t))
+            us = (clock() - t0) / 1000
+            st = stats[i]
+            st["calls"] += 1
+            st["hits"] += hits
+            st["total_ms"] += us / 1000
+            if us > st["worst_us"]:
+                st["worst_us"], st["worst_len"] = us, len(t)
+            b = st["by_len"][bucket]
+            b[0] += 1; b[1] += us
+    return sorted(stats, key=lambda s: s["total_ms"], reverse=True)
+
+def lint_rule(rule: dict, budget_ms: float = LINT_BUDGET_MS, length: int = LINT_LENGTH) -> list:
+    """檢查單條規則，回傳問題清單（空 = 通過）"""
+    problems = []
+    missing = {"category", "tag", "pattern"} - set(rule)
+    if missing:
+        return [f"缺少欄位 {sorted(missing)}"]
+    if rule["category"] not in PRIORITY:
+        problems.append(f"category「{rule['category']}」不在 PRIORITY")
+    try:
+        re.compile(rule["pattern"])
+    except re.error as e:
+        return problems + [f"pattern 無法編譯：{e}"]
+    status, res = growth_isolated(rule["pattern"], length, budget_ms)
+    if status == "timeout":
+        problems.append("對抗輸入逾時（疑似災難性回溯）")
+    elif status == "error":
+        problems.append(f"量測失敗：{res}")
     else:
-        primary = "其他"
+        name, pts, exp = res
+        n, ms = pts[-1]
+        if n < length or ms > budget_ms:
+            problems.append(f"超過時間預算：{name} 長度 {n} 耗時 {ms:.1f}ms（上限 {budget_ms}ms @ {length}）")
+    return problems
+
+def lint_rules(rules=None, budget_ms: float = LINT_BUDGET_MS, length: int = LINT_LENGTH) -> dict:
+    """{規則 index: 問題清單}，只列出有問題的規則"""
+    rules = RULES if rules is None else rules
+    out = {}
+    for i, r in enumerate(rules):
+        p = lint_rule(r, budget_ms, length)
+        if p:
+            out[i] = p
+    return out
+
+def add_rule(rule: dict, budget_ms: float = LINT_BUDGET_MS, length: int = LINT_LENGTH):
+    """新增規則前先 lint；不通過就 raise ValueError，通過才加入 RULES 並重建引擎"""
+    problems = lint_rule(rule, budget_ms, length)
+    if problems:
+        raise ValueError(f"規則「{rule.get('tag')}」未通過檢查：" + "；".join(problems))
+    RULES.append(dict(rule))
+    compile_rules()
+
+def _read_corpus(path, column="reason"):
+    if path.lower().endswith(".csv"):
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            return [row.get(column, "") for row in csv.DictReader(f)]
+    with open(path, encoding="utf-8-sig") as f:
+        return [line.rstrip("\n") for line in f]
+
+def print_profile(stats, growth=True, length=LINT_LENGTH, budget_ms=LINT_BUDGET_MS):
+    print(f"{'#':>3} {'tag':<14} {'calls':>8} {'hits':>7} {'total ms':>9} {'avg us':>7} "
+          f"{'worst us@len':>14} {'len<32/128/512/+ avg us':>26} {'growth':>7}  flag")
+    for st in stats:
+        avg = st["total_ms"] * 1000 / st["calls"] if st["calls"] else 0.0
+        by = "/".join(f"{(b[1] / b[0]) if b[0] else 0:.0f}" for b in st["by_len"].values())
+        flag, exp = "", ""
+        if growth:
+            status, res = growth_isolated(RULES[st["i"]]["pattern"], length, budget_ms)
+            if status == "timeout":
+                exp, flag = "∞", "超線性（逾時）"
+            elif status == "ok":
+                exp = f"{res[2]:.2f}"
+                if res[2] > SUPERLINEAR:
+                    flag = f"超線性（{res[0]}）"
+        print(f"{st['i']:>3} {st['tag']:<14} {st['calls']:>8} {st['hits']:>7} {st['total_ms']:>9.2f} {avg:>7.1f} "
+              f"{st['worst_us']:>8.0f}@{st['worst_len']:<5} {by:>26} {exp:>7}  {flag}")
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="退貨原因規則：效能剖析 / lint")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("profile", help="以語料剖析各規則耗時、命中與成長曲線")
+    p.add_argument("corpus", help="CSV（取 --column 欄）或一行一筆的文字檔")
+    p.add_argument("--column", default="reason")
+    p.add_argument("--no-growth", action="store_true", help="不做對抗輸入成長測試")
+    p.add_argument("--length", type=int, default=LINT_LENGTH)
+    l = sub.add_parser("lint", help="所有規則跑時間預算檢查（CI 用，不通過 exit 1）")
+    l.add_argument("--budget-ms", type=float, default=LINT_BUDGET_MS)
+    l.add_argument("--length", type=int, default=LINT_LENGTH)
+    args = ap.parse_args(argv)
+
+    if args.cmd == "profile":
+        texts = _read_corpus(args.corpus, args.column)
+        stats = profile_rules(texts)
+        print(f"[profile] {len(texts):,} 筆，規則 {len(RULES)} 條")
+        print_profile(stats, growth=not args.no_growth, length=args.length)
+        return 0
+    bad = lint_rules(budget_ms=args.budget_ms, length=args.length)
+    for i, problems in bad.items():
+        print(f"[lint] #{i} {RULES[i]['tag']}：" + "；".join(problems))
+    print(f"[lint] {len(RULES) - len(bad)}/{len(RULES)} 條通過（{args.budget_ms}ms @ {args.length} 字）")
+    return 1 if bad else 0
 
-    return primary, tags_l2, matches
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())
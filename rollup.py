@@ -0,0 +1,320 @@
+import os, sys, json, time, hashlib, argparse
+from datetime import timedelta
+import pandas as pd
+from sqlalchemy import create_engine, inspect, text, bindparam
+from sqlalchemy.engine import URL
+from dotenv import load_dotenv
+import analytic as A
+
+'''
+    儀表板的 SQL 彙總下推（選用）：
+      rollup_daily：訂單日 × 退貨日 × barcode × 原因(L1) × 時滯 的筆數 / 銷售 / 退貨 / 金額
+      rollup_tags ：同上粒度 × L2 標籤 的退貨件數與金額
+    kpi_cards / event_return_rate / heatmap / reason_l1_share / loss_by_reason 依 Filters 直接查彙總表，
+    查回的小表欄名與 base 明細相同，統計與畫圖沿用 analytic.py 的函式。
+    增量刷新：以 data_version 判斷哪些來源表變了，依寫入端記下的 data_change 只重算受影響的訂單日
+    （新訂單、改價、重分類、刪除的退貨都會記錄）；某個版本沒有紀錄、紀錄是整張表、
+    規則集（rule_fp）變了、或帶 --full 則整表重建。
+    engine 可以是 MySQL 或 SQLite（sqlite_engine()，本機測試用）。
+Usage:
+  python rollup.py refresh [--full] [--sqlite PATH]
+'''
+load_dotenv()
+DB_CONFIG = {
+    "host": os.getenv("DB_HOST"),
+    "port": int(os.getenv("DB_PORT", "3306")),
+    "user": os.getenv("DB_USER"),
+    "password": os.getenv("DB_PASSWORD"),
+    "database": os.getenv("DB_NAME"),
+}
+
+DAILY, TAGS, STATE = "rollup_daily", "rollup_tags", "rollup_state"
+ROLLUP_DDL = {
+    DAILY: """CREATE TABLE IF NOT EXISTS rollup_daily (
+        order_day    DATE        NOT NULL,
+        return_day   DATE        NULL,
+        barcode      VARCHAR(32) NOT NULL,
+        reason_cat   VARCHAR(64) NULL,
+        lag_days     INT         NULL,
+        n_rows       BIGINT      NOT NULL,
+        sell_qty     BIGINT      NOT NULL,
+        return_qty   BIGINT      NOT NULL,
+        sales_amount DOUBLE      NULL,
+        loss_amount  DOUBLE      NULL)""",
+    TAGS: """CREATE TABLE IF NOT EXISTS rollup_tags (
+        order_day    DATE        NOT NULL,
+        return_day   DATE        NULL,
+        barcode      VARCHAR(32) NOT NULL,
+        reason_cat   VARCHAR(64) NULL,
+        tag          VARCHAR(64) NOT NULL,
+        n_rows       BIGINT      NOT NULL,
+        return_qty   BIGINT      NOT NULL,
+        loss_amount  DOUBLE      NULL)""",
+    STATE: """CREATE TABLE IF NOT EXISTS rollup_state (
+        name           VARCHAR(64) NOT NULL PRIMARY KEY,
+        last_orderdate DATETIME    NULL,
+        last_return_id BIGINT      NULL,
+        rule_sig       VARCHAR(64) NULL,
+        refreshed_at   DATETIME    NULL,
+        source_versions VARCHAR(1024) NULL)""",
+}
+# 彙總表讀的來源表（reason_tag 只增不改：INSERT IGNORE、tag_id 不變，不必追）
+ROLLUP_SOURCES = ["product", "orders", "returns_clean", "return_tags"]
+ROLLUP_INDEXES = {
+    DAILY: [("idx_rd_order", ["order_day"]), ("idx_rd_return", ["return_day"]), ("idx_rd_barcode", ["barcode"])],
+    TAGS:  [("idx_rtg_order", ["order_day"]), ("idx_rtg_barcode", ["barcode"])],
+}
+# 方言差異：時滯（天）
+LAG_SQL = {
+    "mysql":  "TIMESTAMPDIFF(DAY, o.orderdate, r.returndate)",
+    "sqlite": "CAST(julianday(r.returndate) - julianday(o.orderdate) AS INTEGER)",
+}
+REASON_SQL = "CASE WHEN r.return_id IS NULL THEN NULL ELSE COALESCE(r.reason_category_l1, '其他') END"
+
+DAILY_SELECT = """
+    SELECT DATE(o.orderdate), DATE(r.returndate), o.barcode, {reason}, {lag},
+           COUNT(*), SUM(o.sell_qty), SUM(COALESCE(r.return_qty, 0)),
+           SUM(o.sell_qty * p.sellprice), SUM(COALESCE(r.return_qty, 0) * p.sellprice)
+    FROM orders o
+    LEFT JOIN returns_clean r ON r.orderid = o.orderid AND r.barcode = o.barcode
+    LEFT JOIN product p ON p.barcode = o.barcode
+    {where}
+    GROUP BY 1, 2, 3, 4, 5"""
+TAGS_SELECT = """
+    SELECT DATE(o.orderdate), DATE(r.returndate), o.barcode, {reason}, t.tag,
+           COUNT(*), SUM(r.return_qty), SUM(r.return_qty * p.sellprice)
+    FROM return_tags rt
+    JOIN returns_clean r ON r.return_id = rt.return_id
+    JOIN orders o        ON o.orderid = r.orderid AND o.barcode = r.barcode
+    JOIN reason_tag t    ON t.tag_id = rt.tag_id
+    LEFT JOIN product p  ON p.barcode = o.barcode
+    {where}
+    GROUP BY 1, 2, 3, 4, 5"""
+DAILY_COLS = "order_day, return_day, barcode, reason_cat, lag_days, n_rows, sell_qty, return_qty, sales_amount, loss_amount"
+TAGS_COLS  = "order_day, return_day, barcode, reason_cat, tag, n_rows, return_qty, loss_amount"
+
+def get_engine():
+    url = URL.create(
+        "mysql+mysqlconnector",
+        username=DB_CONFIG["user"],
+        password=DB_CONFIG["password"],
+        host=DB_CONFIG["host"],
+        port=DB_CONFIG["port"],
+        database=DB_CONFIG["database"],
+        query={"charset": "utf8mb4"}
+    )
+    return create_engine(url)
+
+def sqlite_engine(path=":memory:"):
+    """本機 / 測試用的 SQLite 替身（需有 product、orders、returns_clean、return_tags、reason_tag 表）"""
+    return create_engine(f"sqlite:///{path}")
+
+def ensure_rollup_tables(eng):
+    with eng.begin() as conn:
+        for ddl in ROLLUP_DDL.values():
+            conn.execute(text(ddl))
+        insp = inspect(conn)
+        if "source_versions" not in {c["name"] for c in insp.get_columns(STATE)}:     # 舊版 rollup_state
+            conn.execute(text(f"ALTER TABLE {STATE} ADD COLUMN source_versions VARCHAR(1024) NULL"))
+        for t, idxs in ROLLUP_INDEXES.items():
+            have = {i["name"] for i in insp.get_indexes(t)}
+            for name, cols in idxs:
+                if name not in have:
+                    conn.execute(text(f"CREATE INDEX {name} ON {t} ({', '.join(cols)})"))
+
+# ===== 刷新 =====
+def merge_ranges(ranges):
+    """訂單日區間 [(起, 訖隔天 | None=之後全部), ...] → 排序並合併重疊 / 相連的區間"""
+    out = []
+    for lo, hi in sorted(ranges, key=lambda r: r[0]):
+        if out and (out[-1][1] is None or lo <= out[-1][1]):
+            if out[-1][1] is not None and (hi is None or hi > out[-1][1]):
+                out[-1][1] = hi
+        else:
+            out.append([lo, hi])
+    return [tuple(r) for r in out]
+
+def _as_date(v):
+    return pd.Timestamp(v).date() if v is not None else None
+
+def rule_signature(conn):
+    """returns_clean 目前用到的規則集指紋；clear.py 重分類後會改變 → 整表重建"""
+    fps = sorted(str(r[0]) for r in conn.execute(text("SELECT DISTINCT rule_fp FROM returns_clean")))
+    return hashlib.sha1("|".join(fps).encode()).hexdigest()[:16]
+
+def read_state(conn):
+    """(last_orderdate, rule_sig, {來源表: 版本號} | None)"""
+    row = conn.execute(text(f"SELECT last_orderdate, rule_sig, source_versions FROM {STATE} WHERE name = :n"),
+                       {"n": DAILY}).first()
+    return (row[0], row[1], json.loads(row[2]) if row[2] else None) if row else None
+
+def source_versions(conn) -> dict | None:
+    """來源表的 data_version 版本號；來源庫沒有 data_version / data_change 表 → None（無從判斷，只能整表重建）"""
+    insp = inspect(conn)
+    if not (insp.has_table("data_version") and insp.has_table("data_change")):
+        return None
+    stmt = text("SELECT table_name, version FROM data_version WHERE table_name IN :t") \
+        .bindparams(bindparam("t", expanding=True))
+    return {t: int(v) for t, v in conn.execute(stmt, {"t": ROLLUP_SOURCES})}
+
+def changed_ranges(conn, old: dict, new: dict):
+    """
+    版本 old → new 之間 data_change 記下的訂單日 → 要重算的區間（已合併，見 merge_ranges）。
+    版本倒退、中間某個版本沒有紀錄、或紀錄是整張表 → None（改走整表重建）
+    """
+    ranges = []
+    for t in ROLLUP_SOURCES:
+        lo, hi = old.get(t, 0), new.get(t, 0)
+        if hi == lo:
+            continue
+        if hi < lo:
+            return None
+        rows = conn.execute(text("""SELECT version, day_from, day_to FROM data_change
+                                    WHERE table_name = :t AND version > :lo AND version <= :hi"""),
+                            {"t": t, "lo": lo, "hi": hi}).all()
+        if {int(r[0]) for r in rows} != set(range(lo + 1, hi + 1)):
+            return None
+        for _, a, b in rows:
+            if a is None:
+                return None
+            ranges.append((_as_date(a), _as_date(b) + timedelta(days=1) if b is not None else None))
+    return merge_ranges(ranges)
+
+def _rebuild(conn, lag, where="", params=None, delete=None):
+    params = params or {}
+    if delete is not None:
+        for t in (DAILY, TAGS):
+            conn.execute(text(f"DELETE FROM {t} {delete}"), params)
+    conn.execute(text(f"INSERT INTO {DAILY} ({DAILY_COLS})"
+                      + DAILY_SELECT.format(reason=REASON_SQL, lag=lag, where=where)), params)
+    conn.execute(text(f"INSERT INTO {TAGS} ({TAGS_COLS})"
+                      + TAGS_SELECT.format(reason=REASON_SQL, where=where)), params)
+
+def refresh_rollups(eng, full=False) -> dict:
+    """
+    增量刷新彙總表（同一個交易內刪除 + 重算受影響的訂單日）。
+    回傳 {"mode": "full" | "incremental", "ranges": 重算的訂單日區間 [(起, 訖隔天 | None)], "seconds"}
+    """
+    t0 = time.perf_counter()
+    ensure_rollup_tables(eng)
+    lag = LAG_SQL[eng.dialect.name]
+    with eng.begin() as conn:
+        last_od, last_rid = conn.execute(text(
+            "SELECT (SELECT MAX(orderdate) FROM orders), (SELECT MAX(return_id) FROM returns_clean)")).first()
+        sig = rule_signature(conn)
+        versions = source_versions(conn)
+        state = read_state(conn)
+        ranges = None
+        if not (full or state is None or state[1] != sig or state[0] is None
+                or versions is None or state[2] is None):
+            ranges = changed_ranges(conn, state[2], versions)
+        if ranges is None:
+            mode = "full"
+            _rebuild(conn, lag, delete="")
+        else:
+            mode = "incremental"
+            for lo, hi in ranges:
+                p = {"lo": lo.isoformat(), "hi": hi.isoformat() if hi else None}
+                cond_o = "o.orderdate >= :lo" + (" AND o.orderdate < :hi" if hi else "")
+                cond_d = "WHERE order_day >= :lo" + (" AND order_day < :hi" if hi else "")
+                _rebuild(conn, lag, where="WHERE " + cond_o, params=p, delete=cond_d)
+        conn.execute(text(f"DELETE FROM {STATE} WHERE name = :n"), {"n": DAILY})
+        conn.execute(text(f"""INSERT INTO {STATE} (name, last_orderdate, last_return_id, rule_sig, refreshed_at,
+                                                   source_versions)
+                              VALUES (:n, :od, :rid, :sig, :at, :sv)"""),
+                     {"n": DAILY, "od": last_od, "rid": last_rid, "sig": sig,
+                      "at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                      "sv": json.dumps(versions) if versions is not None else None})
+    return {"mode": mode, "ranges": [(lo.isoformat(), hi.isoformat() if hi else None) for lo, hi in ranges or []],
+            "seconds": round(time.perf_counter() - t0, 2)}
+
+# ===== 查詢 =====
+NUMERIC_COLS = ["rows", "lag_days", "sell_qty", "return_qty", "sales_amount", "loss_amount"]
+PRODUCT_FILTERS = {"productid": "productid", "category2": "category2", "category3": "category3"}
+
+def _where(f: A.Filters):
+    """Filters → (WHERE 子句, 參數, 要 expanding 的參數名, 是否需要 JOIN product)"""
+    conds, params, expand = [], {}, []
+    for attr, col in PRODUCT_FILTERS.items():
+        if getattr(f, attr):
+            conds.append(f"p.{col} IN :{attr}")
+            params[attr] = list(getattr(f, attr)); expand.append(attr)
+    if f.reason_l1:
+        conds.append("d.reason_cat IN :reason_l1")
+        params["reason_l1"] = list(f.reason_l1); expand.append("reason_l1")
+    # 篩選日期是 'YYYY-MM-DD'，比照明細的 orderdate >= 日期 / < 日期，換成日粒度完全等價
+    for prefix, col in (("order", "order_day"), ("return", "return_day")):
+        lo, hi = getattr(f, f"{prefix}_from"), getattr(f, f"{prefix}_to")
+        if lo:
+            conds.append(f"d.{col} >= :{prefix}_from"); params[f"{prefix}_from"] = str(pd.Timestamp(lo).date())
+        if hi:
+            conds.append(f"d.{col} < :{prefix}_to");    params[f"{prefix}_to"] = str(pd.Timestamp(hi).date())
+    need_product = any(getattr(f, a) for a in PRODUCT_FILTERS)
+    return (" WHERE " + " AND ".join(conds)) if conds else "", params, expand, need_product
+
+def query(eng, f: A.Filters, select: str, group: str | None = None, table: str = DAILY,
+          with_product: bool = False) -> pd.DataFrame:
+    """對彙總表下 SELECT {select} ... GROUP BY {group}（表別名 d；需要時 LEFT JOIN product p）"""
+    where, params, expand, need_product = _where(f)
+    sql = f"SELECT {select} FROM {table} d"
+    if with_product or need_product:
+        sql += " LEFT JOIN product p ON p.barcode = d.barcode"
+    sql += where + (f" GROUP BY {group}" if group else "")
+    stmt = text(sql).bindparams(*[bindparam(k, expanding=True) for k in expand])
+    with eng.connect() as conn:
+        d = pd.read_sql(stmt, conn, params=params)
+    for c in d.columns.intersection(NUMERIC_COLS):      # 空結果也要是數值欄
+        d[c] = pd.to_numeric(d[c])
+    return d
+
+def kpi_cards(eng, f: A.Filters) -> dict:
+    d = query(eng, f, """d.lag_days, SUM(d.n_rows) AS `rows`, SUM(d.sell_qty) AS sell_qty,
+                         SUM(d.return_qty) AS return_qty, SUM(d.loss_amount) AS loss_amount""", "d.lag_days")
+    return A.kpi_cards(d)
+
+def event_return_rate(eng, f: A.Filters, freq: str = "D"):
+    """依 (訂單日, 退貨日) 彙總後交給 analytic.event_return_rate（銷售看訂單日、退貨看退貨日）"""
+    d = query(eng, f, """d.order_day AS orderdate, d.return_day AS returndate,
+                         SUM(d.sell_qty) AS sell_qty, SUM(d.return_qty) AS return_qty""",
+              "d.order_day, d.return_day")
+    for c in ("orderdate", "returndate"):
+        d[c] = pd.to_datetime(d[c])
+    d["order_ym"] = d["orderdate"].dt.to_period("M")
+    d["event_ym"] = d["returndate"].dt.to_period("M")
+    return A.event_return_rate(d, freq)
+
+def reason_l1_share(eng, f: A.Filters):
+    d = query(eng, f, "d.reason_cat, SUM(d.return_qty) AS return_qty", "d.reason_cat")
+    return A.reason_l1_share(d)
+
+def heatmap(eng, f: A.Filters, level: str = "category3"):
+    if level not in ("category1", "category2", "category3"):
+        raise ValueError("level must be category1|category2|category3")
+    d = query(eng, f, f"p.{level} AS {level}, d.reason_cat, SUM(d.return_qty) AS return_qty",
+              f"p.{level}, d.reason_cat", with_product=True)
+    return A.heatmap(d, level)
+
+def loss_by_reason(eng, f: A.Filters, level="l1") -> pd.DataFrame:
+    if level == "l1":
+        d = query(eng, f, "d.reason_cat, SUM(d.loss_amount) AS loss_amount", "d.reason_cat")
+    else:
+        d = query(eng, f, """d.tag AS tags_l2, SUM(d.n_rows) AS `rows`, SUM(d.return_qty) AS return_qty,
+                             SUM(d.loss_amount) AS loss_amount""", "d.tag", table=TAGS)
+    return A.loss_by_reason(d, level)
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="儀表板彙總表（rollup_daily / rollup_tags）")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    r = sub.add_parser("refresh", help="增量刷新彙總表")
+    r.add_argument("--full", action="store_true", help="整表重建")
+    r.add_argument("--sqlite", help="改用 SQLite 檔（本機測試）")
+    args = ap.parse_args(argv)
+
+    eng = sqlite_engine(args.sqlite) if args.sqlite else get_engine()
+    if args.cmd == "refresh":
+        stats = refresh_rollups(eng, full=args.full)
+        print(f"[rollup] mode={stats['mode']} 重算區間={len(stats['ranges'])} 耗時 {stats['seconds']}s")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
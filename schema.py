@@ -0,0 +1,398 @@
+import os, argparse
+from datetime import date
+import mysql.connector as mc
+from dotenv import load_dotenv
+
+'''
+    資料表結構與索引（DDL 統一在這裡管理）
+    - product / orders / returns / returns_clean 的 CREATE TABLE
+    - 原因標籤：reason_tag 字典 + return_tags(return_id, tag_id) 連結表；
+      命中明細（可選）return_matches 以 rule_id 參照 reason_rule，不存 pattern 字串
+    - 複合索引 (orderid, barcode)、orderdate / returndate 索引
+    - 可選：orders 依 orderdate 做月分區（RANGE COLUMNS）
+    - EXPLAIN 報告：建索引前後，主要查詢的存取方式對照
+Usage:
+  python schema.py create [--partition-orders 2025-01 2026-12]
+  python schema.py migrate        # EXPLAIN(before) → 補表/欄位/索引、移除舊欄位 → EXPLAIN(after)
+  python schema.py explain
+'''
+
+load_dotenv()
+
+DB_CONFIG = {
+    "host": os.getenv("DB_HOST"),
+    "port": int(os.getenv("DB_PORT", "3306")),
+    "user": os.getenv("DB_USER"),
+    "password": os.getenv("DB_PASSWORD"),
+    "database": os.getenv("DB_NAME"),
+}
+
+# 欄位定義（順序與 load_once.COLS / clear.py 輸出一致）
+TABLES = {
+    "product": [
+        ("barcode",      "VARCHAR(32)  NOT NULL"),
+        ("productid",    "VARCHAR(32)  NOT NULL"),
+        ("color",        "VARCHAR(32)  NULL"),
+        ("size",         "VARCHAR(16)  NULL"),
+        ("product_name", "VARCHAR(128) NULL"),
+        ("supplier",     "VARCHAR(128) NULL"),
+        ("cost",         "INT          NULL"),
+        ("sellprice",    "INT          NULL"),
+        ("category1",    "VARCHAR(64)  NULL"),
+        ("category2",    "VARCHAR(64)  NULL"),
+        ("category3",    "VARCHAR(64)  NULL"),
+        ("img_url",      "VARCHAR(512) NULL"),
+    ],
+    "orders": [
+        ("orderid",   "VARCHAR(32) NOT NULL"),
+        ("orderdate", "DATETIME    NOT NULL"),
+        ("barcode",   "VARCHAR(32) NOT NULL"),
+        ("sell_qty",  "INT         NOT NULL"),
+    ],
+    "returns": [
+        ("return_id",  "BIGINT       NOT NULL AUTO_INCREMENT"),
+        ("orderid",    "VARCHAR(32)  NOT NULL"),
+        ("returndate", "DATETIME     NOT NULL"),
+        ("barcode",    "VARCHAR(32)  NOT NULL"),
+        ("return_qty", "INT          NOT NULL"),
+        ("reason",     "VARCHAR(512) NULL"),
+    ],
+    "returns_clean": [
+        ("return_id",          "BIGINT       NOT NULL"),
+        ("orderid",            "VARCHAR(32)  NOT NULL"),
+        ("returndate",         "DATETIME     NOT NULL"),
+        ("barcode",            "VARCHAR(32)  NOT NULL"),
+        ("return_qty",         "INT          NOT NULL"),
+        ("reason",             "VARCHAR(512) NULL"),
+        ("reason_category_l1", "VARCHAR(32)  NULL"),
+        ("rule_fp",            "CHAR(16)     NULL"),   # 分類當時的規則集指紋（見 clear.py）
+    ],
+    # L2 標籤字典與連結表（取代 returns_clean.reason_tags JSON）
+    "reason_tag": [
+        ("tag_id",   "SMALLINT    NOT NULL AUTO_INCREMENT"),
+        ("tag",      "VARCHAR(64) NOT NULL"),
+        ("category", "VARCHAR(32) NOT NULL"),
+    ],
+    "return_tags": [
+        ("return_id", "BIGINT   NOT NULL"),
+        ("tag_id",    "SMALLINT NOT NULL"),
+        ("seq",       "TINYINT  NOT NULL"),    # 標籤在原本 tags_l2 list 中的順序
+    ],
+    # 命中明細（可選，取代 returns_clean.match_terms JSON）
+    "reason_rule": [
+        ("rule_id",  "SMALLINT      NOT NULL AUTO_INCREMENT"),
+        ("rule_key", "CHAR(16)      NOT NULL"),   # sha1(category|tag|pattern)，規則內容不變 id 就不變
+        ("category", "VARCHAR(32)   NOT NULL"),
+        ("tag",      "VARCHAR(64)   NOT NULL"),
+        ("pattern",  "VARCHAR(1024) NOT NULL"),
+    ],
+    "return_matches": [
+        ("return_id", "BIGINT       NOT NULL"),
+        ("rule_id",   "SMALLINT     NOT NULL"),
+        ("m_start",   "SMALLINT     NOT NULL"),
+        ("m_end",     "SMALLINT     NOT NULL"),
+        ("m_text",    "VARCHAR(512) NOT NULL"),
+    ],
+    # 各表資料版本號：寫入端（load_once / clear.py）每次寫完遞增，讀取端的來源指紋以此判斷「原地改值」
+    "data_version": [
+        ("table_name", "VARCHAR(64)  NOT NULL"),
+        ("version",    "BIGINT       NOT NULL"),
+        ("updated_at", "DATETIME     NOT NULL"),
+    ],
+    # 變更紀錄：寫入端記下每次寫入影響的訂單日範圍，bump_data_version 時掛上新版本號；
+    # rollup.py 依此只重算受影響的訂單日（版本變了卻沒有紀錄、或範圍是整張表 → 整表重建）
+    "data_change": [
+        ("change_id",  "BIGINT      NOT NULL AUTO_INCREMENT"),
+        ("table_name", "VARCHAR(64) NOT NULL"),
+        ("version",    "BIGINT      NULL"),     # NULL = 寫入中，bump_data_version 時填上
+        ("day_from",   "DATE        NULL"),     # 受影響的訂單日 [day_from, day_to]；day_from NULL = 整張表
+        ("day_to",     "DATE        NULL"),     # day_to NULL = day_from 之後全部
+    ],
+}
+PRIMARY_KEYS = {
+    "product": ["barcode"],
+    "returns": ["return_id"],
+    "returns_clean": ["return_id"],
+    "reason_tag": ["tag_id"],
+    "return_tags": ["return_id", "tag_id"],
+    "reason_rule": ["rule_id"],
+    "return_matches": ["return_id", "rule_id", "m_start"],
+    "data_version": ["table_name"],
+    "data_change": ["change_id"],
+}
+# 自然鍵（load_once 增量 upsert 依此判斷同一筆）
+# orders：(orderid, barcode) 是訂單明細的識別（returns 以此對應訂單）；同一張訂單重複出現的 barcode 由 load_once 驗證擋下
+# returns：同一筆訂單明細可以退貨多次，以退貨時間區分
+NATURAL_KEYS = {
+    "product": ["barcode"],
+    "orders":  ["orderid","barcode"],
+    "returns": ["orderid","barcode","returndate"],
+}
+# (索引名, 是否唯一, 欄位)
+INDEXES = {
+    "orders": [
+        ("uk_orders_natural",    True,  ["orderid","barcode"]),
+        ("idx_orders_orderdate", False, ["orderdate"]),
+    ],
+    "returns": [
+        ("uk_returns_natural",     True,  ["orderid","barcode","returndate"]),   # 前綴 (orderid, barcode) 供 JOIN 使用
+        ("idx_returns_returndate", False, ["returndate"]),
+    ],
+    "returns_clean": [
+        ("idx_rc_order_barcode", False, ["orderid","barcode"]),
+        ("idx_rc_returndate",    False, ["returndate"]),
+    ],
+    "reason_tag":  [("uk_reason_tag",  True,  ["tag"])],
+    "return_tags": [("idx_rt_tag",     False, ["tag_id"])],
+    "reason_rule": [("uk_reason_rule", True,  ["rule_key"])],
+    "data_change": [("idx_dc_table_version", False, ["table_name","version"])],
+}
+# 已改存到其他表的舊欄位（migrate 時移除，釋放空間）
+OBSOLETE_COLUMNS = {"returns_clean": ["reason_tags", "match_terms"]}
+TABLE_ORDER = ["product","orders","returns","returns_clean",
+               "reason_tag","return_tags","reason_rule","return_matches","data_version","data_change"]
+PARTITION_COL = {"orders": "orderdate"}
+
+# 建索引前後要比對的查詢（皆為專案中實際會跑的型態）
+EXPLAIN_QUERIES = {
+    "returns ⋈ orders USING(orderid, barcode)": """
+        SELECT COUNT(*) FROM returns r LEFT JOIN orders o USING(orderid, barcode)
+        WHERE o.orderid IS NULL OR r.return_qty > o.sell_qty""",
+    "orders 依 orderdate 區間": """
+        SELECT orderid, orderdate, barcode, sell_qty FROM orders
+        WHERE orderdate >= '2025-08-01' AND orderdate < '2025-09-01'""",
+    "orders 高水位 MAX(orderdate)": "SELECT MAX(orderdate) FROM orders",
+    "returns 高水位 MAX(returndate)": "SELECT MAX(returndate) FROM returns",
+    "returns_clean 依 returndate 區間": """
+        SELECT return_id, return_qty FROM returns_clean
+        WHERE returndate >= '2025-08-01' AND returndate < '2025-09-01'""",
+    "returns_clean ⋈ orders (orderid, barcode)": """
+        SELECT o.orderid, o.sell_qty, r.return_qty FROM orders o
+        JOIN returns_clean r ON r.orderid = o.orderid AND r.barcode = o.barcode
+        WHERE o.orderid = 'A202508160001'""",
+}
+
+
+def month_starts(start: str, end: str):
+    """'YYYY-MM' ~ 'YYYY-MM'（含）每月第一天"""
+    y, m = map(int, start.split("-"))
+    ey, em = map(int, end.split("-"))
+    while (y, m) <= (ey, em):
+        yield date(y, m, 1)
+        y, m = (y + 1, 1) if m == 12 else (y, m + 1)
+
+def partition_clause(col: str, start: str, end: str) -> str:
+    """月分區：p<YYYYMM> VALUES LESS THAN (下個月1日)，最後一個 pmax 接住其餘"""
+    parts = []
+    for d in month_starts(start, end):
+        nxt = date(d.year + 1, 1, 1) if d.month == 12 else date(d.year, d.month + 1, 1)
+        parts.append(f"PARTITION p{d:%Y%m} VALUES LESS THAN ('{nxt:%Y-%m-%d}')")
+    parts.append("PARTITION pmax VALUES LESS THAN (MAXVALUE)")
+    return f"PARTITION BY RANGE COLUMNS({col}) (\n    " + ",\n    ".join(parts) + "\n)"
+
+def index_cols(table, cols, unique, partitioned):
+    """分區表的唯一鍵必須包含分區欄（MySQL 限制）"""
+    pcol = PARTITION_COL.get(table)
+    if unique and partitioned and pcol and pcol not in cols:
+        return cols + [pcol]
+    return cols
+
+def create_table_sql(table, partition=None):
+    """
+    產生 CREATE TABLE IF NOT EXISTS。
+    partition=(start, end)：只對 orders 有效，依 orderdate 月分區
+    （分區表不能有外鍵，唯一鍵會自動補上 orderdate）。
+    """
+    partitioned = partition is not None and table in PARTITION_COL
+    lines = [f"{c} {' '.join(t.split())}" for c, t in TABLES[table]]
+    if table in PRIMARY_KEYS:
+        lines.append(f"PRIMARY KEY ({', '.join(PRIMARY_KEYS[table])})")
+    for name, unique, cols in INDEXES.get(table, []):
+        cols = index_cols(table, cols, unique, partitioned)
+        lines.append(f"{'UNIQUE KEY' if unique else 'KEY'} {name} ({', '.join(cols)})")
+    sql = (f"CREATE TABLE IF NOT EXISTS {table} (\n    " + ",\n    ".join(lines) +
+           "\n) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4")
+    if partitioned:
+        sql += "\n" + partition_clause(PARTITION_COL[table], *partition)
+    return sql
+
+def create_tables(cur, tables=TABLE_ORDER, partition=None):
+    for t in tables:
+        cur.execute(create_table_sql(t, partition))
+
+def bump_data_version(cur, tables):
+    """
+    寫入完成後遞增各表的資料版本號（表不存在時先建），並把尚未掛版本的變更紀錄（log_change）掛上新版本號；
+    呼叫端負責 commit
+    """
+    if not tables:
+        return
+    cur.execute(create_table_sql("data_version"))
+    cur.execute(create_table_sql("data_change"))
+    cur.executemany("""INSERT INTO data_version (table_name, version, updated_at) VALUES (%s, 1, NOW())
+                       ON DUPLICATE KEY UPDATE version = version + 1, updated_at = NOW()""",
+                    [(t,) for t in tables])
+    cur.execute(f"""UPDATE data_change c JOIN data_version v ON v.table_name = c.table_name
+                    SET c.version = v.version
+                    WHERE c.version IS NULL AND c.table_name IN ({','.join(['%s'] * len(tables))})""",
+                list(tables))
+
+def log_change(cur, tables, day_from=None, day_to=None):
+    """
+    記錄一次寫入影響的訂單日 [day_from, day_to]（day_from=None = 整張表）；版本號由下一次 bump_data_version 填上。
+    data_change 表需先建好：在寫入交易中途 CREATE TABLE 會隱含 commit
+    """
+    cur.executemany("INSERT INTO data_change (table_name, version, day_from, day_to) VALUES (%s, NULL, %s, %s)",
+                    [(t, day_from, day_to) for t in tables])
+
+def log_change_days(cur, tables, days_sql, params=()):
+    """以查詢結果記錄變更：days_sql 回傳一欄 d（受影響的訂單日），每個日期一筆"""
+    for t in tables:
+        cur.execute(f"""INSERT INTO data_change (table_name, version, day_from, day_to)
+                        SELECT %s, NULL, x.d, x.d FROM ({days_sql}) x""", (t, *params))
+
+def table_exists(cur, table):
+    cur.execute("""SELECT COUNT(*) FROM information_schema.TABLES
+                   WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s""", (table,))
+    return cur.fetchone()[0] > 0
+
+def is_partitioned(cur, table):
+    cur.execute("""SELECT COUNT(*) FROM information_schema.PARTITIONS
+                   WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+                     AND PARTITION_NAME IS NOT NULL""", (table,))
+    return cur.fetchone()[0] > 0
+
+def existing_indexes(cur, table):
+    """{索引名: (是否唯一, [欄位])}"""
+    cur.execute("""
+        SELECT INDEX_NAME, MIN(NON_UNIQUE), GROUP_CONCAT(COLUMN_NAME ORDER BY SEQ_IN_INDEX)
+        FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+        GROUP BY INDEX_NAME
+    """, (table,))
+    return {name: (int(nu) == 0, cols.split(",")) for name, nu, cols in cur.fetchall()}
+
+def ensure_columns(cur, tables=TABLE_ORDER):
+    """既有表缺少 TABLES 裡新增的欄位時補上（ALTER TABLE ADD COLUMN ... AFTER）。回傳新增的欄位"""
+    added = []
+    for t in tables:
+        if not table_exists(cur, t):
+            continue
+        cur.execute("""SELECT COLUMN_NAME FROM information_schema.COLUMNS
+                       WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s""", (t,))
+        have = {r[0] for r in cur.fetchall()}
+        prev = None
+        for c, typ in TABLES[t]:
+            if c not in have:
+                pos = f" AFTER {prev}" if prev else " FIRST"
+                cur.execute(f"ALTER TABLE {t} ADD COLUMN {c} {' '.join(typ.split())}{pos}")
+                added.append(f"{t}.{c}")
+            prev = c
+    return added
+
+def drop_obsolete_columns(cur, tables=TABLE_ORDER):
+    """移除 OBSOLETE_COLUMNS 列出且仍存在的欄位。回傳移除的欄位"""
+    dropped = []
+    for t in tables:
+        cols = OBSOLETE_COLUMNS.get(t)
+        if not cols or not table_exists(cur, t):
+            continue
+        cur.execute("""SELECT COLUMN_NAME FROM information_schema.COLUMNS
+                       WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s""", (t,))
+        have = {r[0] for r in cur.fetchall()}
+        for c in cols:
+            if c in have:
+                cur.execute(f"ALTER TABLE {t} DROP COLUMN {c}")
+                dropped.append(f"-{t}.{c}")
+    return dropped
+
+def ensure_indexes(cur, tables=TABLE_ORDER, only_unique=False):
+    """
+    補齊 INDEXES 裡缺少的索引（已存在「同欄位前綴」的索引就不重建）；
+    同名索引的欄位或唯一性與定義不同時（例如 uk_returns_natural 加上 returndate）先 DROP 再重建。
+    only_unique=True 時只補唯一鍵（增量 upsert 需要）。回傳新增 / 重建的索引名。
+    """
+    added = []
+    for t in tables:
+        if t not in INDEXES or not table_exists(cur, t):
+            continue
+        have = existing_indexes(cur, t)
+        partitioned = is_partitioned(cur, t)
+        for name, unique, cols in INDEXES[t]:
+            if only_unique and not unique:
+                continue
+            cols = index_cols(t, cols, unique, partitioned)
+            if name in have and have[name] != (unique, cols):
+                cur.execute(f"ALTER TABLE {t} DROP INDEX {name}")
+                del have[name]
+                added.append(f"~{t}.{name}")
+            covered = any(u >= unique and c[:len(cols)] == cols and (not unique or len(c) == len(cols))
+                          for u, c in have.values())
+            if name in have or covered:
+                continue
+            cur.execute(f"ALTER TABLE {t} ADD {'UNIQUE KEY' if unique else 'KEY'} {name} ({', '.join(cols)})")
+            added.append(f"{t}.{name}")
+    return added
+
+def ensure_schema(cur, partition=None):
+    """建表（不存在時）、補欄位與索引；可重複執行"""
+    create_tables(cur, partition=partition)
+    return ensure_columns(cur) + ensure_indexes(cur)
+
+# ===== EXPLAIN 報告 =====
+def explain_report(cur, queries=EXPLAIN_QUERIES):
+    """每個查詢的 EXPLAIN 摘要：[(查詢名, table, type, key, rows)]"""
+    out = []
+    for name, sql in queries.items():
+        try:
+            cur.execute("EXPLAIN " + sql)
+        except mc.Error as e:
+            out.append((name, "-", "error", str(e.msg), None))
+            continue
+        cols = [d[0] for d in cur.description]
+        for row in cur.fetchall():
+            r = dict(zip(cols, row))
+            out.append((name, r.get("table"), r.get("type"), r.get("key"), r.get("rows")))
+    return out
+
+def print_report(before, after=None):
+    """type=ALL 代表全表掃描；after 有值時並列顯示前後差異"""
+    print(f"{'查詢':<40} {'table':<8} {'type':<8} {'key':<24} {'rows':>10}")
+    rows = before if after is None else zip(before, after)
+    for item in rows:
+        if after is None:
+            name, tbl, typ, key, n = item
+            print(f"{name:<40} {tbl or '-':<8} {typ or '-':<8} {key or '-':<24} {n or '-':>10}")
+        else:
+            (name, tbl, t0, k0, n0), (_, _, t1, k1, n1) = item
+            print(f"{name:<40} {tbl or '-':<8} {t0 or '-'}→{t1 or '-':<8} {k0 or '-'}→{k1 or '-':<24} "
+                  f"{n0 or '-'}→{n1 or '-':>10}")
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="資料表結構與索引管理")
+    ap.add_argument("cmd", choices=["create", "migrate", "explain"])
+    ap.add_argument("--partition-orders", nargs=2, metavar=("FROM_YM", "TO_YM"),
+                    help="建立 orders 時依 orderdate 月分區，例如 2025-01 2026-12")
+    args = ap.parse_args(argv)
+
+    conn = mc.connect(**DB_CONFIG, autocommit=True)
+    cur = conn.cursor()
+    try:
+        if args.cmd == "create":
+            added = ensure_schema(cur, partition=args.partition_orders)
+            print(f"[schema] tables ok, 新增欄位/索引: {added or '無'}")
+        elif args.cmd == "migrate":
+            before = explain_report(cur)
+            create_tables(cur)
+            added = ensure_columns(cur) + drop_obsolete_columns(cur) + ensure_indexes(cur)
+            after = explain_report(cur)
+            print(f"[schema] 新增欄位/索引: {added or '無'}")
+            print_report(before, after)
+        else:
+            print_report(explain_report(cur))
+    finally:
+        cur.close()
+        conn.close()
+
+if __name__ == "__main__":
+    main()
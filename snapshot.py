@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# snapshot.py
+import os, json, time, uuid, shutil, hashlib
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+'''
+    base 明細的本機欄式快照：
+      每欄一個 .npy（category 存 codes、period 存 ordinal、object 先字典編碼），
+      meta.json 記錄欄位型別、類別值與「來源資料指紋」。
+    載入時以 np.load(mmap_mode="r") 記憶體映射，指紋不符（或檔案不在）就回傳 None 由呼叫端重建。
+    多個 process 載同一份快照時共用 OS page cache，不必各自持有一份。
+    目錄結構：path/<版本目錄>/（每次寫入一個不重複的新目錄）＋ path/CURRENT（指向目前版本的指標檔）；
+    指標以 os.replace 原子替換，多個 writer 同時寫也只會有一份完整快照生效（最後換指標者勝）。
+'''
+
+SNAPSHOT_VERSION = 1
+META = "meta.json"
+CURRENT = "CURRENT"
+KEEP_SECONDS = 600       # 非目前版本的目錄超過此秒數沒動才刪（可能是其他 writer 正在寫 / 剛寫完還沒換指標）
+
+def _data_versions(conn) -> dict:
+    """data_version 表（load_once / clear.py 寫完會遞增）→ {表: 版本號}；表還不存在 → {}"""
+    try:
+        return dict(conn.execute(text("SELECT table_name, version FROM data_version")).all())
+    except DBAPIError:
+        conn.rollback()
+        return {}
+
+def source_fingerprint(eng, tables, extra="", max_cols=None) -> str:
+    """
+    來源表指紋：data_version 的版本號、information_schema.UPDATE_TIME，以及 max_cols={表: 欄} 的 MAX(欄)。
+      - 版本號：寫入端每次寫完遞增，抓得到筆數與最大鍵都沒變的原地更新（改價、重分類）
+      - UPDATE_TIME：MySQL 8 預設快取 information_schema_stats_expiry（86400 秒），先把本 session 設成 0；
+        DB 重啟後會變 NULL，只會造成多重建一次
+      - MAX(欄)：max_cols 應給有索引的欄，只讀索引端點；不做 COUNT(*)（InnoDB 要掃整個索引）
+    """
+    parts = [str(SNAPSHOT_VERSION), extra]
+    with eng.connect() as conn:
+        try:
+            conn.execute(text("SET SESSION information_schema_stats_expiry = 0"))
+        except DBAPIError:                   # MySQL 5.7 沒有這個變數（也不快取）
+            conn.rollback()
+        versions = _data_versions(conn)
+        for t in tables:
+            upd = conn.execute(text("""SELECT UPDATE_TIME FROM information_schema.TABLES
+                                       WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :t"""),
+                               {"t": t}).scalar()
+            parts.append(f"{t}:{versions.get(t)}:{upd}")
+            if max_cols and t in max_cols:
+                parts.append(str(conn.execute(text(f"SELECT MAX({max_cols[t]}) FROM {t}")).scalar()))
+    return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()[:16]
+
+def _encode(s: pd.Series):
+    """欄 → (kind, ndarray, 額外 meta)"""
+    dt = s.dtype
+    if isinstance(dt, pd.CategoricalDtype):
+        return "category", s.cat.codes.to_numpy(), {"categories": s.cat.categories.tolist(),
+                                                   "ordered": bool(dt.ordered)}
+    if isinstance(dt, pd.PeriodDtype):
+        return "period", s.array.asi8, {"period_dtype": str(dt)}
+    if dt == object:
+        c = s.astype("category")        # 字串欄無法 mmap → 字典編碼，載回為 category
+        return "category", c.cat.codes.to_numpy(), {"categories": c.cat.categories.tolist(),
+                                                   "ordered": False}
+    return "array", s.to_numpy(), {}
+
+def _decode(col: dict, arr: np.ndarray):
+    kind = col["kind"]
+    if kind == "category":
+        dtype = pd.CategoricalDtype(col["categories"], ordered=col["ordered"])
+        return pd.Categorical.from_codes(arr, dtype=dtype, validate=False)
+    if kind == "period":
+        return pd.arrays.PeriodArray(arr, dtype=pd.api.types.pandas_dtype(col["period_dtype"]))
+    return arr
+
+def current_dir(path: str) -> str:
+    """指標檔指向的版本目錄；沒有指標檔時就是 path 本身"""
+    try:
+        with open(os.path.join(path, CURRENT), encoding="utf-8") as f:
+            name = f.read().strip()
+    except OSError:
+        return path
+    return os.path.join(path, name) if name else path
+
+def _prune(path: str, keep: set):
+    now = time.time()
+    for name in os.listdir(path):
+        d = os.path.join(path, name)
+        if name in keep or not os.path.isdir(d):
+            continue
+        try:
+            if now - os.path.getmtime(d) > KEEP_SECONDS:
+                shutil.rmtree(d, ignore_errors=True)   # 已 mmap 的舊檔在 Linux 上仍可讀到 process 結束
+        except OSError:
+            pass
+
+def save_snapshot(df: pd.DataFrame, path: str, fingerprint: str) -> str:
+    """寫進新的版本目錄，寫完才原子替換指標檔，讀取端不會看到寫一半的快照。回傳 path"""
+    os.makedirs(path, exist_ok=True)
+    ver = f"{time.strftime('%Y%m%d%H%M%S')}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    tmp = os.path.join(path, ver)
+    os.makedirs(tmp)
+    cols = []
+    for i, name in enumerate(df.columns):
+        kind, arr, extra = _encode(df[name])
+        fn = f"{i:03d}.npy"
+        np.save(os.path.join(tmp, fn), np.ascontiguousarray(arr), allow_pickle=False)
+        cols.append({"name": name, "kind": kind, "file": fn, "dtype": str(arr.dtype), **extra})
+    meta = {"version": SNAPSHOT_VERSION, "fingerprint": fingerprint, "rows": len(df),
+            "created_at": time.strftime("%Y-%m-%d %H:%M:%S"), "columns": cols}
+    with open(os.path.join(tmp, META), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+
+    ptr = os.path.join(path, f"{CURRENT}.{ver}")
+    with open(ptr, "w", encoding="utf-8") as f:
+        f.write(ver)
+    os.replace(ptr, os.path.join(path, CURRENT))
+    _prune(path, {ver, os.path.basename(current_dir(path))})
+    return path
+
+def read_meta(path: str) -> dict | None:
+    try:
+        with open(os.path.join(current_dir(path), META), encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get("version") == SNAPSHOT_VERSION else None
+
+def load_snapshot(path: str, fingerprint: str | None = None, mmap: bool = True) -> pd.DataFrame | None:
+    """
+    指紋相符就載入快照（mmap=True 時資料頁按需讀取、唯讀）；
+    快照不存在、版本不同或指紋不符 → None。fingerprint=None 表示不檢查。
+    """
+    path = current_dir(path)             # 先解析一次指標，整份快照都從同一個版本目錄讀
+    meta = read_meta(path)
+    if meta is None or (fingerprint is not None and meta["fingerprint"] != fingerprint):
+        return None
+    data = {}
+    try:
+        for col in meta["columns"]:
+            arr = np.load(os.path.join(path, col["file"]), mmap_mode="r" if mmap else None,
+                          allow_pickle=False)
+            data[col["name"]] = _decode(col, arr)
+    except (OSError, ValueError):
+        return None
+    # copy=False：不合併成 2D block，各欄直接引用 mmap 陣列
+    return pd.DataFrame(data, copy=False)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import os, sys
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import analytic as A
+from return_reason_cata import classify_many
+
+'''
+    共用 fixture：以 data/*.csv 組出與 analytic.read_sources() 相同格式的五張來源表，
+    以及寫進 SQLite 替身（rollup.sqlite_engine / partitions.sqlite_engine 共用的表結構）。
+'''
+
+DATA = os.path.join(ROOT, "data")
+P_COLS = ["barcode", "productid", "product_name", "supplier", "sellprice",
+          "category1", "category2", "category3", "color", "size"]
+
+def load_sources():
+    """(product, orders, returns_clean, return_tags, reason_tag 名稱)；原因分類以 classify_many 現算"""
+    p = pd.read_csv(os.path.join(DATA, "product.csv"), encoding="utf-8-sig")[P_COLS]
+    o = pd.read_csv(os.path.join(DATA, "orders.csv"), encoding="utf-8-sig")
+    r = pd.read_csv(os.path.join(DATA, "returns.csv"), encoding="utf-8-sig")
+    r.insert(0, "return_id", np.arange(1, len(r) + 1))
+    results = classify_many(r["reason"].tolist())
+    r["reason_cat"] = [res[0] for res in results]
+    tags = sorted({t for res in results for t in res[1]})
+    tag_id = {t: i + 1 for i, t in enumerate(tags)}
+    links = pd.DataFrame([(rid, tag_id[t]) for rid, res in zip(r["return_id"], results) for t in res[1]],
+                         columns=["return_id", "tag_id"])
+    names = pd.Series(tags, index=range(1, len(tags) + 1))
+    return p, o, r.drop(columns="reason"), links, names
+
+def copies(sources):
+    """build_base 會改動傳入的表，每次給一份副本"""
+    return tuple(x.copy() for x in sources)
+
+def write_sqlite(eng, p, o, r, links, names, if_exists="fail"):
+    """來源表寫進 SQLite（欄名同 MySQL：returns_clean.reason_category_l1、return_tags.seq）；增量測試用 if_exists="append" 補資料"""
+    if p is not None:
+        p.to_sql("product", eng, index=False, if_exists=if_exists)
+    if names is not None:
+        names.rename("tag").rename_axis("tag_id").reset_index().to_sql("reason_tag", eng, index=False,
+                                                                      if_exists=if_exists)
+    o.assign(orderdate=pd.to_datetime(o["orderdate"]).dt.strftime("%Y-%m-%d %H:%M:%S")) \
+     .to_sql("orders", eng, index=False, if_exists=if_exists)
+    r.assign(returndate=pd.to_datetime(r["returndate"]).dt.strftime("%Y-%m-%d %H:%M:%S"), rule_fp="test") \
+     .rename(columns={"reason_cat": "reason_category_l1"}).to_sql("returns_clean", eng, index=False,
+                                                                  if_exists=if_exists)
+    links.assign(seq=links.groupby("return_id").cumcount()).to_sql("return_tags", eng, index=False,
+                                                                   if_exists=if_exists)
+
+SQLITE_CHANGE_DDL = [
+    "CREATE TABLE IF NOT EXISTS data_version (table_name TEXT PRIMARY KEY, version INTEGER NOT NULL, updated_at TEXT)",
+    """CREATE TABLE IF NOT EXISTS data_change (change_id INTEGER PRIMARY KEY AUTOINCREMENT, table_name TEXT NOT NULL,
+                                               version INTEGER, day_from DATE, day_to DATE)""",
+]
+
+def record_change(eng, tables, ranges=None):
+    """
+    SQLite 版的寫入端收尾（schema.log_change + bump_data_version）：各表版本號 +1，
+    並記下影響的訂單日 ranges=[(day_from, day_to | None), ...]；None = 整張表，[] = 只遞增版本不留紀錄
+    """
+    ranges = [(None, None)] if ranges is None else ranges
+    with eng.begin() as conn:
+        for ddl in SQLITE_CHANGE_DDL:
+            conn.exec_driver_sql(ddl)
+        for t in tables:
+            conn.exec_driver_sql("""INSERT INTO data_version VALUES (?, 1, datetime('now'))
+                                    ON CONFLICT(table_name) DO UPDATE SET version = version + 1""", (t,))
+            v = conn.exec_driver_sql("SELECT version FROM data_version WHERE table_name = ?", (t,)).scalar()
+            for lo, hi in ranges:
+                conn.exec_driver_sql("INSERT INTO data_change (table_name, version, day_from, day_to) VALUES (?,?,?,?)",
+                                     (t, v, lo, hi))
+
+def canon(d):
+    """比對用：category 轉 object、依所有欄排序、重設 index"""
+    d = d.copy()
+    d.columns = [str(c) for c in d.columns]
+    for c in d.columns:
+        if isinstance(d[c].dtype, pd.CategoricalDtype):
+            d[c] = d[c].astype(object)
+    return d.sort_values(list(d.columns)).reset_index(drop=True)
+
+def frames_equal(a, b):
+    """列順序也要相同的比對（忽略 dtype 與 category / object 的差別）"""
+    assert_frame_equal(a.reset_index(drop=True), b.reset_index(drop=True), check_dtype=False,
+                       check_categorical=False, check_index_type=False)
+
+@pytest.fixture(scope="session")
+def sources():
+    return load_sources()
+
+@pytest.fixture(scope="session")
+def base(sources):
+    return A.build_base(*copies(sources))
+
+@pytest.fixture(scope="session")
+def sample_filters(base):
+    """各面板比對用的篩選組合：無條件、維度、商品、訂單 / 退貨日期、以及沒有結果的條件"""
+    c2 = sorted(base["category2"].dropna().unique())
+    c3 = sorted(base["category3"].dropna().unique())
+    rc = sorted(base["reason_cat"].dropna().unique())
+    pid = sorted(base["productid"].dropna().unique())
+    return [A.Filters(), A.Filters(category2=c2[:1]), A.Filters(category3=c3[:3], reason_l1=rc[:2]),
+            A.Filters(productid=pid[:20]), A.Filters(order_from="2025-08-10", order_to="2025-08-25"),
+            A.Filters(return_from="2025-08-15"), A.Filters(category2=["不存在的類別"])]
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import threading
+import pytest
+
+import analytic as A
+
+'''
+    BaseCache：版本沒變不重建、版本變了整份替換、重建期間與重建失敗時都繼續提供舊 frame。
+    data_version / load_base 以可控的替身取代（不連 DB）。
+'''
+
+class Source:
+    """可控的來源：version 決定 data_version()；load_base 依版本回傳 base 的不同切片，可卡住或丟例外"""
+    def __init__(self, base):
+        self.base, self.version, self.loads = base, "v1", []
+        self.gate, self.fail = None, None
+
+    def data_version(self, eng):
+        return self.version
+
+    def load_base(self, eng, version, compact=True, snapshot=True):
+        self.loads.append(version)
+        if self.gate is not None:
+            self.gate.wait(10)
+        if self.fail:
+            raise self.fail
+        return self.base.iloc[: 100 * int(version[1:])].reset_index(drop=True)
+
+@pytest.fixture
+def src(base, monkeypatch):
+    s = Source(base)
+    monkeypatch.setattr(A, "get_engine", lambda db: None)
+    monkeypatch.setattr(A, "data_version", s.data_version)
+    monkeypatch.setattr(A, "load_base", s.load_base)
+    return s
+
+def test_version_swap(src):
+    cache = A.BaseCache({}, poll_seconds=0)
+    old = cache.get()
+    assert len(old) == 100 and cache.version == "v1" and src.loads == ["v1"]
+    assert cache.get() is old
+    assert cache.refresh(wait=True) is False and src.loads == ["v1"]     # 版本沒變不重建
+    src.version = "v2"
+    assert cache.refresh(wait=True) is True
+    version, df, _ = cache.current()
+    assert version == "v2" and len(df) == 200 and cache.get() is df
+    assert len(old) == 100                                               # 舊 frame 仍完整可用
+    assert A._FRAME_INDEXES.get((id(df), "FilterIndex")) is not None     # 換上之前索引已建好
+
+def test_background_rebuild_serves_old_frame(src):
+    cache = A.BaseCache({}, poll_seconds=0)
+    old = cache.get()
+    src.version, src.gate = "v3", threading.Event()
+    assert cache.refresh() is True
+    assert cache.refresh() is False                                      # 重建中不重複觸發
+    assert cache.get() is old and cache.info()["building"] and cache.version == "v1"
+    src.gate.set()
+    with cache._build_lock:                                              # 等背景重建結束
+        pass
+    assert cache.version == "v3" and len(cache.get()) == 300 and not cache.info()["building"]
+    assert src.loads == ["v1", "v3"]
+
+def test_failed_rebuild_keeps_old_frame(src):
+    cache = A.BaseCache({}, poll_seconds=0)
+    old = cache.get()
+    src.version, src.fail = "v2", RuntimeError("db gone")
+    assert cache.refresh(wait=True) is True
+    assert cache.get() is old and cache.version == "v1"
+    assert cache.last_error == "RuntimeError: db gone"
+    src.fail = None
+    assert cache.refresh(wait=True) is True
+    assert cache.version == "v2" and cache.last_error is None
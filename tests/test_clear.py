@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import os
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+
+import clear as C
+from conftest import DATA
+from return_reason_cata import RULES, classify_many
+
+'''
+    clear.py 的管線測試：讀取分頁、序列化、過期判斷與刪除同步在 SQLite 替身上跑。
+'''
+
+@pytest.fixture
+def eng(tmp_path):
+    """returns 表：data/returns.csv，return_id 故意留洞（每 7 號跳一號）"""
+    rows = pd.read_csv(os.path.join(DATA, "returns.csv"), encoding="utf-8-sig")
+    rows.insert(0, "return_id", [i + i // 7 + 1 for i in range(len(rows))])
+    eng = create_engine(f"sqlite:///{tmp_path / 'clear.db'}")
+    rows.to_sql("returns", eng, index=False)
+    return eng
+
+@pytest.mark.parametrize("chunksize", [1, 100, 1188, 1189, 5000])
+def test_read_pages_returns_every_row_once_in_order(eng, chunksize):
+    pages = list(C.read_pages(eng, C.SELECT_ALL, {}, chunksize))
+    ids = pd.concat(pages)["return_id"].tolist()
+    assert len(ids) == 1188 and ids == sorted(set(ids))
+    assert all(len(p) <= chunksize for p in pages)
+
+def test_serialize_results_round_trip():
+    tag_ids = {r["tag"]: i + 1 for i, r in enumerate({r["tag"]: r for r in RULES}.values())}
+    rule_ids = {(r["tag"], r["pattern"]): i + 1 for i, r in enumerate(RULES)}
+    texts = ["尺寸偏小，袖長過長", "尺寸偏小，袖長過長", "沒有原因", None, "外箱破損又寄錯"]
+    results = classify_many(texts)
+    l1, tags, terms = C.serialize_results(results, tag_ids, rule_ids)
+    names = {v: k for k, v in tag_ids.items()}
+    assert l1 == [r[0] for r in results]
+    assert [[names[t] for t in tl] for tl in tags] == [r[1] for r in results]
+    assert [len(t) for t in terms] == [len(r[2]) for r in results]
+    tag_rows, match_rows = C.link_rows([10, 11, 12, 13, 14], tags, terms, with_matches=True)
+    assert [(rid, seq) for rid, _, seq in tag_rows if rid == 10] == [(10, k) for k in range(len(tags[0]))]
+    assert len(match_rows) == sum(len(t) for t in terms)
+    assert C.link_rows([10], tags[:1], terms[:1])[1] == []
+
+def test_to_db_rows_converts_types():
+    df = pd.DataFrame({"a": pd.to_datetime(["2025-08-01 10:00:00", None]), "b": [1.5, None], "c": ["x", None]})
+    assert C.to_db_rows(df, ["a", "b", "c"]) == [("2025-08-01 10:00:00", 1.5, "x"), (None, None, None)]
+
+def clean_rows(rows, fp):
+    out = rows.copy()
+    out["reason_category_l1"] = "其他"
+    out["rule_fp"] = fp
+    return out
+
+def test_count_stale_and_select_stale(eng):
+    fp = C.clean_fingerprint()
+    with eng.begin() as conn:
+        src = pd.read_sql("SELECT * FROM returns ORDER BY return_id", conn)
+    clean = clean_rows(src, fp)
+    ids = clean["return_id"]
+    clean = clean[ids != ids.iloc[0]].copy()                         # 新的一列
+    clean.loc[ids == ids.iloc[1], "reason"] = "改過的原因"             # 原因改了
+    clean.loc[ids == ids.iloc[2], "return_qty"] += 1                 # 數量改了
+    clean.loc[ids == ids.iloc[3], "rule_fp"] = "0" * 16              # 指紋過期
+    clean.loc[ids == ids.iloc[4], "rule_fp"] = None                  # 舊表補上的欄（NULL）
+    clean.loc[ids == ids.iloc[5], "reason"] = None                   # 一邊 NULL 一邊有值
+    clean.to_sql("returns_clean", eng, index=False)
+    with eng.begin() as conn:
+        conn.exec_driver_sql(f"UPDATE returns SET reason = NULL WHERE return_id IN ({ids.iloc[6]}, {ids.iloc[7]})")
+        conn.exec_driver_sql(f"UPDATE returns_clean SET reason = NULL WHERE return_id = {ids.iloc[7]}")   # 兩邊 NULL
+        assert C.count_stale(conn, fp) == (7, len(src))
+    got = pd.concat(C.read_pages(eng, C.select_stale(eng.dialect.name), {"fp": fp}, 3))["return_id"].tolist()
+    assert got == ids.iloc[:7].tolist()
+
+def test_purge_deleted_removes_orphans(eng):
+    with eng.begin() as conn:
+        src = pd.read_sql("SELECT * FROM returns ORDER BY return_id", conn)
+    ids = src["return_id"].tolist()
+    clean_rows(src, "x").to_sql("returns_clean", eng, index=False)
+    pd.DataFrame({"return_id": ids[:10], "tag_id": 1, "seq": 0}).to_sql("return_tags", eng, index=False)
+    pd.DataFrame({"return_id": ids[:10], "rule_id": 1, "m_start": 0, "m_end": 1, "m_text": "x"}) \
+        .to_sql("return_matches", eng, index=False)
+    with eng.begin() as conn:
+        conn.exec_driver_sql(f"DELETE FROM returns WHERE return_id IN ({ids[0]}, {ids[3]}, {ids[-1]})")
+    raw = eng.raw_connection()
+    try:
+        cur = raw.cursor()
+        assert C.purge_deleted(cur) == 3
+        raw.commit()
+        assert C.purge_deleted(cur) == 0
+    finally:
+        raw.close()
+    with eng.begin() as conn:
+        for t, n in [("returns_clean", len(ids) - 3), ("return_tags", 8), ("return_matches", 8)]:
+            assert conn.exec_driver_sql(f"SELECT COUNT(*) FROM {t}").scalar() == n
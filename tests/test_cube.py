@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from pandas.testing import assert_frame_equal
+
+import analytic as A
+from conftest import frames_equal
+
+def test_cube_panels_match_detail(base, sample_filters):
+    for f in sample_filters:
+        d = A.apply_filters(base, f)
+        c = A.build_cube(d)
+        assert c["rows"].sum() == len(d)
+        frames_equal(A.summary_table(c), A.summary_table(d))
+        frames_equal(A.top5_per_reason(c), A.top5_per_reason(d))
+        frames_equal(A.reason_l1_share(c)[0], A.reason_l1_share(d)[0])
+        frames_equal(A.loss_by_reason(c, "l1"), A.loss_by_reason(d, "l1"))
+        for freq in ("D", "W", "M"):
+            frames_equal(A.event_return_rate(c, freq)[0], A.event_return_rate(d, freq)[0])
+        for level in ("category2", "category3"):
+            assert_frame_equal(A.heatmap(c, level)[0], A.heatmap(d, level)[0], check_dtype=False)
+        pc, _, ms_c, mr_c = A.scatter_quadrant(c)
+        pd_, _, ms_d, mr_d = A.scatter_quadrant(d)
+        frames_equal(pc, pd_)
+        assert (ms_c, mr_c) == (ms_d, mr_d) or (np.isnan(mr_c) and np.isnan(mr_d))
+        frames_equal(A.quadrant_matrix(pc, ms_c, mr_c), A.quadrant_matrix(pd_, ms_d, mr_d))
+
+def test_cube_keys_exclude_lag_and_tags(base):
+    """時滯與 L2 標籤不進 cube：cube 只比「商品 × 原因 × 訂單日 × 退貨日 × 是否退貨」細"""
+    c = A.build_cube(base)
+    assert "lag_days" not in c.columns and "tags_l2" not in c.columns
+    keys = [base["barcode"], base["reason_cat"], base["orderdate"].dt.floor("D"),
+            base["returndate"].dt.floor("D"), base["return_qty"] > 0]
+    assert len(c) == base.groupby(keys, observed=True, dropna=False).ngroups < len(base)
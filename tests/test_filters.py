@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import random
+import numpy as np
+import pandas as pd
+
+import analytic as A
+
+def mask_filter(df, f):
+    """原本的遮罩串接寫法（FilterIndex 之前的 apply_filters），當作比對基準"""
+    m = pd.Series(True, index=df.index)
+    for attr, col in A.FILTER_DIMS.items():
+        if getattr(f, attr):
+            m &= df[col].isin(getattr(f, attr))
+    for prefix, col in A.FILTER_DATES.items():
+        lo, hi = getattr(f, f"{prefix}_from"), getattr(f, f"{prefix}_to")
+        if lo:
+            m &= df[col] >= pd.Timestamp(lo)
+        if hi:
+            m &= df[col] < pd.Timestamp(hi)
+    return df[m]
+
+def random_filters(base, n=300, seed=16):
+    rnd = random.Random(seed)
+    values = {attr: sorted(base[col].dropna().unique()) + ["不存在"] for attr, col in A.FILTER_DIMS.items()}
+    days = [str(d.date()) for d in pd.date_range("2025-07-25", "2025-09-30")]
+    out = []
+    for _ in range(n):
+        kw = {}
+        for attr, vals in values.items():
+            if rnd.random() < 0.35:
+                kw[attr] = rnd.sample(vals, rnd.randint(1, min(5, len(vals))))
+        for prefix in A.FILTER_DATES:
+            if rnd.random() < 0.3:
+                kw[f"{prefix}_from"] = rnd.choice(days)
+            if rnd.random() < 0.3:
+                kw[f"{prefix}_to"] = rnd.choice(days)
+        out.append(A.Filters(**kw))
+    return out
+
+def test_index_matches_mask(base):
+    for f in random_filters(base):
+        got, exp = A.apply_filters(base, f), mask_filter(base, f)
+        assert got.index.equals(exp.index), f
+        assert A.filter_index(base).count(f) == len(exp)
+
+def test_no_conditions_returns_base_itself(base):
+    assert A.apply_filters(base, A.Filters()) is base
+
+def test_index_follows_frame_identity(base):
+    d = base.iloc[::2]
+    f = A.Filters(category2=sorted(base["category2"].dropna().unique())[:1])
+    assert A.filter_index(d) is not A.filter_index(base)
+    assert A.apply_filters(d, f).index.equals(mask_filter(d, f).index)
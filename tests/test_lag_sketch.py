@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+
+import analytic as A
+
+def sketch_filters(base):
+    rc = sorted(base["reason_cat"].dropna().unique())
+    c2 = sorted(base["category2"].dropna().unique())
+    month = base["returndate"].dropna().min().to_period("M")
+    return [A.Filters(), A.Filters(reason_l1=rc[:2]), A.Filters(category2=c2[:1]),
+            A.Filters(return_from=str(month.start_time.date()), return_to=str((month + 1).start_time.date()))]
+
+def test_sketch_matches_exact_on_sample_data(base):
+    idx = A.LagSketchIndex(base)
+    for f in sketch_filters(base):
+        exact = A.lag_stats(A.apply_filters(base, f))
+        got = idx.lag_stats(f)
+        # 整數天時滯在 50 天內：分位數與列順序都應與精確版相同
+        assert_frame_equal(got.reset_index(drop=True).assign(原因=lambda d: d["原因"].astype(str)),
+                           exact.reset_index(drop=True).assign(原因=lambda d: d["原因"].astype(str)),
+                           check_dtype=False)
+
+def test_zero_and_negative_lags_keep_counts_small(base):
+    d = base.copy()
+    has = np.flatnonzero(d["lag_days"].notna().to_numpy())
+    d.loc[d.index[has[0]], "lag_days"] = 0         # 當天退貨
+    d.loc[d.index[has[1]], "lag_days"] = -3        # 退貨日早於訂單日（資料錯誤）
+    idx = A.LagSketchIndex(d)
+    assert idx.counts.shape[1] < 64
+    assert idx.counts.nbytes < 1 << 20
+    exact = A.lag_stats(d).set_index("原因").sort_index()
+    got = idx.lag_stats(A.Filters()).set_index("原因").sort_index()
+    assert_frame_equal(got, exact, check_dtype=False, check_categorical=False, check_index_type=False)
+    assert got["最小(天)"].min() == -3
+
+def test_unsupported_filters_fall_back(base):
+    idx = A.LagSketchIndex(base)
+    assert idx.lag_stats(A.Filters(order_from="2025-08-01")) is None
+    assert idx.lag_stats(A.Filters(productid=["X"])) is None
+    assert idx.lag_stats(A.Filters(return_from="2025-08-15")) is None
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_error_bound_on_long_lags(seed):
+    rng = np.random.default_rng(seed)
+    n = 1001                                  # (n-1)·q 為整數：分位數不需內插，可直接檢查單點誤差界
+    lag = rng.integers(-30, 3650, n).astype("float64")
+    df = pd.DataFrame({"reason_cat": pd.Categorical(rng.choice(["甲"], n)),
+                       "category2": pd.Categorical(rng.choice(["a", "b"], n)),
+                       "category3": pd.Categorical(rng.choice(["x", "y", "z"], n)),
+                       "returndate": pd.Timestamp("2025-01-01") + pd.to_timedelta(rng.integers(0, 365, n), unit="D"),
+                       "lag_days": lag})
+    idx = A.LagSketchIndex(df, alpha=0.01)
+    got = idx.describe(np.arange(len(idx.cells)))
+    for q in A.LAG_PERCENTILES:
+        exact = float(np.sort(lag)[int((n - 1) * q)])
+        assert abs(got[A._pct_label(q)] - exact) <= 0.01 * abs(exact) + 0.5
+    assert got["count"] == n and got["min"] == lag.min() and got["max"] == lag.max()
+    assert got["mean"] == pytest.approx(lag.mean())
+    assert got["std"] == pytest.approx(lag.std(ddof=1))
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import threading
+import pytest
+
+import load_once as L
+from conftest import DATA
+
+'''
+    load_once 的串流 / 續傳測試：以記憶體內的假連線代替 MySQL。
+    假連線只認得 load_once 會送出的幾種 SQL（checkpoint 讀寫、executemany INSERT），
+    executemany 與 checkpoint 都先放在連線自己的交易裡，commit 才寫進共用的 FakeDB。
+'''
+
+class Crash(Exception):
+    pass
+
+class FakeDB:
+    """已 commit 的狀態：各表的列（依寫入順序）與 checkpoint"""
+    def __init__(self):
+        self.rows = {}
+        self.ckpt = {}
+        self.stmts = []              # INSERT 以外的 executemany（例如增量模式的 MOVED_SQL）
+        self.lock = threading.Lock()
+        self.fail_after = None       # 第幾次 executemany 時丟出 Crash（模擬中斷）
+        self.calls = 0
+
+    def connect(self):
+        conn = FakeConn(self)
+        return conn, conn.cursor()
+
+class FakeConn:
+    def __init__(self, db):
+        self.db = db
+        self.ops = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        with self.db.lock:
+            for kind, key, val in self.ops:
+                if kind == "rows":
+                    self.db.rows.setdefault(key, []).extend(val)
+                elif kind == "stmt":
+                    self.db.stmts.append((key, val))
+                else:
+                    self.db.ckpt[key] = val
+        self.ops = []
+
+    def close(self):
+        self.ops = []            # 沒 commit 的交易丟掉
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.result = []
+        self.rowcount = 0            # 假連線沒有既有列：MOVED_SQL 一律刪 0 列
+
+    def _ckpt(self):
+        view = dict(self.conn.db.ckpt)
+        view.update({k: v for kind, k, v in self.conn.ops if kind == "ckpt"})
+        return view
+
+    def execute(self, sql, params=()):
+        sql = " ".join(sql.split())
+        if sql.startswith(f"SELECT src, byte_offset, rows_done, done FROM {L.CKPT_TABLE}"):
+            hit = self._ckpt().get(params[0])
+            self.result = [hit] if hit else []
+        elif sql.startswith(f"INSERT INTO {L.CKPT_TABLE}"):
+            tbl, src, off, n, done = params
+            self.conn.ops.append(("ckpt", tbl, (src, off, n, done)))
+        elif sql.startswith(f"SELECT tbl FROM {L.CKPT_TABLE}"):
+            table = params[0]
+            self.result = [(k,) for k, v in self._ckpt().items()
+                           if (k == table or k.startswith(f"{table}#")) and not v[3]]
+        elif sql.startswith(f"DELETE FROM {L.CKPT_TABLE}"):
+            self.conn.db.ckpt.clear()
+        else:
+            raise AssertionError(f"FakeCursor 不認得的 SQL：{sql}")
+
+    def executemany(self, sql, rows):
+        db = self.conn.db
+        with db.lock:
+            db.calls += 1
+            if db.fail_after is not None and db.calls > db.fail_after:
+                raise Crash()
+        verb, _, table = sql.split()[:3]
+        self.conn.ops.append(("rows", table, list(rows)) if verb == "INSERT" else ("stmt", sql, list(rows)))
+
+    def fetchone(self):
+        return self.result[0] if self.result else None
+
+    def fetchall(self):
+        return list(self.result)
+
+    def close(self):
+        pass
+
+@pytest.fixture
+def orders_csv(tmp_path):
+    path = tmp_path / "orders.csv"
+    shutil.copy(os.path.join(DATA, "orders.csv"), path)
+    return str(path)
+
+def expected_rows(path, table="orders"):
+    return list(L.iter_rows(path, table))
+
+def test_stream_table_loads_every_row_once(orders_csv):
+    db = FakeDB()
+    conn, cur = db.connect()
+    n, total, _ = L.stream_table(conn, cur, "orders", orders_csv, batch_size=100, commit_every=3)
+    assert n == total == len(expected_rows(orders_csv)) == 4940
+    assert db.rows["orders"] == expected_rows(orders_csv)
+    src, off, rows, done = db.ckpt["orders"]
+    assert (off, rows, done) == (os.path.getsize(orders_csv), n, 1)
+    assert L.stream_table(conn, cur, "orders", orders_csv) is None      # 已完成：略過
+
+def test_stream_table_resumes_after_crash(orders_csv):
+    db = FakeDB()
+    db.fail_after = 7                    # 第 8 批時中斷：已 commit 的是前 6 批（每 3 批 commit）
+    conn, cur = db.connect()
+    with pytest.raises(Crash):
+        L.stream_table(conn, cur, "orders", orders_csv, batch_size=100, commit_every=3)
+    conn.close()
+    assert len(db.rows["orders"]) == 600 and db.ckpt["orders"][2:] == (600, 0)
+
+    db.fail_after = None
+    conn, cur = db.connect()
+    n, total, _ = L.stream_table(conn, cur, "orders", orders_csv, batch_size=100, commit_every=3)
+    assert (n, total) == (4340, 4940)
+    assert db.rows["orders"] == expected_rows(orders_csv)              # 不漏、不重複、順序相同
+
+def test_changed_source_resets_checkpoint(orders_csv):
+    db = FakeDB()
+    conn, cur = db.connect()
+    L.stream_table(conn, cur, "orders", orders_csv, batch_size=500)
+    with open(orders_csv, "a", encoding="utf-8") as f:
+        f.write("Z999,2025-09-01 00:00:00,A010100010102,1\n")
+    n, total, _ = L.stream_table(conn, cur, "orders", orders_csv, batch_size=500)
+    assert n == total == 4941
+
+# ===== 平行切段（split_ranges / parallel_table） =====
+@pytest.mark.parametrize("n", [1, 2, 3, 7, 16])
+def test_split_ranges_cover_file_on_line_starts(orders_csv, n):
+    ranges = L.split_ranges(orders_csv, n)
+    with open(orders_csv, "rb") as f:
+        data = f.read()
+    assert ranges[0][0] == data.index(b"\n") + 1 and ranges[-1][1] == len(data)
+    assert all(a[1] == b[0] for a, b in zip(ranges, ranges[1:]))
+    assert all(data[s - 1:s] == b"\n" for s, _ in ranges)
+    rows = []
+    for s, e in ranges:
+        stream = L.CsvStream(orders_csv, "orders", offset=s, end=e)
+        rows += list(stream)
+    assert rows == list(L.CsvStream(orders_csv, "orders"))
+
+def test_parallel_table_matches_single_stream(orders_csv, monkeypatch):
+    db = FakeDB()
+    monkeypatch.setattr(L, "open_conn", db.connect)
+    conn, cur = db.connect()
+    res = L.parallel_table(cur, "orders", orders_csv, 4, batch_size=100, commit_every=2)
+    assert [k for k, _ in res] == [f"orders#{k}/4" for k in range(4)]
+    assert sum(r[0] for _, r in res) == 4940
+    assert sorted(db.rows["orders"]) == sorted(expected_rows(orders_csv))
+    assert all(L.parallel_table(cur, "orders", orders_csv, 4)[k][1] is None for k in range(4))
+
+def test_parallel_resume_requires_same_workers(orders_csv, monkeypatch):
+    db = FakeDB()
+    monkeypatch.setattr(L, "open_conn", db.connect)
+    conn, cur = db.connect()
+    db.fail_after = 10
+    with pytest.raises(Crash):
+        L.parallel_table(cur, "orders", orders_csv, 3, batch_size=100, commit_every=2)
+    with pytest.raises(RuntimeError):
+        L.parallel_table(cur, "orders", orders_csv, 2, batch_size=100)     # 切段不同會重複匯入
+    db.fail_after = None
+    L.parallel_table(cur, "orders", orders_csv, 3, batch_size=100, commit_every=2)
+    assert sorted(db.rows["orders"]) == sorted(expected_rows(orders_csv))
+
+# ===== 欄式驗證與拒絕檔 =====
+def test_int_columns_accept_what_int_accepts():
+    rows = [["O1", "2025-08-01 00:00:00", "B1", v] for v in ["-1", "+2", " 3 ", "１２", "1_000", "2.0", "abc", "1.5", ""]]
+    records, rejects = L.parse_block("orders", [0, 1, 2, 3], 4, rows)
+    assert [r[3] for r in records] == [-1, 2, 3, 12, 1000, 2]
+    assert [why for _, why in rejects] == ["sell_qty 非整數", "sell_qty 非整數", "缺少 sell_qty"]
+
+def test_validator_writes_rejects_with_reasons(tmp_path):
+    for name in ("product.csv", "orders.csv"):
+        shutil.copy(os.path.join(DATA, name), tmp_path / name)
+    with open(tmp_path / "orders.csv", "a", encoding="utf-8") as f:
+        f.write("Z1,2025-09-01 00:00:00,NOPE,1\n"           # barcode 不存在
+                "Z2,2025-09-01 00:00:00,A010100010102,x\n"   # 非整數
+                "Z3,,A010100010102,1\n"                      # 缺訂單日
+                "Z4,2025-09-01 00:00:00\n")                  # 欄位數不符
+    with open(tmp_path / "returns.csv", "w", encoding="utf-8") as f:
+        f.write("orderid,returndate,barcode,return_qty,reason\n"
+                "A202508160001,2025-08-20 00:00:00,A010100020203,1,ok\n"
+                "A202508160001,2025-08-20 00:00:00,A010100020203,3,too many\n"
+                "NOORDER,2025-08-20 00:00:00,A010100020203,1,no order\n")
+    reject = tmp_path / "rejects.csv"
+    v = L.Validator(str(reject))
+    db = FakeDB()
+    conn, cur = db.connect()
+    for table in L.LOAD_ORDER:
+        L.stream_table(conn, cur, table, str(tmp_path / L.FILES[table]), validator=v)
+    assert len(db.rows["orders"]) == 4940 and len(db.rows["returns"]) == 1
+    assert v.stats == {("orders", "barcode 不存在於 product"): 1, ("orders", "sell_qty 非整數"): 1,
+                       ("orders", "缺少 orderdate"): 1, ("orders", "欄位數不符(2≠4)"): 1,
+                       ("returns", "退貨量大於銷售量"): 1, ("returns", "找不到對應訂單(orderid, barcode)"): 1}
+    with open(reject, encoding="utf-8-sig") as f:
+        lines = f.read().splitlines()
+    assert lines[0] == "table,reason,row" and len(lines) == 7
+    assert "orders,barcode 不存在於 product,Z1,2025-09-01 00:00:00,NOPE,1" in lines
+
+# ===== 增量模式 =====
+def test_delta_filter_compares_parsed_dates():
+    from datetime import datetime
+    keep = L.delta_filter(None, "orders", {"orders": (datetime(2025, 1, 5, 12), 10)})
+    rows = [("O1", d, "B1", 1) for d in ["2025/1/5 13:00", "2025-01-05 11:00:00", "2025/1/10",
+                                          "2024/12/31 23:59:59", "2025-01-05 12:00:00", "壞日期"]]
+    assert [r[1] for r in keep(rows)] == ["2025/1/5 13:00", "2025/1/10", "2025-01-05 12:00:00", "壞日期"]
+    keep = L.delta_filter(None, "orders", {"orders": (datetime(2025, 1, 5, 12), 10)}, lookback_days=1)
+    assert len(keep(rows)) == 5
+    assert keep([]) == []
+
+def test_duplicate_order_lines_rejected_and_repeat_returns_kept(tmp_path):
+    for name in ("product.csv", "orders.csv"):
+        shutil.copy(os.path.join(DATA, name), tmp_path / name)
+    with open(tmp_path / "orders.csv", "a", encoding="utf-8") as f:
+        f.write("A202508160001,2025-08-16 03:33:29,A010100020203,5\n")      # 同一明細再出現一次
+    with open(tmp_path / "returns.csv", "w", encoding="utf-8") as f:
+        f.write("orderid,returndate,barcode,return_qty,reason\n"
+                "A202508160001,2025-08-20 00:00:00,A010100020203,1,first\n"
+                "A202508160001,2025-08-25 00:00:00,A010100020203,1,second\n")  # 同一明細第二次退貨
+    v = L.Validator(str(tmp_path / "rejects.csv"))
+    db = FakeDB()
+    conn, cur = db.connect()
+    for table in L.LOAD_ORDER:
+        L.stream_table(conn, cur, table, str(tmp_path / L.FILES[table]), validator=v)
+    assert v.stats == {("orders", "訂單明細重複(orderid, barcode)"): 1}
+    assert len(db.rows["orders"]) == 4940 and len(db.rows["returns"]) == 2
+    assert v.order_qty["A202508160001\x1fA010100020203"] == 2
+
+def test_incremental_orders_replace_moved_lines(orders_csv):
+    db = FakeDB()
+    conn, cur = db.connect()
+    L.stream_table(conn, cur, "orders", orders_csv, batch_size=1000, delta=lambda rows: rows[:2])
+    exp = [r for k in range(0, 4940, 1000) for r in expected_rows(orders_csv)[k:k + 2]]   # 每批前兩列
+    assert db.rows["orders"] == exp
+    assert [sql for sql, _ in db.stmts] == [L.MOVED_SQL["orders"]] * 5
+    assert [p for _, params in db.stmts for p in params] == [(r[0], r[2], r[1]) for r in exp]
+
+def test_moved_lines_log_whole_table_change(orders_csv, monkeypatch):
+    """舊列真的被刪掉（訂單日被更正）時，記一筆整張表的變更（舊訂單日不知道）"""
+    db = FakeDB()
+    conn, cur = db.connect()
+    monkeypatch.setattr(cur, "rowcount", 1)
+    L.stream_table(conn, cur, "orders", orders_csv, batch_size=1000, delta=lambda rows: rows[:2])
+    assert db.rows["data_change"] == [("orders", None, None)] * 5
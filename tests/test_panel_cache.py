@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import threading
+import pandas as pd
+
+import analytic as A
+
+def frame(n):
+    return pd.DataFrame({"x": range(n)})
+
+def test_hit_and_miss_counts():
+    pc, calls = A.PanelCache(), []
+    f = A.Filters(category2=["a"])
+    compute = lambda: calls.append(1) or frame(3)
+    first = pc.get_or_compute("v1", f, "kpi", compute)
+    assert pc.get_or_compute("v1", A.Filters(category2=["a"]), "kpi", compute) is first
+    pc.get_or_compute("v1", f, "lag", compute)
+    info = pc.info()
+    assert len(calls) == 2 and (info["hits"], info["misses"], info["entries"]) == (1, 2, 2)
+    assert info["bytes"] == 2 * A._nbytes(frame(3))
+
+def test_evicts_least_recently_used_by_bytes():
+    size = A._nbytes(frame(100))
+    pc = A.PanelCache(max_bytes=size * 2)
+    f = A.Filters()
+    for name in ("a", "b"):
+        pc.get_or_compute(1, f, name, lambda: frame(100))
+    pc.get_or_compute(1, f, "a", lambda: frame(100))               # a 變成最近用過
+    pc.get_or_compute(1, f, "c", lambda: frame(100))               # 擠掉 b
+    assert pc.info()["evictions"] == 1 and pc.bytes <= pc.max_bytes
+    assert [k[1] for k in pc._d] == ["a", "c"]
+
+def test_oversize_value_is_returned_but_not_stored():
+    pc = A.PanelCache(max_bytes=100)
+    big = frame(1000)
+    assert pc.get_or_compute(1, A.Filters(), "big", lambda: big) is big
+    assert pc.info()["entries"] == 0 and pc.bytes == 0
+
+def test_version_change_clears():
+    pc = A.PanelCache()
+    f = A.Filters()
+    old = pc.get_or_compute("v1", f, "kpi", lambda: {"n": 1})
+    new = pc.get_or_compute("v2", f, "kpi", lambda: {"n": 2})
+    assert old == {"n": 1} and new == {"n": 2}
+    assert pc.info()["entries"] == 1 and pc.version == "v2"
+    pc.clear("v3")
+    assert pc.info()["entries"] == 0 and pc.bytes == 0
+
+def test_result_computed_across_version_swap_is_not_stored():
+    """計算期間資料換版：舊版本的結果照樣回傳，但不放進新版本的快取"""
+    pc = A.PanelCache()
+    f = A.Filters()
+    started, swapped = threading.Event(), threading.Event()
+    def slow():
+        started.set()
+        swapped.wait(5)
+        return "old"
+    out = []
+    t = threading.Thread(target=lambda: out.append(pc.get_or_compute("v1", f, "kpi", slow)))
+    t.start()
+    started.wait(5)
+    assert pc.get_or_compute("v2", f, "kpi", lambda: "new") == "new"
+    swapped.set()
+    t.join(5)
+    assert out == ["old"]
+    assert pc.get_or_compute("v2", f, "kpi", lambda: "again") == "new"
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+
+import analytic as A
+import partitions as P
+from conftest import copies, write_sqlite, canon
+
+MONTHS = 14
+
+@pytest.fixture(scope="module")
+def shifted(sources):
+    """訂單依 orderid 平移 0~13 個月（退貨跟著平移），前 5 筆訂單日設為 NULL，讓資料跨多個分區"""
+    p, o, r, links, names = copies(sources)
+    ids = pd.Index(o["orderid"].unique())
+    shift = pd.Series(pd.util.hash_array(ids.astype(str).to_numpy()) % MONTHS, index=ids)
+    o["orderdate"] = pd.to_datetime(o["orderdate"]) + pd.to_timedelta(o["orderid"].map(shift) * 30, unit="D")
+    r["returndate"] = pd.to_datetime(r["returndate"]) + pd.to_timedelta(r["orderid"].map(shift).fillna(0) * 30, unit="D")
+    o.loc[o.index[:5], "orderdate"] = pd.NaT
+    return p, o, r, links, names
+
+@pytest.fixture(scope="module")
+def ds(shifted, tmp_path_factory):
+    tmp = tmp_path_factory.mktemp("parts")
+    eng = P.sqlite_engine(str(tmp / "src.db"))
+    write_sqlite(eng, *copies(shifted))
+    root = str(tmp / "parts")
+    m = P.build_partitions(eng, root, version="v1")
+    assert len(m["partitions"]) > 10 and m["partitions"][-1]["month"] == P.NO_DATE
+    assert P.build_partitions(eng, root, version="v1")["created_at"] == m["created_at"]   # 版本沒變不重建
+    return P.PartitionedBase(root)
+
+@pytest.fixture(scope="module")
+def full(shifted):
+    return A.build_base(*copies(shifted))
+
+def part_filters(full, ds):
+    c2 = sorted(full["category2"].dropna().unique())
+    c3 = sorted(full["category3"].dropna().unique())
+    rc = sorted(full["reason_cat"].dropna().unique())
+    months = sorted(p["month"] for p in ds.manifest["partitions"] if p["month"] != P.NO_DATE)
+    return [A.Filters(), A.Filters(category2=c2[:1]), A.Filters(category3=c3[:3], reason_l1=rc[:2]),
+            A.Filters(order_from=months[1] + "-10", order_to=months[-1] + "-05"),
+            A.Filters(return_from=months[-1] + "-01", reason_l1=rc[:2]),
+            A.Filters(order_from="2099-01-01")]
+
+def test_panels_match_full_base(ds, full):
+    for f in part_filters(full, ds):
+        d = A.apply_filters(full, f)
+        assert P.kpi_cards(ds, f) == A.kpi_cards(d)
+        assert_frame_equal(canon(P.lag_stats(ds, f)), canon(A.lag_stats(d)), check_dtype=False)
+        for freq in ("D", "W", "M"):
+            assert_frame_equal(canon(P.event_return_rate(ds, f, freq)[0]), canon(A.event_return_rate(d, freq)[0]),
+                               check_dtype=False)
+        assert_frame_equal(canon(P.reason_l1_share(ds, f)[0]), canon(A.reason_l1_share(d)[0]), check_dtype=False)
+        for level in ("category1", "category3"):
+            got, exp = P.heatmap(ds, f, level)[0], A.heatmap(d, level)[0]
+            assert_frame_equal(got.sort_index().sort_index(axis=1), exp.sort_index().sort_index(axis=1),
+                               check_dtype=False, check_categorical=False, check_index_type=False,
+                               check_column_type=False, check_names=False)
+        for level in ("l1", "l2"):
+            assert_frame_equal(canon(P.loss_by_reason(ds, f, level)), canon(A.loss_by_reason(d, level)),
+                               check_dtype=False)
+        assert P.row_count(ds, f) == len(d)
+
+def test_product_panels_match_full_base(ds, full):
+    for f in part_filters(full, ds):
+        d = A.apply_filters(full, f)
+        # 分區只認得自己出現過的類別值：比值不比類別集合
+        kw = dict(check_dtype=False, check_categorical=False)
+        assert_frame_equal(P.summary_table(ds, f), A.summary_table(d), **kw)
+        got, exp = P.scatter_quadrant(ds, f), A.scatter_quadrant(d)
+        assert_frame_equal(got[0], exp[0], **kw)
+        assert got[2:] == pytest.approx(exp[2:])
+        assert_frame_equal(A.quadrant_matrix(got[0], *got[2:]), A.quadrant_matrix(exp[0], *exp[2:]), **kw)
+        for denom in ("total", "reason"):
+            assert_frame_equal(P.top5_per_reason(ds, f, denom=denom), A.top5_per_reason(d, denom=denom), **kw)
+        for level, top in (("category2", None), ("category3", None), ("barcode", 30)):
+            got, exp = P.tag_heatmap(ds, f, level, top=top)[0], A.tag_heatmap(d, level, top=top)[0]
+            assert_frame_equal(got, exp, check_index_type=False, check_column_type=False, **kw)
+
+def test_partials_do_not_grow_with_rows(ds, full):
+    """合併後的部分彙總只跟維度有關：遠小於明細列數"""
+    agg = ds.aggregate(A.Filters())
+    assert agg["lag"]["rows"].sum() == len(full)
+    assert len(agg["lag"]) <= full["reason_cat"].nunique(dropna=False) * (full["lag_days"].nunique() + 1)
+    assert len(agg["sales"]) <= full["orderdate"].dt.floor("D").nunique() + 1
+    assert len(agg["product"]) == full["barcode"].nunique()
+    assert len(agg["product_reason"]) <= full["barcode"].nunique() * (full["reason_cat"].nunique() + 1) * 2
+    assert sum(len(d) for d in agg.values()) < len(full)
+
+def test_aggregate_reads_partitions_once_per_filter(ds, full, monkeypatch):
+    """同一篩選條件的多個面板共用一次合併結果（分區只讀一次），與並行呼叫無關"""
+    f = A.Filters(category2=sorted(full["category2"].dropna().unique())[1:2])
+    loads = []
+    load = P.PartitionedBase.load
+    monkeypatch.setattr(P.PartitionedBase, "load", lambda self, part: loads.append(part["month"]) or load(self, part))
+    with ThreadPoolExecutor(4) as pool:
+        list(pool.map(lambda fn: fn(ds, f), [P.kpi_cards, P.summary_table, P.top5_per_reason, P.lag_stats]))
+    assert sorted(loads) == sorted(p["month"] for p in ds.partitions(f))
+
+def test_refreshed_follows_manifest(shifted, tmp_path):
+    eng = P.sqlite_engine(str(tmp_path / "src.db"))
+    write_sqlite(eng, *copies(shifted))
+    root = str(tmp_path / "parts")
+    P.build_partitions(eng, root, version="v1")
+    ds = P.PartitionedBase(root)
+    assert ds.refreshed() is ds
+    P.build_partitions(eng, root, version="v2")
+    new = ds.refreshed()
+    assert new is not ds and new.version == "v2" and new.refreshed() is new
+    assert P.row_count(new, A.Filters()) == sum(p["rows"] for p in new.manifest["partitions"])
+
+def test_pruning_skips_partitions(ds):
+    months = sorted(p["month"] for p in ds.manifest["partitions"] if p["month"] != P.NO_DATE)
+    picked = ds.partitions(A.Filters(order_from=months[2] + "-01", order_to=months[3] + "-01"))
+    assert [p["month"] for p in picked] == [months[2]]
+    assert P.NO_DATE in [p["month"] for p in ds.partitions(A.Filters())]
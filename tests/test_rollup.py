@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+from sqlalchemy import text
+
+import analytic as A
+import rollup as R
+from conftest import copies, write_sqlite, canon, record_change
+
+CUT = "2025-08-20"
+RETURN_TABLES = ["returns_clean", "return_tags"]
+
+def order_days(o, r):
+    """退貨對到的訂單日（寫入端 clear.py 記的變更範圍）"""
+    d = r.merge(o, on=["orderid", "barcode"])
+    return sorted({(x, x) for x in pd.to_datetime(d["orderdate"]).dt.strftime("%Y-%m-%d")})
+
+def build(sources, path):
+    """先放 CUT 之前的訂單與前 70% 的退貨做全量刷新，再補上其餘資料做增量刷新（含舊訂單上的晚到退貨）"""
+    p, o, r, links, names = copies(sources)
+    eng = R.sqlite_engine(str(path))
+    old_o = pd.to_datetime(o["orderdate"]) < CUT
+    old_r = r["return_id"] <= r["return_id"].quantile(0.7)
+    old_l = links["return_id"].isin(r.loc[old_r, "return_id"])
+    write_sqlite(eng, p, o[old_o], r[old_r], links[old_l], names)
+    record_change(eng, R.ROLLUP_SOURCES)
+    assert R.refresh_rollups(eng)["mode"] == "full"
+    write_sqlite(eng, None, o[~old_o], r[~old_r], links[~old_l], None, if_exists="append")
+    record_change(eng, ["orders"], [(CUT, None)])
+    record_change(eng, RETURN_TABLES, order_days(o, r[~old_r]))
+    res = R.refresh_rollups(eng)
+    assert res["mode"] == "incremental" and res["ranges"][0][0] < CUT and res["ranges"][-1][1] is None
+    return eng
+
+@pytest.fixture(scope="module")
+def eng(sources, tmp_path_factory):
+    return build(sources, tmp_path_factory.mktemp("rollup") / "src.db")
+
+def rollup_rows(eng):
+    with eng.connect() as conn:
+        return {t: canon(pd.read_sql(text(f"SELECT * FROM {t}"), conn)) for t in (R.DAILY, R.TAGS)}
+
+def assert_matches_full(eng):
+    inc = rollup_rows(eng)
+    assert R.refresh_rollups(eng, full=True)["mode"] == "full"
+    full = rollup_rows(eng)
+    for t in inc:
+        assert_frame_equal(inc[t], full[t])
+
+def test_incremental_equals_full_refresh(eng):
+    assert_matches_full(eng)
+
+def test_merge_ranges():
+    d = pd.Timestamp
+    assert R.merge_ranges([(d("2025-08-05"), d("2025-08-06")), (d("2025-08-01"), d("2025-08-05")),
+                           (d("2025-08-10"), None), (d("2025-08-12"), d("2025-08-13"))]) == \
+        [(d("2025-08-01"), d("2025-08-06")), (d("2025-08-10"), None)]
+
+@pytest.mark.parametrize("change", ["price", "reclassify", "purge", "late_order", "unlogged"])
+def test_in_place_changes(sources, tmp_path, change):
+    """原地改值（改價、重分類、刪除退貨、舊日期的訂單、沒留紀錄的寫入）後增量刷新仍與整表重建相同"""
+    eng = build(sources, tmp_path / "src.db")
+    with eng.begin() as conn:
+        r = pd.read_sql(text("SELECT r.return_id, r.reason_category_l1, DATE(o.orderdate) AS day FROM returns_clean r "
+                             "JOIN orders o ON o.orderid = r.orderid AND o.barcode = r.barcode "
+                             "WHERE o.orderdate < :cut ORDER BY r.return_id"), conn, params={"cut": CUT})
+        rid, day = int(r["return_id"].iloc[0]), r["day"].iloc[0]
+        if change == "price":
+            conn.execute(text("UPDATE product SET sellprice = sellprice + 100 WHERE barcode IN "
+                              "(SELECT barcode FROM returns_clean WHERE return_id = :rid)"), {"rid": rid})
+        elif change == "reclassify":
+            cat = "其他" if r["reason_category_l1"].iloc[0] != "其他" else "品質瑕疵"
+            conn.execute(text("UPDATE returns_clean SET reason_category_l1 = :c WHERE return_id = :rid"),
+                         {"c": cat, "rid": rid})
+            conn.execute(text("DELETE FROM return_tags WHERE return_id = :rid"), {"rid": rid})
+        elif change in ("purge", "unlogged"):
+            for t in RETURN_TABLES:
+                conn.execute(text(f"DELETE FROM {t} WHERE return_id = :rid"), {"rid": rid})
+        else:
+            o = pd.read_sql(text("SELECT * FROM orders WHERE DATE(orderdate) = :d LIMIT 1"), conn, params={"d": day})
+            o.assign(orderid="LATE0001").to_sql("orders", conn, index=False, if_exists="append")
+    if change == "price":
+        record_change(eng, ["product"])
+    elif change == "late_order":
+        record_change(eng, ["orders"], [(day, None)])
+    else:
+        record_change(eng, RETURN_TABLES, [] if change == "unlogged" else [(day, day)])
+    res = R.refresh_rollups(eng)
+    if change in ("price", "unlogged"):
+        assert res["mode"] == "full"
+    else:
+        assert res["mode"] == "incremental" and res["ranges"][0][0] == day
+    assert_matches_full(eng)
+
+def test_unchanged_versions_skip_work(eng):
+    assert R.refresh_rollups(eng)["ranges"] == []
+
+def test_panels_match_detail(eng, base, sample_filters):
+    for f in sample_filters:
+        d = A.apply_filters(base, f)
+        assert R.kpi_cards(eng, f) == A.kpi_cards(d)
+        for freq in ("D", "M"):
+            assert_frame_equal(canon(R.event_return_rate(eng, f, freq)[0]), canon(A.event_return_rate(d, freq)[0]),
+                               check_dtype=False)
+        assert_frame_equal(canon(R.reason_l1_share(eng, f)[0]), canon(A.reason_l1_share(d)[0]), check_dtype=False)
+        for level in ("category2", "category3"):
+            assert_frame_equal(canon(R.heatmap(eng, f, level)[0].reset_index()),
+                               canon(A.heatmap(d, level)[0].reset_index()), check_dtype=False)
+        for level in ("l1", "l2"):
+            assert_frame_equal(canon(R.loss_by_reason(eng, f, level)), canon(A.loss_by_reason(d, level)),
+                               check_dtype=False, rtol=1e-9)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import os
+import random
+import re
+import unicodedata
+import pandas as pd
+import pytest
+
+import return_reason_cata as C
+from conftest import DATA
+
+def reference_classify(text):
+    """逐條 re.finditer 的原始寫法（RuleEngine 之前的 classify_reason），當作比對基準"""
+    if not isinstance(text, str):
+        t = ""
+    else:
+        t = re.sub(r"\s+", "", unicodedata.normalize("NFKC", text).lower())
+        for k, v in C.SYNONYMS.items():
+            t = t.replace(k, v)
+    scores = {c: 0 for c in set(r["category"] for r in C.RULES)}
+    tags, matches = [], []
+    for rule in C.RULES:
+        for m in re.finditer(rule["pattern"], t):
+            scores[rule["category"]] += 1
+            tags.append(rule["tag"])
+            matches.append({"category": rule["category"], "tag": rule["tag"], "pattern": rule["pattern"],
+                            "text": m.group(0), "start": m.start(), "end": m.end()})
+    tags = list(dict.fromkeys(tags))
+    if any(scores.values()):
+        top = max(scores.values())
+        primary = sorted([c for c, s in scores.items() if s == top], key=C.PRIORITY.index)[0]
+    else:
+        primary = "其他"
+    return primary, tags, matches
+
+def fuzz_texts(n=3000, seed=6):
+    """規則關鍵字、同義詞（含重疊的 錯寄錯）與雜訊隨機拼接"""
+    pieces = [a for r in C.RULES for a in (C.rule_anchors(r["pattern"]) or [])]
+    pieces += list(C.SYNONYMS) + list(C.SYNONYMS.values()) + ["錯寄錯", "太", "偏", "不", "ＡＢ", " ", "，", "了"]
+    rnd = random.Random(seed)
+    return ["".join(rnd.choice(pieces) for _ in range(rnd.randint(1, 8))) for _ in range(n)]
+
+@pytest.fixture(scope="module")
+def reasons():
+    r = pd.read_csv(os.path.join(DATA, "returns.csv"), encoding="utf-8-sig")["reason"]
+    return r.tolist() + fuzz_texts() + [None, 123, "", "   "]
+
+def test_engine_matches_reference(reasons):
+    for x in reasons:
+        assert C.classify_reason(x) == reference_classify(x), x
+
+def test_classify_many_matches_single(reasons):
+    C.clear_classify_cache()
+    expected = [C.classify_reason(x) for x in reasons]
+    assert C.classify_many(reasons) == expected
+    assert C.classify_many(reasons) == expected          # 第二次全部命中快取
+    assert C.classify_many(reasons, use_cache=False) == expected
+
+def test_rule_edit_invalidates_cache(monkeypatch):
+    text = "尺寸太小想換貨"
+    before = C.classify_many([text])[0]
+    rules = C.RULES + [{"category": "個人因素", "tag": "換貨", "pattern": r"換貨"}]
+    monkeypatch.setattr(C, "RULES", rules)
+    after = C.classify_many([text])[0]
+    assert "換貨" in after[1] and "換貨" not in before[1]
+    monkeypatch.undo()
+    assert C.classify_many([text])[0] == before
+
+def test_parallel_uses_cache(reasons):
+    """多 process 路徑同樣先查快取：第二次全部命中，不再派工"""
+    texts = [x for x in reasons if isinstance(x, str)] + fuzz_texts(n=4000, seed=11)
+    expected = [C.classify_reason(x) for x in texts]
+    C.clear_classify_cache()
+    try:
+        assert C.classify_many(texts, workers=2) == expected
+        cold = C.classify_cache_info()
+        assert cold["hits"] == 0 and cold["misses"] == cold["size"] > 1000
+        assert C.classify_many(texts, workers=2) == expected
+        warm = C.classify_cache_info()
+        assert warm["hits"] == cold["misses"] and warm["misses"] == cold["misses"]
+        assert C.classify_many(texts[:50], workers=2) == expected[:50]     # 與單 process 共用同一把鍵
+        assert C.classify_many(texts[:50]) == expected[:50]
+        assert C.classify_cache_info()["misses"] == cold["misses"]
+    finally:
+        C.shutdown_pool()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import pytest
+
+import analytic as A
+
+@pytest.fixture
+def sched():
+    s = A.PanelScheduler(max_workers=4)
+    yield s
+    s.pool.shutdown(wait=True)
+
+def test_dependencies_get_results(sched):
+    tasks = {"a": (lambda: 2, ()), "b": (lambda: 3, ()),
+             "c": (lambda a, b: a * b, ("a", "b")), "d": (lambda c: c + 1, ("c",))}
+    out, timings = sched.run(tasks)
+    assert out == {"a": 2, "b": 3, "c": 6, "d": 7}
+    assert set(timings) == set(tasks) and sched.last["panels"] == timings
+    assert sorted(sched.info()["面板"]) == ["a", "b", "c", "d"]
+
+def test_independent_panels_overlap(sched):
+    barrier = threading.Barrier(3, timeout=5)     # 三個面板要同時在跑才會過
+    out, _ = sched.run({k: (lambda: barrier.wait() is not None, ()) for k in "abc"})
+    assert out == {"a": True, "b": True, "c": True}
+
+def test_error_propagates_after_running_panels_finish(sched):
+    ran, finished = [], threading.Event()
+    def slow():
+        time.sleep(0.2)
+        finished.set()
+        return 1
+    def boom():
+        raise ZeroDivisionError("boom")
+    tasks = {"slow": (slow, ()), "boom": (boom, ()), "after": (lambda x: ran.append(x), ("boom",))}
+    with pytest.raises(ZeroDivisionError, match="boom"):
+        sched.run(tasks)
+    assert finished.is_set() and ran == []           # 已送出的面板跑完才拋；依賴失敗面板的不送出
+    assert sched.info().empty                        # 失敗的一批不計入統計
+    assert sched.run({"ok": (lambda: 1, ())})[0] == {"ok": 1}
+
+def test_first_error_wins(sched):
+    gate = threading.Event()
+    def first():
+        raise KeyError("first")
+    def second():
+        gate.wait(5)
+        raise ValueError("second")
+    # second 等 first 失敗之後才拋：只留第一個例外
+    tasks = {"first": (first, ()), "second": (second, ()), "open": (lambda: (time.sleep(0.1), gate.set()), ())}
+    with pytest.raises(KeyError, match="first"):
+        sched.run(tasks)
+
+def test_bad_dependencies(sched):
+    with pytest.raises(KeyError):
+        sched.run({"a": (lambda x: x, ("missing",))})
+    with pytest.raises(ValueError, match="循環"):
+        sched.run({"a": (lambda b: b, ("b",)), "b": (lambda a: a, ("a",)), "c": (lambda: 1, ())})
+
+def test_timeout_cancels_pending_panels(sched):
+    release, started = threading.Event(), []
+    def stuck():
+        started.append("stuck")
+        release.wait(5)
+        return 0
+    tasks = {"stuck": (stuck, ()), "fast": (lambda: 1, ()), "dep": (lambda s: started.append("dep"), ("stuck",))}
+    t0 = time.perf_counter()
+    with pytest.raises(TimeoutError, match="stuck"):
+        sched.run(tasks, timeout=0.2)
+    assert time.perf_counter() - t0 < 2
+    release.set()
+    assert sched.run({"fast": (lambda: 1, ())}, timeout=5)[0] == {"fast": 1}
+    assert "dep" not in started
+
+def test_concurrent_runs_share_pool(sched):
+    outs = {}
+    def one(i):
+        outs[i] = sched.run({"x": (lambda: i, ()), "y": (lambda x: x * 10, ("x",))})[0]
+    threads = [threading.Thread(target=one, args=(i,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(10)
+    assert outs == {i: {"x": i, "y": i * 10} for i in range(8)}
+    assert sched.info().set_index("面板").loc["y", "次數"] == 8
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import load_once as L
+import schema as S
+
+def test_returns_key_allows_repeat_returns_of_a_line():
+    sql = " ".join(S.create_table_sql("returns").split())
+    assert "UNIQUE KEY uk_returns_natural (orderid, barcode, returndate)" in sql
+    assert "UNIQUE KEY uk_returns_natural (orderid, barcode)," not in sql
+    upsert = L.insert_sql("returns", upsert=True)
+    assert upsert.endswith("ON DUPLICATE KEY UPDATE return_qty=VALUES(return_qty), reason=VALUES(reason)")
+
+def test_partitioned_orders_unique_key_includes_orderdate():
+    sql = " ".join(S.create_table_sql("orders", partition=("2025-01", "2025-03")).split())
+    assert "UNIQUE KEY uk_orders_natural (orderid, barcode, orderdate)" in sql
+    assert "PARTITION p202503 VALUES LESS THAN ('2025-04-01')" in sql
+
+class IndexCursor:
+    """ensure_indexes 用到的 information_schema 查詢 + 記下 ALTER TABLE"""
+    def __init__(self, have):
+        self.have, self.ddl, self.result = have, [], []
+
+    def execute(self, sql, params=()):
+        sql = " ".join(sql.split())
+        if "information_schema.TABLES" in sql:
+            self.result = [(1,)]
+        elif "information_schema.PARTITIONS" in sql:
+            self.result = [(0,)]
+        elif "information_schema.STATISTICS" in sql:
+            self.result = [(n, 0 if u else 1, ",".join(c)) for n, (u, c) in self.have.get(params[0], {}).items()]
+        else:
+            self.ddl.append(sql)
+
+    def fetchone(self):
+        return self.result[0]
+
+    def fetchall(self):
+        return self.result
+
+def test_ensure_indexes_redefines_changed_unique_key():
+    cur = IndexCursor({"returns": {"uk_returns_natural": (True, ["orderid", "barcode"]),
+                                   "idx_returns_returndate": (False, ["returndate"])}})
+    added = S.ensure_indexes(cur, ["returns"])
+    assert added == ["~returns.uk_returns_natural", "returns.uk_returns_natural"]
+    assert cur.ddl == ["ALTER TABLE returns DROP INDEX uk_returns_natural",
+                       "ALTER TABLE returns ADD UNIQUE KEY uk_returns_natural (orderid, barcode, returndate)"]
+    cur = IndexCursor({"returns": {"uk_returns_natural": (True, ["orderid", "barcode", "returndate"])}})
+    assert S.ensure_indexes(cur, ["returns"]) == ["returns.idx_returns_returndate"]
+
+class RecordCursor:
+    def __init__(self):
+        self.sql = []
+
+    def execute(self, sql, params=()):
+        self.sql.append((" ".join(sql.split()), params))
+
+    def executemany(self, sql, rows):
+        self.sql.append((" ".join(sql.split()), list(rows)))
+
+def test_bump_attaches_pending_changes():
+    cur = RecordCursor()
+    S.bump_data_version(cur, [])
+    assert cur.sql == []
+    S.log_change(cur, ["orders"], "2025-08-01")
+    S.bump_data_version(cur, ["orders", "product"])
+    assert cur.sql[0] == ("INSERT INTO data_change (table_name, version, day_from, day_to) VALUES (%s, NULL, %s, %s)",
+                          [("orders", "2025-08-01", None)])
+    sql, params = cur.sql[-1]
+    assert sql.startswith("UPDATE data_change c JOIN data_version v") and "c.version IS NULL" in sql
+    assert params == ["orders", "product"]
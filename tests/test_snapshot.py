@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+import snapshot as S
+
+'''
+    snapshot.py：欄式快照的讀寫，以及多個 writer 同時寫同一個路徑時讀取端只看到完整的快照。
+'''
+
+def frame(i, n=2000):
+    return pd.DataFrame({
+        "k": pd.Series([i] * n, dtype="int64"),
+        "cat": pd.Categorical([f"c{i}"] * n),
+        "s": [f"s{i}"] * n,
+        "p": pd.period_range("2025-01", periods=n, freq="D"),
+        "x": [float(i)] * n,
+    })
+
+def test_round_trip_and_fingerprint(tmp_path):
+    path = str(tmp_path / "snap")
+    assert S.load_snapshot(path) is None
+    df = frame(1)
+    S.save_snapshot(df, path, "fp1")
+    exp = df.assign(s=df["s"].astype("category"))
+    assert_frame_equal(S.load_snapshot(path, "fp1", mmap=False), exp)
+    assert (S.load_snapshot(path, "fp1")["x"] == 1.0).all()
+    assert S.load_snapshot(path, "other") is None
+    assert S.read_meta(path)["rows"] == len(df)
+
+def test_concurrent_writers(tmp_path, monkeypatch):
+    """多個 writer 同時寫（同一個 pid 的多執行緒也不互相覆蓋），讀取端每次都讀到某一份完整快照"""
+    path = str(tmp_path / "snap")
+    S.save_snapshot(frame(0), path, "fp0")
+    errors, stop = [], threading.Event()
+
+    def write(i):
+        try:
+            for _ in range(5):
+                S.save_snapshot(frame(i), path, f"fp{i}")
+        except Exception as e:           # noqa: BLE001
+            errors.append(e)
+
+    def read():
+        while not stop.is_set():
+            meta = S.read_meta(path)
+            df = S.load_snapshot(path, mmap=False)
+            if df is None or meta is None:
+                continue                 # 剛好讀到被清掉的舊版本：呼叫端會重建，不算錯
+            i = int(df["k"].iloc[0])
+            if not ((df["k"] == i).all() and (df["cat"] == f"c{i}").all() and len(df) == 2000):
+                errors.append(AssertionError(f"混到不同版本 {i}"))
+
+    readers = [threading.Thread(target=read) for _ in range(2)]
+    writers = [threading.Thread(target=write, args=(i,)) for i in range(1, 7)]
+    for t in readers + writers:
+        t.start()
+    for t in writers:
+        t.join()
+    stop.set()
+    for t in readers:
+        t.join()
+    assert not errors
+    meta = S.read_meta(path)
+    df = S.load_snapshot(path, meta["fingerprint"])
+    assert meta["fingerprint"] == f"fp{int(df['k'].iloc[0])}"
+    assert len(os.listdir(path)) == 6 * 5 + 2                        # 寬限期內的舊版本先留著
+    monkeypatch.setattr(S, "KEEP_SECONDS", -1)
+    S.save_snapshot(frame(9), path, "fp9")
+    assert sorted(os.listdir(path)) == sorted([S.CURRENT, os.path.basename(S.current_dir(path))])
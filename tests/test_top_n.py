@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+import pytest
+
+import analytic as A
+
+def synthetic(n=5000, seed=21):
+    """大量同值與 NaN 的商品表"""
+    rng = np.random.default_rng(seed)
+    d = pd.DataFrame({"g": pd.Categorical(rng.choice(list("abcde"), n)),
+                      "x": rng.integers(0, 20, n).astype(float),
+                      "y": rng.integers(0, 5, n).astype(float),
+                      "z": rng.integers(0, 3, n)})
+    d.loc[rng.random(n) < 0.1, "x"] = np.nan
+    d.loc[rng.random(n) < 0.05, "y"] = np.nan
+    return d
+
+@pytest.mark.parametrize("by,ascending", [(["x", "y"], [False, False]), (["x", "y", "z"], [True, False, True]),
+                                          (["y", "x"], [False, True])])
+@pytest.mark.parametrize("n", [1, 5, 50])
+def test_top_n_matches_sort_values(by, ascending, n):
+    d = synthetic()
+    exp = d.sort_values(by, ascending=ascending, kind="stable", na_position="last").head(n)
+    assert d.take(A.top_n_positions(d, by, ascending, n)).index.equals(exp.index)
+    # 分組：各組前 n，組依類別順序
+    exp = (d.sort_values(by, ascending=ascending, kind="stable", na_position="last")
+            .groupby("g", observed=True, sort=False).head(n))
+    exp = exp.sort_values("g", kind="stable")
+    assert d.take(A.top_n_positions(d, by, ascending, n, group=d["g"])).index.equals(exp.index)
+
+def test_top_n_small_and_empty():
+    d = synthetic(7)
+    assert list(A.top_n_positions(d, ["x"], [False], 10)) == \
+        list(np.argsort(-d["x"].fillna(-np.inf).to_numpy(), kind="stable"))
+    assert len(A.top_n_positions(d.iloc[:0], ["x"], [False], 5)) == 0
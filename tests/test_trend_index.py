@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+import analytic as A
+from conftest import frames_equal
+
+def test_trend_index_matches_detail(base, sample_filters):
+    idx = A.TrendIndex(base)
+    answered = 0
+    for f in sample_filters:
+        for freq in ("D", "W", "M"):
+            got = idx.event_return_rate(f, freq)
+            if got is None:          # 商品 / 日期條件：走明細路徑
+                assert f.productid or f.order_from or f.order_to or f.return_from or f.return_to
+                continue
+            answered += 1
+            frames_equal(got[0], A.event_return_rate(A.apply_filters(base, f), freq)[0])
+    assert answered >= 9